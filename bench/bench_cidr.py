@@ -0,0 +1,87 @@
+#!/usr/bin/python
+
+'''Compare NetworkIndex lookups against the linear scan over cidr ranges
+that Manager.address_is_valid used to do.
+
+Run from the top of the source tree:
+
+    PYTHONPATH=. python bench/bench_cidr.py'''
+
+import argparse
+import random
+import time
+
+import netaddr
+
+from kiwi.netindex import NetworkIndex
+
+
+def legacy_is_valid(networks, address):
+    for net in networks:
+        if address in net:
+            return True
+
+    return False
+
+
+def make_networks(count):
+    '''Return count distinct /24 networks spread across 10.0.0.0/8.'''
+    blocks = random.sample(range(1 << 16), count)
+    return [netaddr.IPNetwork('10.%d.%d.0/24' % (b >> 8, b & 255))
+            for b in blocks]
+
+
+def make_addresses(networks, count):
+    '''Return count addresses, about half of which fall inside one of
+    the networks.'''
+
+    addresses = []
+    for i in range(count):
+        if i % 2:
+            net = random.choice(networks)
+            addresses.append(str(net[random.randint(0, 255)]))
+        else:
+            addresses.append('10.%d.%d.%d' % (random.randint(0, 255),
+                                              random.randint(0, 255),
+                                              random.randint(0, 255)))
+    return addresses
+
+
+def measure(addresses, check):
+    start = time.time()
+    hits = sum(1 for address in addresses if check(address))
+    return hits, time.time() - start
+
+
+def report(label, count, hits, elapsed):
+    print('%-28s %8.3f s  %10.1f us/lookup  %6d hits' % (
+        label, elapsed, elapsed / count * 1e6, hits))
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--lookups', type=int, default=5000)
+    p.add_argument('--ranges', default='10,100,1000')
+    p.add_argument('--seed', type=int, default=0)
+    args = p.parse_args()
+
+    random.seed(args.seed)
+
+    for count in [int(x) for x in args.ranges.split(',')]:
+        networks = make_networks(count)
+        addresses = make_addresses(networks, args.lookups)
+
+        start = time.time()
+        index = NetworkIndex(networks)
+        print('%d ranges (index built in %.3f ms)' % (
+            count, (time.time() - start) * 1e3))
+
+        report('  linear scan', args.lookups,
+               *measure(addresses,
+                        lambda address: legacy_is_valid(networks, address)))
+        report('  NetworkIndex', args.lookups,
+               *measure(addresses, index.contains))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+#!/usr/bin/python
+
+'''Measure how long it takes for the addresses owned by a dead agent
+to be claimed by the survivors.
+
+Several kiwi agents, each in its own process and using drivers that
+record changes instead of making them, watch the same in-process fake
+Kubernetes API and share one fake etcd.  Once every address has been
+claimed we kill (SIGKILL, so nothing is released) the agent that owns
+the most addresses and wait until each of its addresses has been
+claimed by another agent.
+
+For each orphaned address we report the time from the dead agent's
+last heartbeat for that address (the start of the TTL that then ran
+out) until it was claimed elsewhere, split into the time until the
+claim expired and the time from expiry to the new claim.  We also
+report how many claim PUTs the survivors made and how many of them
+lost the race.
+
+Run from the top of the source tree:
+
+    PYTHONPATH=. python bench/bench_failover.py --agents 3 --runs 3'''
+
+import argparse
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import time
+
+from kiwi import manager
+from kiwi.tests import drivers
+from kiwi.tests import fakeetcd
+from kiwi.tests import fakekube
+
+
+def service(i):
+    return {'id': 'service-%d' % i,
+            'port': 80,
+            'protocol': 'TCP',
+            'publicIPs': ['10.0.%d.%d' % (i >> 8 & 255, i & 255)]}
+
+
+def agent(id, etcd_endpoint, kube_endpoint, options):
+    logging.basicConfig(level=logging.CRITICAL)
+
+    mgr = manager.Manager(id=id,
+                          etcd_endpoint=etcd_endpoint,
+                          kube_endpoint=kube_endpoint,
+                          iface_driver=drivers.RecordingInterface(),
+                          fw_driver=drivers.RecordingFirewall(),
+                          **options)
+    mgr.mainloop()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class Simulation (object):
+    def __init__(self, args):
+        self.args = args
+        self.ttl = args.refresh_interval * 2
+        self.etcd = fakeetcd.FakeEtcd(history=args.etcd_history).start()
+        self.kube = fakekube.FakeKube().start()
+        self.agents = {}
+
+    def stop(self):
+        for child in self.agents.values():
+            if child.is_alive():
+                os.kill(child.pid, signal.SIGKILL)
+            child.join()
+
+        self.kube.stop()
+        self.etcd.stop()
+
+    def claims(self):
+        '''Return a dict mapping each claimed address to its owner and
+        the expiration time of the claim.'''
+
+        return dict((key.split('/')[-1], node) for key, node in
+                    self.etcd.owners('/kiwi/publicips').items())
+
+    def start(self):
+        for i in range(self.args.services):
+            self.kube.add(service(i))
+
+        options = {'refresh_interval': self.args.refresh_interval,
+                   'heartbeat_mode': self.args.heartbeat_mode,
+                   'ownership_mode': self.args.ownership_mode}
+
+        for i in range(self.args.agents):
+            id = 'agent-%d' % i
+            child = multiprocessing.Process(
+                target=agent,
+                args=(id, self.etcd.endpoint, self.kube.endpoint, options))
+            child.start()
+            self.agents[id] = child
+
+        deadline = time.time() + self.args.timeout
+        while len(self.claims()) < self.args.services:
+            if time.time() > deadline:
+                raise RuntimeError('agents did not claim every address')
+            time.sleep(0.05)
+
+    def last_heartbeats(self, victim, orphans):
+        '''Return the time of the victim's last heartbeat for each of
+        its addresses, which is when the TTL that is now running out
+        was set.'''
+
+        if self.args.ownership_mode == 'agent':
+            _, expiration = self.etcd.owners('/kiwi/agents')[
+                '/kiwi/agents/%s' % victim]
+            return dict((address, expiration - self.ttl)
+                        for address in orphans)
+
+        claims = self.claims()
+        return dict((address, claims[address][1] - self.ttl)
+                    for address in orphans)
+
+    def failover(self):
+        claims = self.claims()
+        owned = {}
+        for address, (owner, _) in claims.items():
+            owned.setdefault(owner, set()).add(address)
+
+        victim = max(owned, key=lambda owner: len(owned[owner]))
+        orphans = owned[victim]
+
+        # kill the victim at a random point in its heartbeat cycle.
+        time.sleep(random.uniform(0, self.args.refresh_interval))
+        os.kill(self.agents[victim].pid, signal.SIGKILL)
+        self.agents[victim].join()
+
+        heartbeats = self.last_heartbeats(victim, orphans)
+        before = dict(self.etcd.responses)
+
+        claimed = {}
+        deadline = time.time() + self.ttl + self.args.timeout
+        while len(claimed) < len(orphans) and time.time() < deadline:
+            now = time.time()
+            for address, (owner, _) in self.claims().items():
+                if (address in orphans and address not in claimed and
+                        owner != victim):
+                    claimed[address] = now
+            time.sleep(0.01)
+
+        responses = dict((key, count - before.get(key, 0))
+                         for key, count in self.etcd.responses.items())
+
+        return {'victim': victim,
+                'orphans': len(orphans),
+                'claimed': len(claimed),
+                'latency': [claimed[address] - heartbeats[address]
+                            for address in claimed],
+                'after_expiry': [claimed[address] - heartbeats[address] -
+                                 self.ttl for address in claimed],
+                'responses': responses}
+
+
+def report(run, result):
+    print('run %d: killed %s, which owned %d addresses' % (
+        run, result['victim'], result['orphans']))
+
+    if result['claimed'] < result['orphans']:
+        print('  only %d addresses were claimed again' % result['claimed'])
+
+    if result['latency']:
+        for label, values in [('last heartbeat to claim',
+                               result['latency']),
+                              ('expiry to claim',
+                               result['after_expiry'])]:
+            print('  %-24s min %6.2f  p50 %6.2f  p99 %6.2f  max %6.2f s' % (
+                label, min(values), percentile(values, 0.5),
+                percentile(values, 0.99), max(values)))
+
+    refused = sum(count for (method, status), count
+                  in result['responses'].items()
+                  if method == 'PUT' and status >= 400)
+    print('  refused claim PUTs       %d (%.1f per orphan)' % (
+        refused, float(refused) / max(1, result['orphans'])))
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--agents', type=int, default=3)
+    p.add_argument('--services', type=int, default=100)
+    p.add_argument('--runs', type=int, default=3)
+    p.add_argument('--refresh-interval', type=int, default=2)
+    p.add_argument('--heartbeat-mode', default='scheduler',
+                   choices=['pass', 'scheduler'])
+    p.add_argument('--ownership-mode', default='address',
+                   choices=['address', 'agent'])
+    p.add_argument('--etcd-history', type=int, default=10000)
+    p.add_argument('--timeout', type=int, default=60)
+    args = p.parse_args()
+
+    print('%d agents, %d services, refresh interval %d s (ttl %d s), '
+          '%s ownership, %s heartbeats' % (
+              args.agents, args.services, args.refresh_interval,
+              args.refresh_interval * 2, args.ownership_mode,
+              args.heartbeat_mode))
+
+    for run in range(args.runs):
+        sim = Simulation(args)
+        try:
+            sim.start()
+            report(run, sim.failover())
+        finally:
+            sim.stop()
+
+
+if __name__ == '__main__':
+    main()
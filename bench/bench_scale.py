@@ -0,0 +1,164 @@
+#!/usr/bin/python
+
+'''Measure how quickly kiwi converges when services are created, using
+in-process stand-ins for Kubernetes and etcd and drivers that record
+changes instead of making them.
+
+For each size, the fake APIs run in this process and kiwi runs in a
+child process so that they do not compete for the same interpreter
+lock.  Once kiwi is watching, N services (each with its own public
+address) are created as fast as possible.  We report how long kiwi
+took to handle all of the service events, how long until it had
+claimed and configured every address, and how much memory it used.
+
+Run from the top of the source tree:
+
+    PYTHONPATH=. python bench/bench_scale.py --sizes 1000,10000,50000'''
+
+import argparse
+import logging
+import multiprocessing
+import resource
+import threading
+import time
+
+from kiwi import manager
+from kiwi.tests import drivers
+from kiwi.tests import fakeetcd
+from kiwi.tests import fakekube
+
+
+def rss():
+    '''Return the resident set size of this process in bytes.'''
+    with open('/proc/self/statm') as fd:
+        return int(fd.read().split()[1]) * resource.getpagesize()
+
+
+def service(i):
+    return {'id': 'service-%d' % i,
+            'port': 80,
+            'protocol': 'TCP',
+            'publicIPs': ['10.%d.%d.%d' % (i >> 16 & 255,
+                                           i >> 8 & 255,
+                                           i & 255)]}
+
+
+def agent(etcd_endpoint, kube_endpoint, count, options, results):
+    '''Run kiwi until it has handled `count` services and configured
+    their addresses, then report on the queue.'''
+
+    logging.basicConfig(level=logging.CRITICAL)
+
+    iface = drivers.RecordingInterface()
+    fw = drivers.RecordingFirewall()
+    mgr = manager.Manager(id='bench',
+                          etcd_endpoint=etcd_endpoint,
+                          kube_endpoint=kube_endpoint,
+                          iface_driver=iface,
+                          fw_driver=fw,
+                          **options)
+
+    rss_start = rss_peak = rss()
+    thread = threading.Thread(target=mgr.mainloop)
+    thread.daemon = True
+    thread.start()
+
+    handled = converged = None
+    deadline = time.time() + options.get('refresh_interval', 600)
+    while converged is None and time.time() < deadline:
+        now = time.time()
+        if handled is None and len(mgr.services) >= count:
+            handled = now
+        if handled is not None and len(iface.addresses) >= count:
+            converged = now
+        rss_peak = max(rss_peak, rss())
+        time.sleep(0.01)
+
+    # the kernel only updates ru_maxrss from time to time, so it can
+    # lag behind our own readings.
+    rss_end = rss()
+    rss_peak = max(rss_peak, rss_end, resource.getrusage(
+        resource.RUSAGE_SELF).ru_maxrss * 1024)
+
+    results.put({'handled': handled,
+                 'converged': converged,
+                 'rss_start': rss_start,
+                 'rss_end': rss_end,
+                 'rss_peak': rss_peak,
+                 'firewall': dict(fw.calls),
+                 'interface': dict(iface.calls)})
+
+
+def run(count, args):
+    etcd = fakeetcd.FakeEtcd(history=args.etcd_history).start()
+    kube = fakekube.FakeKube(history=count + 1).start()
+    results = multiprocessing.Queue()
+
+    options = {'refresh_interval': args.refresh_interval,
+               'batch_size': args.batch_size,
+               'coalesce_window': args.coalesce_window}
+    child = multiprocessing.Process(target=agent,
+                                    args=(etcd.endpoint, kube.endpoint,
+                                          count, options, results))
+    child.start()
+
+    try:
+        while not kube.watchers:
+            time.sleep(0.01)
+
+        start = time.time()
+        for i in range(count):
+            kube.add(service(i))
+        produced = time.time() - start
+
+        result = results.get(timeout=args.refresh_interval + 10)
+    finally:
+        child.terminate()
+        child.join()
+        kube.stop()
+        etcd.stop()
+
+    return start, produced, result, dict(etcd.requests)
+
+
+def report(count, start, produced, result, requests):
+    print('%d services (events created in %.2f s)' % (count, produced))
+
+    if result['handled'] is None or result['converged'] is None:
+        print('  did not converge')
+        return
+
+    handled = result['handled'] - start
+    converged = result['converged'] - start
+    print('  handled in    %8.2f s  %10.0f events/s' % (
+        handled, count / handled))
+    print('  converged in  %8.2f s  %10.0f addresses/s' % (
+        converged, count / converged))
+    print('  memory        %8.1f MB rss (+%.1f MB), %.1f MB peak' % (
+        result['rss_end'] / 1e6,
+        (result['rss_end'] - result['rss_start']) / 1e6,
+        result['rss_peak'] / 1e6))
+    print('  etcd requests %s' % ', '.join(
+        '%s=%d' % item for item in sorted(requests.items())))
+    print('  firewall      %s' % ', '.join(
+        '%s=%d' % item for item in sorted(result['firewall'].items())))
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--sizes', default='1000,10000,50000')
+    p.add_argument('--batch-size', type=int, default=100)
+    p.add_argument('--coalesce-window', type=float, default=0)
+    p.add_argument('--etcd-history', type=int, default=1000)
+
+    # heartbeats are not what we are measuring, so by default they are
+    # sent rarely.  This is also how long we wait for convergence.
+    p.add_argument('--refresh-interval', type=int, default=600)
+    args = p.parse_args()
+
+    for count in [int(x) for x in args.sizes.split(',')]:
+        report(count, *run(count, args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/python
+
+'''Compare the watch stream decoder against the line-based reader it
+replaced, on a synthetic multi-megabyte Kubernetes watch stream.
+
+Both readers decode the same chunked response, which `cat` writes into
+a socket pair so that it is read through a real socket.  The decoder
+reads it as kiwi does, through httplib and urllib3.  The old reader
+skips the headers and reads the body from the socket 1 KiB at a time;
+it splits lines on CRLF rather than with splitlines(), which mis-framed
+most events whenever a read ended between CR and LF.
+
+Each reader yields the events as servicewatcher.iter_request_events
+does, so the CPU time counted is that of framing and parsing them: the
+old reader parses each payload with json.loads, the decoder each chunk
+with JSONDecoder.raw_decode.  A payload that does not parse, because it
+was framed wrongly, is counted as an error.
+
+Run from the top of the source tree:
+
+    PYTHONPATH=. python bench/bench_stream.py'''
+
+import argparse
+import httplib
+import json
+import os
+import socket
+import subprocess
+import tempfile
+import time
+from itertools import izip
+
+from requests.packages import urllib3
+
+from kiwi.utils import StreamDecoder
+
+headers = ('HTTP/1.1 200 OK\r\n'
+           'Content-Type: application/json\r\n'
+           'Transfer-Encoding: chunked\r\n'
+           '\r\n')
+
+
+def legacy_iter_lines(fd, chunk_size=1024):
+    pending = ''
+
+    while True:
+        chunk = os.read(fd, chunk_size)
+        if not chunk:
+            break
+
+        lines = (pending + chunk).split('\r\n')
+        pending = lines.pop()
+
+        for line in lines:
+            yield line
+
+    if pending:
+        yield pending
+
+
+def legacy_decode(sock, read_size):
+    data = ''
+    while len(data) < len(headers):
+        data += sock.recv(len(headers) - len(data))
+
+    lines = legacy_iter_lines(sock.fileno())
+    for expected_len, data in izip(lines, lines):
+        if int(expected_len, 16) != len(data):
+            raise ValueError('data length mismatch')
+        if not data:
+            break
+
+        try:
+            yield json.loads(data)
+        except ValueError:
+            yield None
+
+
+def stream_decode(sock, read_size):
+    '''Read the stream as kiwi does, through a urllib3 response.'''
+
+    r = httplib.HTTPResponse(sock, method='GET', buffering=True)
+    r.begin()
+    raw = urllib3.HTTPResponse.from_httplib(r, preload_content=False)
+    for events in StreamDecoder(raw, read_size):
+        for event in events:
+            yield event
+
+
+def make_stream(path, count):
+    with open(path, 'w') as fd:
+        fd.write(headers)
+        for i in range(count):
+            event = json.dumps({
+                'type': 'ADDED',
+                'object': {
+                    'id': 'service-%d' % i,
+                    'kind': 'Service',
+                    'port': 8000 + i % 1000,
+                    'protocol': 'TCP',
+                    'publicIPs': ['10.%d.%d.%d' % (i >> 16 & 255,
+                                                   i >> 8 & 255,
+                                                   i & 255)],
+                    'selector': {'name': 'service-%d' % i},
+                    'labels': {'app': 'bench', 'tier': 'frontend'},
+                    'resourceVersion': i + 1,
+                }}) + '\n'
+            fd.write('%x\r\n%s\r\n' % (len(event), event))
+        fd.write('0\r\n\r\n')
+
+
+def measure(path, decode, read_size):
+    '''Decode every event in the stream, returning the CPU time taken
+    and the number of events that parsed and that failed to.'''
+
+    rsock, wsock = socket.socketpair()
+    writer = subprocess.Popen(['cat', path], stdout=wsock)
+    wsock.close()
+
+    # wrap the socket as socket.create_connection would, so that
+    # httplib reads it through a socket._fileobject.
+    sock = socket.socket(_sock=rsock)
+    try:
+        start = time.clock()
+        events = list(decode(sock, read_size))
+        elapsed = time.clock() - start
+    finally:
+        sock.close()
+        writer.wait()
+
+    errors = events.count(None)
+    return elapsed, len(events) - errors, errors
+
+
+def report(label, events, elapsed, count, errors):
+    print('%-30s %8.3f s  %6.2f us/event  %8d events  %4d errors' % (
+        label, elapsed, elapsed / events * 1e6, count, errors))
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--events', type=int, default=20000)
+    p.add_argument('--read-sizes', default='1024,16384,65536,262144')
+    p.add_argument('--repeat', type=int, default=5)
+    args = p.parse_args()
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        make_stream(path, args.events)
+        size = os.path.getsize(path)
+        print('stream: %d events, %.1f MB, best of %d runs' % (
+            args.events, size / 1e6, args.repeat))
+
+        runs = [('old reader (1 KiB reads)', legacy_decode, 1024)]
+        runs.extend(('StreamDecoder (%d KiB reads)' % (read_size / 1024),
+                     stream_decode, read_size)
+                    for read_size in
+                    [int(x) for x in args.read_sizes.split(',')])
+
+        for label, decode, read_size in runs:
+            results = [measure(path, decode, read_size)
+                       for i in range(args.repeat)]
+            report(label, args.events, *min(results))
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
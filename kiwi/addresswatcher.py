@@ -1,32 +1,136 @@
 import logging
-import requests
 import time
 import re
 
+import client as kiwiclient
 import defaults
 
 LOG = logging.getLogger(__name__)
 re_address = re.compile('\d+\.\d+\.\d+\.\d+')
 
+ERR_KEY_NOT_FOUND = 100
+ERR_EVENT_INDEX_CLEARED = 401
 
-def iter_events(url, interval=1, recursive=True):
+
+class EventIndexCleared (Exception):
+    pass
+
+
+def iter_nodes(node):
+    '''Iterate over all the leaf nodes in an etcd directory listing.'''
+
+    if not node.get('dir'):
+        yield node
+        return
+
+    for child in node.get('nodes', []):
+        for leaf in iter_nodes(child):
+            yield leaf
+
+
+def snapshot(url, client):
+    '''Return an (index, nodes) tuple, where index is the etcd index at
+    which the listing was taken and nodes is a dictionary mapping keys
+    to nodes for every key under the given URL.'''
+
+    r = client.get(url, params={'recursive': True})
+    index = int(r.headers['X-Etcd-Index'])
+
+    if r.status_code == 404 and r.json().get('errorCode') == \
+            ERR_KEY_NOT_FOUND:
+        return index, {}
+
+    r.raise_for_status()
+    return index, dict((node['key'], node)
+                       for node in iter_nodes(r.json()['node']))
+
+
+def diff_events(old, new):
+    '''Generate synthetic events that turn the old set of nodes into
+    the new set of nodes.  We cannot tell from a snapshot whether a
+    missing key was deleted or expired, so all removals are reported as
+    deletes.'''
+
+    events = []
+    for key, node in new.items():
+        if key not in old:
+            events.append({'action': 'create', 'node': node})
+        elif old[key].get('value') != node.get('value'):
+            events.append({'action': 'set', 'node': node,
+                           'prevNode': old[key]})
+
+    for key, node in old.items():
+        if key not in new:
+            events.append({'action': 'delete', 'node': node,
+                           'prevNode': node})
+
+    return events
+
+
+def iter_events(url, interval=1, recursive=True, client=None):
     '''Produces an inifite stream of events from etcd regarding the given
-    URL.'''
+    URL.
+
+    We start from a snapshot of the keys under the URL and keep track
+    of their values as events arrive.  If we fall so far behind that
+    etcd has discarded the events we are waiting for, we take a new
+    snapshot, generate synthetic events for any differences from the
+    values we know about, and continue watching from the index of the
+    snapshot.'''
 
+    if client is None:
+        client = kiwiclient.Client()
+
+    known = None
+    resync = False
     waitindex = None
 
     while True:
         try:
+            if known is None or resync:
+                index, nodes = snapshot(url, client)
+                LOG.info('snapshot of %s at index %d (%d keys)',
+                         url, index, len(nodes))
+
+                events = diff_events(known, nodes) if resync else []
+                if resync:
+                    LOG.warn('resynchronized at index %d (%d changes)',
+                             index, len(events))
+
+                known = nodes
+                resync = False
+                waitindex = index + 1
+
+                for event in events:
+                    yield event
+
             params = {'recursive': recursive,
                       'wait': True,
                       'waitIndex': waitindex}
 
-            r = requests.get(url, params=params)
+            r = client.get(url, params=params,
+                           timeout=(client.connect_timeout, None))
+            if r.status_code == 400 and r.json().get('errorCode') == \
+                    ERR_EVENT_INDEX_CLEARED:
+                raise EventIndexCleared(waitindex)
             r.raise_for_status()
 
             event = r.json()
             waitindex = event['node']['modifiedIndex'] + 1
+
+            key = event['node']['key']
+            if event['action'].lower() in ['delete',
+                                           'compareanddelete',
+                                           'expire']:
+                known.pop(key, None)
+            else:
+                known[key] = event['node']
+
             yield event
+        except EventIndexCleared as exc:
+            LOG.warn('event index %s has been cleared, resynchronizing',
+                     exc)
+            resync = True
         except Exception as exc:
             LOG.error('connection failed: %s' % exc)
             time.sleep(interval)
@@ -37,28 +141,51 @@ class AddressWatcher (object):
     keys that represent public ip addresses being managed by kiwi, and
     yields these events as Python dictionaries.'''
 
+    directory = 'publicips'
+
     def __init__(self,
                  etcd_endpoint=defaults.etcd_endpoint,
                  etcd_prefix=defaults.etcd_prefix,
-                 reconnect_interval=defaults.reconnect_interval):
+                 reconnect_interval=defaults.reconnect_interval,
+                 client=None):
         super(AddressWatcher, self).__init__()
 
         self.etcd_endpoint = etcd_endpoint
         self.etcd_prefix = etcd_prefix
         self.reconnect_interval = reconnect_interval
+        self.client = client
+
+    def valid(self, name):
+        return re_address.match(name)
+
+    def is_renewal(self, event):
+        '''Return True if an event only renewed the TTL of a key
+        without changing its value, as every heartbeat does.  No agent
+        needs to act on these, so they are not queued.'''
+
+        prev = event.get('prevNode')
+        return (event['action'].lower() in ['set', 'update',
+                                            'compareandswap'] and
+                prev is not None and
+                prev.get('value') == event['node'].get('value'))
 
     def __iter__(self):
-        url = '%s/v2/keys%s/publicips' % (self.etcd_endpoint,
-                                          self.etcd_prefix)
+        url = '%s/v2/keys%s/%s' % (self.etcd_endpoint,
+                                   self.etcd_prefix,
+                                   self.directory)
 
-        for event in iter_events(url, interval=self.reconnect_interval):
+        for event in iter_events(url, interval=self.reconnect_interval,
+                                 client=self.client):
             LOG.debug('event: %s', event)
 
             node = event['node']
             address = node['key'].split('/')[-1]
 
-            if not re_address.match(address):
-                LOG.error('invalid address %s', address)
+            if not self.valid(address):
+                LOG.error('invalid key %s', address)
+                continue
+
+            if self.is_renewal(event):
                 continue
 
             handler = getattr(self, 'handle_%s' %
@@ -90,6 +217,7 @@ class AddressWatcher (object):
                 'address': address,
                 'node': node})
 
+    handle_compareandswap = handle_set
     handle_compareanddelete = handle_delete
 
     def handle_expire(self, address, node):
@@ -98,6 +226,31 @@ class AddressWatcher (object):
                 'address': address,
                 'node': node})
 
+
+class AgentWatcher (AddressWatcher):
+    '''An AgentWatcher watches the etcd directory of agent liveness keys
+    used when addresses are owned by agents rather than having their own
+    TTL, and yields an event when an agent's key expires or is
+    deleted.'''
+
+    directory = 'agents'
+
+    def valid(self, name):
+        return True
+
+    handle_create = None
+    handle_set = None
+    handle_compareandswap = None
+
+    def handle_expire(self, agent, node):
+        return({'message': 'expire-agent',
+                'target': agent,
+                'agent': agent,
+                'node': node})
+
+    handle_delete = handle_expire
+    handle_compareanddelete = handle_expire
+
 if __name__ == '__main__':
     import pprint
 
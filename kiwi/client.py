@@ -0,0 +1,92 @@
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from six.moves.urllib.parse import urlsplit
+
+import defaults
+
+LOG = logging.getLogger(__name__)
+
+
+class Client (object):
+    '''A Client owns a pool of keep-alive HTTP connections for each API
+    endpoint that kiwi talks to, so that heartbeats and watches reuse
+    existing connections rather than opening a new one for every
+    request.
+
+    Requests are made with default (connect, read) timeouts.  Failures
+    to connect are retried, but requests that may have reached the
+    server are not, because etcd writes are not idempotent.'''
+
+    def __init__(self,
+                 pool_size=defaults.http_pool_size,
+                 connect_timeout=defaults.connect_timeout,
+                 read_timeout=defaults.read_timeout,
+                 retries=defaults.http_retries):
+        super(Client, self).__init__()
+
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    @property
+    def timeout(self):
+        return (self.connect_timeout, self.read_timeout)
+
+    def session(self, url):
+        '''Return the shared session for the endpoint of the given
+        url, creating it if necessary.'''
+
+        parts = urlsplit(url)
+        endpoint = '%s://%s' % (parts.scheme, parts.netloc)
+
+        with self.lock:
+            try:
+                return self.sessions[endpoint]
+            except KeyError:
+                pass
+
+            LOG.debug('creating session for %s', endpoint)
+            retry = Retry(total=self.retries,
+                          connect=self.retries,
+                          read=0,
+                          redirect=0,
+                          backoff_factor=0.1)
+            adapter = HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=self.pool_size,
+                                  max_retries=retry)
+            session = requests.Session()
+            session.mount('%s/' % endpoint, adapter)
+            self.sessions[endpoint] = session
+            return session
+
+    def request(self, method, url, **kwargs):
+        '''Make a request using the session for the url's endpoint.
+        Pass timeout=(connect, None) for long-polling requests that
+        should wait indefinitely for a response.'''
+
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session(url).request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+
+            self.sessions = {}
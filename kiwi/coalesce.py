@@ -0,0 +1,67 @@
+import collections
+
+
+def subject(msg):
+    '''Return what a message is about ('service', 'address', ...).'''
+    return msg['message'].split('-')[-1]
+
+
+def service_spec(service):
+    '''Return the parts of a service that kiwi acts on.'''
+    return (sorted(service.get('publicIPs') or []),
+            service.get('protocol'),
+            service.get('port'))
+
+
+def fold_service(first, last):
+    '''Return the messages that have the same net effect as the
+    sequence of service messages that started with `first` and ended
+    with `last`.'''
+
+    if first is last:
+        return [last]
+
+    if first['message'] == 'add-service':
+        if last['message'] == 'delete-service':
+            return []
+        return [dict(last, message='add-service')]
+
+    if first['message'] == 'delete-service':
+        if last['message'] == 'delete-service':
+            # the service that is actually configured is the one from
+            # before the window.
+            return [first]
+        if service_spec(first['service']) == service_spec(last['service']):
+            return []
+        return [dict(last, message='update-service')]
+
+    if last['message'] == 'add-service':
+        return [dict(last, message='update-service')]
+
+    return [last]
+
+
+def coalesce(msgs):
+    '''Fold the messages for each (subject, target) into their net
+    effect.  Service messages are folded as described in fold_service.
+    For everything else only the last message is kept, because the
+    address and agent handlers act on the current state of etcd rather
+    than on the change that produced it.
+
+    The surviving messages are returned in the order of the last
+    message for each target.'''
+
+    pending = collections.OrderedDict()
+    for msg in msgs:
+        key = (subject(msg), msg['target'])
+        first, last = pending.pop(key, (msg, msg))
+        pending[key] = (first, msg)
+
+    out = []
+    for (kind, target), (first, last) in pending.items():
+        if kind == 'service':
+            out.extend(fold_service(first, last))
+        else:
+            out.append(last)
+
+    return out
@@ -3,6 +3,25 @@ kube_endpoint = 'http://localhost:8080'
 interface = 'eth0'
 fwchain = 'KUBE-PUBLIC'
 fwmark = 1
+fw_layout = 'flat'
+reorder_interval = 60
+reorder_hysteresis = 0.2
+fwset = 'kiwi-public'
+nft_table = 'kiwi'
 etcd_prefix = '/kiwi'
 refresh_interval = 10
 reconnect_interval = 5
+batch_size = 100
+connect_timeout = 5
+read_timeout = 5
+http_retries = 2
+refresh_workers = 8
+# room for every refresh worker, three watchers and the main loop.
+http_pool_size = refresh_workers + 4
+ip_batch_timeout = 10
+heartbeat_mode = 'scheduler'
+ownership_mode = 'address'
+stream_read_size = 65536
+coalesce_window = 0
+metrics_address = '127.0.0.1'
+trace_buffer = 0
@@ -1,5 +1,12 @@
+import abc
+import collections
+import contextlib
 import logging
+import re
 import subprocess
+import threading
+
+import netaddr
 
 import defaults
 import iptables
@@ -14,45 +21,513 @@ class Firewall (object):
     This driver operates by creating rules in the `mangle` table that will
     apply a specific firewall mark to inbound packets.  The driver uses the
     mangle table in order to match packets before they are modified by the
-    REDIRECT rules generated in the nat table by kube-proxy.'''
+    REDIRECT rules generated in the nat table by kube-proxy.
+
+    With the default 'flat' layout every rule is in self.fwchain, so a
+    packet is checked against the rules for every service.  With the
+    'address' layout, self.fwchain holds one jump per public address to
+    a sub-chain named after the address (KUBE-PUBLIC-0A000001 for
+    10.0.0.1) that holds the rules for that address, and with the
+    'bucket' layout there is one sub-chain for each /24.  Sub-chains are
+    created when their first rule is added and deleted when their last
+    rule is removed.
+
+    With multiport set, services that share an address and protocol
+    are marked by `-m multiport --dports` rules of up to 15 ports each
+    instead of one rule per service.  A change to a port rewrites only
+    the rule that holds it.
+
+    MARK does not end the traversal of a chain, so normally every
+    packet is checked against every rule whatever their order.  With
+    reorder set, rules instead go to (-g) a chain that sets the mark,
+    after which the packet returns to the chain that jumped to
+    self.fwchain, so the traversal ends at the first match and moving
+    busy rules to the front (see optimizer.Optimizer) pays off.  Jumps
+    to sub-chains use -g for the same reason.
+
+    Changes to the kernel are made while holding self.lock, which a
+    whole batch holds until it commits.'''
+
+    layouts = {'address': 32, 'bucket': 24}
+
+    # the most ports that a single multiport match accepts.
+    max_ports = 15
 
     def __init__(self,
                  fwchain=defaults.fwchain,
-                 fwmark=defaults.fwmark):
+                 fwmark=defaults.fwmark,
+                 table=None,
+                 reconcile=False,
+                 layout=defaults.fw_layout,
+                 multiport=False,
+                 reorder=False):
 
+        if table is None:
+            table = iptables.mangle
+
+        if layout != 'flat' and layout not in self.layouts:
+            raise ValueError('unknown firewall layout: %s' % layout)
+
+        self.table = table
         self.fwchain = fwchain
         self.fwmark = fwmark
+        self.layout = layout
+        self.multiport = multiport
+        self.reorder = reorder
+        self.markchain = '%s-MARK' % fwchain
+        self.lock = threading.RLock()
+
+        # an optimizer.Optimizer reordering our rules, if any, which
+        # is stopped before cleanup removes them.
+        self.optimizer = None
         self.rules = set()
 
+        # in multiport mode, maps (address, protocol) to a list of
+        # chunks, each of which is one rule and maps the ports in that
+        # rule to the ids of the services that use them.
+        self.groups = {}
+        self.pending = None
+
+        # in a batch, maps id() of each chunk whose ports have changed
+        # to the chunk and its ports before the batch; render_dirty
+        # gives each of them a new rule when the batch is committed.
+        self.dirty = collections.OrderedDict()
+        self.existing = {}
+
+        # maps the name of each sub-chain in use to the set of rules
+        # it holds.
+        self.members = {}
+        self.chains = {}
+
+        # sub-chains found by load_rules, which map to the rule that
+        # jumps to them from self.fwchain (or None).
+        self.existing_chains = {}
+
+        # In reconcile mode we keep the rules left behind by a
+        # previous instance, so that they can be adopted instead of
+        # being flushed and added again.
         self.create_chain()
-        self.flush_rules()
+        if reorder:
+            self.create_mark_chain()
+
+        if reconcile:
+            self.load_rules()
+        else:
+            self.flush_rules()
 
     def cleanup(self):
+        if self.optimizer is not None:
+            self.optimizer.stop()
+
         self.flush_rules()
+        if self.reorder:
+            self.delete_mark_chain()
 
     def create_chain(self):
         '''Create self.fwchain if it does not already exist.'''
 
-        if iptables.mangle.chain_exists(self.fwchain):
+        try:
+            self.chain = self.table.chains[self.fwchain]
             return
+        except KeyError:
+            pass
 
         LOG.info('creating chain %s', self.fwchain)
         try:
-            iptables.mangle.create_chain(self.fwchain)
+            self.chain = self.table.create_chain(self.fwchain)
+        except iptables.CommandError as exc:
+            raise FirewallDriverError(reason=exc)
+
+    def create_mark_chain(self):
+        '''Create self.markchain if it does not exist, and make it
+        contain only the rule that sets our mark.'''
+
+        try:
+            with self.table.batch():
+                if not self.table.chain_exists(self.markchain):
+                    self.table.create_chain(self.markchain)
+
+                self.table.flush_chain(self.markchain)
+                self.table.modify('-A', self.markchain,
+                                  *self.mark_target())
+        except iptables.CommandError as exc:
+            raise FirewallDriverError(reason=exc)
+
+    def delete_mark_chain(self):
+        '''Delete self.markchain, once no rules refer to it.'''
+
+        LOG.info('deleting chain %s', self.markchain)
+        try:
+            with self.table.batch():
+                self.table.flush_chain(self.markchain)
+                self.table.delete_chain(self.markchain)
         except iptables.CommandError as exc:
             raise FirewallDriverError(reason=exc)
 
+    def mark_target(self):
+        return ['-j', 'MARK', '--set-mark', str(self.fwmark)]
+
+    def target(self):
+        '''Return the target arguments for a rule that marks
+        packets.'''
+
+        if self.reorder:
+            return ['-g', self.markchain]
+
+        return self.mark_target()
+
+    def is_our_target(self, args):
+        '''Return True if a rule, given as a map from each option to
+        its argument, marks packets the way that we would.'''
+
+        if self.reorder:
+            return args.get('-g') == self.markchain
+
+        mark = args.get('--set-xmark', args.get('--set-mark'))
+        return int(mark.split('/')[0], 0) == int(self.fwmark)
+
+    def is_subchain(self, name):
+        return re.match('%s-[0-9A-F]+$' % re.escape(self.fwchain),
+                        name) is not None
+
+    def subchain_for(self, address):
+        '''Return the name of the sub-chain that holds the rules for
+        address and the destination matched by the rule that jumps to
+        it, or (self.fwchain, None) in the flat layout.'''
+
+        if self.layout == 'flat':
+            return self.fwchain, None
+
+        prefixlen = self.layouts[self.layout]
+        network = netaddr.IPNetwork('%s/%d' % (address, prefixlen)).cidr
+        return ('%s-%0*X' % (self.fwchain, prefixlen // 4,
+                             int(network.ip) >> (32 - prefixlen)),
+                str(network))
+
+    def jump_rule(self, name, destination):
+        return iptables.Rule(['-d', destination,
+                              '-g' if self.reorder else '-j', name])
+
     def flush_rules(self):
-        '''Flush all rules in self.fwchain.'''
+        '''Flush all rules in self.fwchain and delete any sub-chains.'''
 
         LOG.info('flushing all rules from %s',
                  self.fwchain)
         self.rules = set()
+        self.members = {}
+        self.groups = {}
         try:
-            iptables.mangle.flush_chain(self.fwchain)
+            with self.lock, self.table.batch():
+                self.chain.flush()
+                for name in list(self.table.chains.keys()):
+                    if self.is_subchain(name):
+                        LOG.info('deleting chain %s', name)
+                        self.table.flush_chain(name)
+                        self.table.delete_chain(name)
         except iptables.CommandError as exc:
             raise FirewallDriverError(reason=exc)
 
+    def load_rules(self):
+        '''Read the rules that are already in self.fwchain and its
+        sub-chains into self.existing, which maps (chain, (address,
+        protocol, port, service id)) keys to lists of rules, and the
+        sub-chains into self.existing_chains.'''
+
+        try:
+            chains = [(self.fwchain, self.chain)]
+            for name in list(self.table.chains.keys()):
+                if self.is_subchain(name):
+                    self.chains[name] = self.table.chains[name]
+                    self.existing_chains[name] = None
+                    chains.append((name, self.chains[name]))
+
+            rules = [(name, rule) for name, chain in chains
+                     for rule in chain.rules()]
+        except iptables.CommandError as exc:
+            raise FirewallDriverError(reason=exc)
+
+        for name, rule in rules:
+            if name == self.fwchain:
+                args = dict(zip(rule, rule[1:]))
+                target = args.get('-j', args.get('-g'))
+                if target in self.existing_chains:
+                    self.existing_chains[target] = rule
+                    continue
+
+            if self.multiport and self.load_chunk(name, rule):
+                continue
+
+            key = self.parse_rule(rule)
+            if key is None:
+                LOG.warn('unexpected rule in %s: %s', name, rule)
+                key = rule
+
+            self.existing.setdefault((name, key), []).append(rule)
+
+        LOG.info('found %d existing rules in %s and %d sub-chains',
+                 len(rules), self.fwchain, len(self.existing_chains))
+
+    def parse_rule(self, rule):
+        '''Return the key for a rule as listed by iptables, or None if
+        it is not a rule that we would have created.'''
+
+        # map each option to the argument that follows it.
+        args = dict(zip(rule, rule[1:]))
+        try:
+            if not self.is_our_target(args):
+                return None
+
+            return (args['-d'].split('/')[0],
+                    args['-p'],
+                    args['--dport'],
+                    args['--comment'])
+        except (KeyError, AttributeError, ValueError):
+            return None
+
+    def parse_multiport_rule(self, rule):
+        '''Return the address, protocol and list of ports for a
+        multiport rule as listed by iptables, or None if it is not a
+        rule that we would have created.'''
+
+        args = dict(zip(rule, rule[1:]))
+        try:
+            if not self.is_our_target(args):
+                return None
+
+            return (args['-d'].split('/')[0],
+                    args['-p'],
+                    args['--dports'].split(','))
+        except (KeyError, AttributeError, ValueError):
+            return None
+
+    def load_chunk(self, name, rule):
+        '''Record an existing multiport rule as a chunk whose ports
+        have no users yet.  Ports that are still wanted are adopted by
+        add_service, and prune removes the rest.  Returns False if the
+        rule is not one that we can adopt.'''
+
+        parsed = self.parse_multiport_rule(rule)
+        if parsed is None:
+            return False
+
+        address, protocol, ports = parsed
+        if self.subchain_for(address)[0] != name:
+            return False
+
+        chunk = {'ports': collections.OrderedDict(
+                 (port, set()) for port in ports),
+                 'rule': rule}
+        self.groups.setdefault((address, protocol), []).append(chunk)
+        return True
+
+    def rule_key(self, address, service):
+        return (address,
+                service['protocol'].lower(),
+                str(service['port']),
+                service['id'])
+
+    def prune(self):
+        '''Delete the rules and sub-chains found by load_rules that
+        were not adopted.'''
+
+        for (address, protocol), chunks in self.groups.items():
+            chain, _ = self.subchain_for(address)
+            for chunk in list(chunks):
+                stale = [port for port, users in chunk['ports'].items()
+                         if not users]
+                if not stale:
+                    continue
+
+                LOG.info('removing stale ports %s on %s from %s',
+                         ','.join(stale), address, chain)
+                ports = collections.OrderedDict(
+                    (port, users) for port, users in chunk['ports'].items()
+                    if users)
+                self.render_chunk(chunk, ports, address, protocol, chain)
+
+            self.collect_chunks(address, protocol)
+
+        existing, self.existing = self.existing, {}
+        for (name, key), rules in existing.items():
+            for rule in rules:
+                LOG.info('removing stale rule %s from %s', rule, name)
+                self.apply('delete', rule, name)
+
+        existing_chains, self.existing_chains = self.existing_chains, {}
+        for name, jump in existing_chains.items():
+            LOG.info('removing stale chain %s', name)
+            if jump is not None:
+                self.apply('delete', jump)
+            self.apply('destroy', chain=name)
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''Collect the firewall changes made inside this context and
+        commit them to the kernel in a single iptables-restore
+        transaction.  If the transaction fails, the changes are retried
+        one at a time so that a single bad rule does not discard the
+        rest of the batch.  If the context exits with any other
+        exception nothing is committed, and our bookkeeping for every
+        change is undone.'''
+
+        if self.pending is not None:
+            yield
+            return
+
+        with self.lock:
+            self.pending = []
+            try:
+                with self.table.batch():
+                    yield
+                    self.render_dirty()
+            except iptables.CommandError as exc:
+                LOG.error('failed to commit %d firewall changes: %s',
+                          len(self.pending), exc)
+                pending, self.pending = self.pending, None
+                self.replay(pending)
+            except Exception:
+                LOG.error('discarding %d uncommitted firewall changes',
+                          len(self.pending))
+                for action, rule, chain, undo in reversed(self.pending):
+                    if undo is not None:
+                        undo()
+                for chunk, old_ports, address, protocol, chain in \
+                        self.dirty.values():
+                    self.restore_chunk(chunk, old_ports, address, protocol)
+                raise
+            finally:
+                self.pending = None
+                self.dirty.clear()
+
+    def replay(self, changes):
+        '''Apply a list of (action, rule, chain, undo) changes
+        individually, calling undo to restore our bookkeeping for any
+        that fail.'''
+
+        failed = None
+        for action, rule, chain, undo in changes:
+            try:
+                self.modify(action, rule, chain)
+            except iptables.CommandError as exc:
+                LOG.error('failed to %s rule %s in %s: %s',
+                          action, rule, chain, exc)
+                failed = exc
+                if undo is not None:
+                    undo()
+
+        if failed is not None:
+            raise FirewallDriverError(reason=failed)
+
+    def modify(self, action, rule, chain):
+        if action == 'create':
+            self.chains[chain] = self.table.create_chain(chain)
+            return
+        elif action == 'destroy':
+            self.table.flush_chain(chain)
+            self.table.delete_chain(chain)
+            self.chains.pop(chain, None)
+            return
+
+        target = self.chain if chain == self.fwchain else self.chains[chain]
+        if action == 'replace':
+            # rule is a (new, old) pair, either of which may be None.
+            # Both changes go in one transaction, so the old rule is
+            # never deleted unless the new one was added.
+            new, old = rule
+            with self.table.batch():
+                if new is not None:
+                    target.append(new)
+                if old is not None:
+                    target.delete(old)
+        else:
+            getattr(target, action)(rule)
+
+    def apply(self, action, rule=None, chain=None, undo=None):
+        '''Append, delete or replace a rule, or create or destroy a
+        sub-chain, either immediately or as part of the current batch.
+        Rules go in self.fwchain unless another chain is given.
+
+        Callers update their bookkeeping once apply returns.  If the
+        change fails, `undo` is called to reverse whatever bookkeeping
+        has been done for it by then: when not in a batch, that is only
+        what modify did before apply raises FirewallDriverError.'''
+
+        if chain is None:
+            chain = self.fwchain
+
+        with self.lock:
+            try:
+                with self.table.batch():
+                    self.modify(action, rule, chain)
+            except iptables.CommandError as exc:
+                if undo is not None:
+                    undo()
+                raise FirewallDriverError(reason=exc)
+
+            if self.pending is not None:
+                self.pending.append((action, rule, chain, undo))
+
+    def use_subchain(self, address):
+        '''Return the name of the chain for address's rules, creating
+        the sub-chain and the jump to it if this is its first rule.'''
+
+        name, destination = self.subchain_for(address)
+        if name == self.fwchain or name in self.members:
+            return name
+
+        def uncreate():
+            self.chains.pop(name, None)
+            self.existing_chains.pop(name, None)
+            self.members.pop(name, None)
+
+        def unjump():
+            self.members.pop(name, None)
+            if name in self.chains:
+                # the chain is there, so adopt it next time.
+                self.existing_chains[name] = None
+
+        if name in self.existing_chains:
+            LOG.info('adopting existing chain %s', name)
+            jump = self.existing_chains.pop(name)
+        else:
+            LOG.info('creating chain %s', name)
+            jump = None
+            self.apply('create', chain=name, undo=uncreate)
+
+        if jump is None:
+            self.apply('append', self.jump_rule(name, destination),
+                       undo=unjump)
+
+        self.members[name] = set()
+        return name
+
+    def release_subchain(self, name, address):
+        '''Delete a sub-chain and the jump to it once its last rule has
+        been removed.'''
+
+        if (name == self.fwchain or name not in self.members or
+                self.members[name]):
+            return
+
+        chain = self.chains.get(name)
+
+        def undelete():
+            self.members.setdefault(name, set())
+            self.existing_chains.pop(name, None)
+
+        def undestroy():
+            if chain is not None:
+                self.chains[name] = chain
+            if name not in self.members:
+                # the jump is gone, so adopt the chain next time.
+                self.existing_chains[name] = None
+
+        LOG.info('deleting chain %s', name)
+        self.apply('delete', self.jump_rule(*self.subchain_for(address)),
+                   undo=undelete)
+        self.members.pop(name, None)
+        self.apply('destroy', chain=name, undo=undestroy)
+
     def rule_for(self, address, service):
         '''Generate an iptables rule (returned as a tuple) for the given
         address and service.'''
@@ -63,12 +538,182 @@ class Firewall (object):
             '--dport', service['port'],
             '-m', 'comment',
             '--comment', service['id'],
-            '-j', 'MARK', '--set-mark', self.fwmark
-        ])
+        ] + self.target())
+
+    def multiport_rule_for(self, address, protocol, ports):
+        return iptables.Rule(str(arg) for arg in [
+            '-d', address,
+            '-p', protocol,
+            '-m', 'multiport',
+            '--dports', ','.join(ports),
+        ] + self.target())
+
+    def track(self, rule, chain):
+        self.rules.add(rule)
+        if chain != self.fwchain:
+            self.members.setdefault(chain, set()).add(rule)
+
+    def untrack(self, rule, chain):
+        self.rules.discard(rule)
+        self.members.get(chain, set()).discard(rule)
+
+    def render_chunk(self, chunk, ports, address, protocol, chain):
+        '''Give a chunk a new set of ports, replacing its rule with one
+        for those ports.  In a batch the chunk only takes the new ports,
+        and is rendered once by render_dirty however many times its
+        ports change.'''
+
+        if self.pending is None:
+            self.write_chunk(chunk, ports, chunk['ports'],
+                             address, protocol, chain)
+            return
+
+        self.dirty.setdefault(id(chunk), (chunk, chunk['ports'],
+                                          address, protocol, chain))
+        chunk['ports'] = ports
+
+    def render_dirty(self):
+        '''Render the chunks whose ports have changed in this batch, and
+        delete the sub-chains that they leave empty.'''
+
+        released = []
+        while self.dirty:
+            _, (chunk, old_ports, address, protocol, chain) = \
+                self.dirty.popitem(last=False)
+            self.write_chunk(chunk, chunk['ports'], old_ports,
+                             address, protocol, chain)
+            self.collect_chunks(address, protocol)
+            released.append((chain, address))
+
+        for chain, address in released:
+            self.release_subchain(chain, address)
+
+    def restore_chunk(self, chunk, ports, address, protocol):
+        chunk['ports'] = ports
+        if not ports:
+            return
+
+        # the chunk may have been collected since.
+        chunks = self.groups.setdefault((address, protocol), [])
+        if not any(other is chunk for other in chunks):
+            chunks.append(chunk)
+
+    def write_chunk(self, chunk, ports, old_ports, address, protocol,
+                    chain):
+        '''Replace a chunk's rule with one for `ports`.  The new rule is
+        added before the old one is deleted so that there is no moment
+        at which neither matches.  If that fails the chunk keeps its
+        old rule and `old_ports`.'''
+
+        old = chunk['rule']
+        new = None
+        if ports:
+            new = self.multiport_rule_for(address, protocol, ports.keys())
+
+        def undo():
+            chunk['rule'] = old
+            if new is not None:
+                self.untrack(new, chain)
+            if old is not None:
+                self.track(old, chain)
+            self.restore_chunk(chunk, old_ports, address, protocol)
+
+        if new != old:
+            self.apply('replace', (new, old), chain, undo=undo)
+
+        if old is not None:
+            self.untrack(old, chain)
+        if new is not None:
+            self.track(new, chain)
+        chunk['ports'], chunk['rule'] = ports, new
+
+    def collect_chunks(self, address, protocol):
+        '''Forget the empty chunks for an address and protocol.'''
+
+        key = (address, protocol)
+        chunks = [chunk for chunk in self.groups.get(key, [])
+                  if chunk['ports']]
+        if chunks:
+            self.groups[key] = chunks
+        else:
+            self.groups.pop(key, None)
+
+    def add_port(self, address, service):
+        '''Add a service to the multiport rules for its address and
+        protocol.'''
+
+        protocol = service['protocol'].lower()
+        port = str(service['port'])
+        chunks = self.groups.setdefault((address, protocol), [])
+        chain = self.use_subchain(address)
+
+        for chunk in chunks:
+            users = chunk['ports'].get(port)
+            if users is None:
+                continue
+
+            if service['id'] in users:
+                LOG.info('not adding port for service %s '
+                         'on %s port %s (already exists)',
+                         service['id'], address, port)
+            else:
+                # the port may be in a rule adopted by load_chunk.
+                users.add(service['id'])
+                if chunk['rule'] is not None:
+                    self.track(chunk['rule'], chain)
+            return
+
+        LOG.info('adding port for service %s on %s port %s',
+                 service['id'], address, port)
+
+        for chunk in chunks:
+            if len(chunk['ports']) < self.max_ports:
+                break
+        else:
+            chunk = {'ports': collections.OrderedDict(), 'rule': None}
+            chunks.append(chunk)
+
+        ports = collections.OrderedDict(chunk['ports'])
+        ports[port] = set([service['id']])
+        self.render_chunk(chunk, ports, address, protocol, chain)
+
+    def remove_port(self, address, service):
+        '''Remove a service from the multiport rules for its address
+        and protocol.'''
+
+        protocol = service['protocol'].lower()
+        port = str(service['port'])
+        for chunk in self.groups.get((address, protocol), []):
+            if service['id'] in chunk['ports'].get(port, ()):
+                break
+        else:
+            LOG.info('not removing port for service %s '
+                     'on %s port %s (does not exist)',
+                     service['id'], address, port)
+            return
+
+        users = chunk['ports'][port]
+        if users != set([service['id']]):
+            users.discard(service['id'])
+            return
+
+        LOG.info('removing port for service %s on %s port %s',
+                 service['id'], address, port)
+
+        chain, _ = self.subchain_for(address)
+        ports = collections.OrderedDict(chunk['ports'])
+        del ports[port]
+        self.render_chunk(chunk, ports, address, protocol, chain)
+        self.collect_chunks(address, protocol)
+        self.release_subchain(chain, address)
 
     def add_service(self, address, service):
         '''Add a new service to the firewall.'''
 
+        if self.multiport:
+            self.add_port(address, service)
+            return
+
         rule = self.rule_for(address, service)
         if rule in self.rules:
             LOG.info('not adding rule for service %s '
@@ -76,27 +721,202 @@ class Firewall (object):
                      service['id'], address, service['port'])
             return
 
+        chain = self.use_subchain(address)
+        existing = self.existing.get((chain,
+                                      self.rule_key(address, service)))
+        if existing:
+            LOG.info('adopting existing rule for service %s '
+                     'on %s port %d',
+                     service['id'], address, service['port'])
+            existing.pop()
+            self.track(rule, chain)
+            return
+
         LOG.info('adding firewall rules for service %s '
                  'on %s port %d',
                  service['id'], address, service['port'])
 
-        try:
-            iptables.mangle.chains[self.fwchain].append(rule)
-        except iptables.CommandError as exc:
-            raise FirewallDriverError(reason=exc)
-        else:
-            self.rules.add(rule)
+        self.apply('append', rule, chain,
+                   undo=lambda: self.untrack(rule, chain))
+        self.track(rule, chain)
 
     def remove_service(self, address, service):
         '''Remove a service from the firewall.'''
 
+        if self.multiport:
+            self.remove_port(address, service)
+            return
+
         rule = self.rule_for(address, service)
+        if rule not in self.rules:
+            LOG.info('not removing rule for service %s '
+                     'on %s port %d (does not exist)',
+                     service['id'], address, service['port'])
+            return
 
         LOG.info('removing firewall rules for service %s '
                  'on %s port %d',
                  service['id'], address, service['port'])
-        self.rules.remove(rule)
+
+        chain, _ = self.subchain_for(address)
+        self.apply('delete', rule, chain,
+                   undo=lambda: self.track(rule, chain))
+        self.untrack(rule, chain)
+        self.release_subchain(chain, address)
+
+
+class SetFirewall (object):
+    '''Base class for firewall drivers that mark packets with a single
+    rule matching against a kernel set of (address, protocol, port)
+    entries.  Subclasses must define entry_for() and commit(), which
+    applies a list of ('add' or 'del', entry) changes in one
+    transaction.
+
+    Entries are reference counted by service id, because several
+    services may share an address and port.  Entries that were already
+    in the set when we started (self.existing) are adopted by
+    add_service and removed by prune.'''
+
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self):
+        self.entries = {}
+        self.pending = None
+        self.existing = set()
+
+    @abc.abstractmethod
+    def entry_for(self, address, service):
+        '''Return the set entry, a tuple of strings, for a service on
+        an address.'''
+
+    @abc.abstractmethod
+    def commit(self, changes):
+        '''Apply a list of (action, entry) changes to the kernel set in
+        one transaction, raising iptables.CommandError on failure.'''
+
+    def prune(self):
+        '''Delete the existing entries that were not adopted.'''
+
+        existing, self.existing = self.existing, set()
+        for entry in existing:
+            LOG.info('removing stale entry %s', entry)
+            self.apply('del', entry,
+                       undo=lambda entry=entry: self.existing.add(entry))
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''Collect the set changes made inside this context and commit
+        them in a single transaction.  If that fails, the changes are
+        retried one at a time so that a single bad entry does not
+        discard the rest of the batch.  If the context exits with any
+        other exception nothing is committed, and our bookkeeping for
+        every change is undone.'''
+
+        if self.pending is not None:
+            yield
+            return
+
+        self.pending = []
         try:
-            iptables.mangle.chains[self.fwchain].remove(rule=rule)
+            yield
+            pending = self.pending
+        except Exception:
+            LOG.error('discarding %d uncommitted set changes',
+                      len(self.pending))
+            for action, entry, undo in reversed(self.pending):
+                if undo is not None:
+                    undo()
+            raise
+        finally:
+            self.pending = None
+
+        try:
+            self.commit([(action, entry)
+                         for action, entry, undo in pending])
         except iptables.CommandError as exc:
+            LOG.error('failed to commit %d set changes: %s',
+                      len(pending), exc)
+            self.replay(pending)
+
+    def replay(self, changes):
+        '''Apply a list of (action, entry, undo) changes individually,
+        calling undo to restore our bookkeeping for any that fail.'''
+
+        failed = None
+        for action, entry, undo in changes:
+            try:
+                self.commit([(action, entry)])
+            except iptables.CommandError as exc:
+                LOG.error('failed to %s entry %s: %s', action, entry, exc)
+                failed = exc
+                if undo is not None:
+                    undo()
+
+        if failed is not None:
+            raise FirewallDriverError(reason=failed)
+
+    def apply(self, action, entry, undo=None):
+        '''Add or delete a set entry, either immediately or as part of
+        the current batch.  The caller has already updated its
+        bookkeeping, and `undo` is called to reverse that if the change
+        fails.'''
+
+        if self.pending is not None:
+            self.pending.append((action, entry, undo))
+            return
+
+        try:
+            self.commit([(action, entry)])
+        except iptables.CommandError as exc:
+            if undo is not None:
+                undo()
             raise FirewallDriverError(reason=exc)
+
+    def add_service(self, address, service):
+        '''Add a new service to the firewall.'''
+
+        entry = self.entry_for(address, service)
+        users = self.entries.setdefault(entry, set())
+        if service['id'] in users:
+            LOG.info('not adding entry for service %s '
+                     'on %s port %d (already exists)',
+                     service['id'], address, service['port'])
+            return
+
+        users.add(service['id'])
+        if len(users) > 1:
+            return
+
+        if entry in self.existing:
+            LOG.info('adopting existing entry for service %s '
+                     'on %s port %d',
+                     service['id'], address, service['port'])
+            self.existing.discard(entry)
+            return
+
+        LOG.info('adding set entry for service %s on %s port %d',
+                 service['id'], address, service['port'])
+        self.apply('add', entry,
+                   undo=lambda: self.entries.pop(entry, None))
+
+    def remove_service(self, address, service):
+        '''Remove a service from the firewall.'''
+
+        entry = self.entry_for(address, service)
+        users = self.entries.get(entry, set())
+        if service['id'] not in users:
+            LOG.info('not removing entry for service %s '
+                     'on %s port %d (does not exist)',
+                     service['id'], address, service['port'])
+            return
+
+        users.discard(service['id'])
+        if users:
+            return
+
+        LOG.info('removing set entry for service %s on %s port %d',
+                 service['id'], address, service['port'])
+        del self.entries[entry]
+        self.apply('del', entry,
+                   undo=lambda: self.entries.setdefault(
+                       entry, set()).add(service['id']))
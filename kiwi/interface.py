@@ -1,7 +1,13 @@
 import logging
+import os
 import re
+import select
 import subprocess
+import threading
+import time
 
+import defaults
+import metrics
 from exc import *
 
 re_label = re.compile(r'''\d+: \s+ (?P<ifname>\S+) \s+ inet \s+
@@ -17,26 +23,65 @@ class Interface (object):
 
     def __init__(self,
                  interface='eth0',
-                 label='kube'):
+                 label='kube',
+                 reconcile=False):
         self.interface = interface
         self.label = label
+        self.existing = set()
 
-        self.remove_labelled_addresses()
+        # In reconcile mode we keep the addresses left behind by a
+        # previous instance, so that they can be adopted instead of
+        # being removed and added again.
+        if reconcile:
+            self.existing = set(self.labelled_addresses())
+        else:
+            self.remove_labelled_addresses()
+
+    def adopt_address(self, address):
+        '''Return True if address was already configured when we
+        started, in which case it is now ours and does not need to be
+        added.'''
+
+        if address not in self.existing:
+            return False
+
+        LOG.info('adopting existing address %s on device %s',
+                 address,
+                 self.interface)
+        self.existing.discard(address)
+        return True
+
+    def prune(self):
+        '''Remove the addresses found at startup that were not
+        adopted.'''
+
+        existing, self.existing = self.existing, set()
+        for address in existing:
+            self.remove_address(address)
 
     def remove_labelled_addresses(self):
         '''Remove all addresses labelled with self.label from
         self.interface.'''
 
+        for address in self.labelled_addresses():
+            self.remove_address(address)
+
+    def labelled_addresses(self):
+        '''Return a list of addresses on self.interface that are
+        labelled with self.label.'''
+
         try:
-            out = subprocess.check_output([
-                'ip', '-o', 'addr', 'show',
-                'label', '%s:%s' % (self.interface, self.label)
-            ])
+            with metrics.timed_command('ip', args='addr show'):
+                out = subprocess.check_output([
+                    'ip', '-o', 'addr', 'show',
+                    'label', '%s:%s' % (self.interface, self.label)
+                ])
         except subprocess.CalledProcessError as exc:
             raise InterfaceDriverError(reason=exc)
 
         # we're parsing the output of the 'ip' command here, which always
         # makes me nervous.
+        addresses = []
         for line in out.splitlines():
             m = re_label.match(line)
             if not m:
@@ -44,8 +89,9 @@ class Interface (object):
                          line)
                 continue
 
-            address = m.group('ipv4addr').split('/')[0]
-            self.remove_address(address)
+            addresses.append(m.group('ipv4addr').split('/')[0])
+
+        return addresses
 
     def add_address(self, address, lft=None):
         '''Add the given address to the managed interface.'''
@@ -57,7 +103,7 @@ class Interface (object):
         # label to the address.  This allows us to identify addresses
         # that we have added, which in turns allows us to clean them up
         # at startup without needing to otherwise preserve state.
-        cmd = [ 'ip', 'addr', 'replace',
+        cmd = [ 'addr', 'replace',
                 '%s/32' % address,
                 'label', '%s:%s' % (self.interface, self.label),
                 'dev', self.interface ]
@@ -66,10 +112,7 @@ class Interface (object):
             cmd += ['preferred_lft', str(lft),
                     'valid_lft', str(lft)]
 
-        try:
-            subprocess.check_call(cmd)
-        except subprocess.CalledProcessError as exc:
-            raise InterfaceDriverError(reason=exc)
+        self.ip(*cmd)
 
     def refresh_address(self, address, lft=None):
         self.add_address(address, lft=lft)
@@ -79,14 +122,149 @@ class Interface (object):
         LOG.info('remove address %s from device %s',
                  address,
                  self.interface)
-        try:
-            subprocess.check_call([
-                'ip', 'addr', 'del',
+        self.ip('addr', 'del',
                 '%s/32' % address,
-                'dev', self.interface
-            ])
+                'dev', self.interface)
+
+    def ip(self, *args):
+        '''Run an `ip` command, raising InterfaceDriverError if it
+        fails.'''
+
+        try:
+            with metrics.timed_command('ip', args=' '.join(args)):
+                subprocess.check_call(('ip',) + args)
         except subprocess.CalledProcessError as exc:
-            raise InterfaceDriverError(reason=exc)
+            raise InterfaceDriverError(reason=exc,
+                                       returncode=exc.returncode)
+
+    def close(self):
+        '''Release whatever the driver holds open, leaving its
+        addresses in place.'''
 
     def cleanup(self):
         self.remove_labelled_addresses()
+        self.close()
+
+
+class BatchInterface (Interface):
+    '''This is a network interface driver for Kiwi that keeps a single
+    `ip -force -batch -` process running and streams commands to it,
+    rather than running a new `ip` process for every change.
+
+    After each command we send a line that `ip` does not understand.
+    Because stderr is unbuffered, the error message for that line
+    tells us that the preceding command has completed, and anything
+    printed before it is an error from that command.  If that does not
+    arrive within `timeout` seconds the process is killed, and started
+    again for the next command.'''
+
+    marker = 'kiwi-sync'
+
+    def __init__(self,
+                 interface='eth0',
+                 label='kube',
+                 reconcile=False,
+                 timeout=defaults.ip_batch_timeout):
+        self.proc = None
+        self.serial = 0
+        self.timeout = timeout
+        self.buffered = ''
+        self.lock = threading.Lock()
+
+        super(BatchInterface, self).__init__(interface=interface,
+                                             label=label,
+                                             reconcile=reconcile)
+
+    def start(self):
+        LOG.debug('starting ip batch process')
+        with open(os.devnull, 'w') as devnull:
+            self.proc = subprocess.Popen(['ip', '-force', '-batch', '-'],
+                                         stdin=subprocess.PIPE,
+                                         stdout=devnull,
+                                         stderr=subprocess.PIPE,
+                                         close_fds=True)
+        self.buffered = ''
+
+    def stop(self, kill=False):
+        if self.proc is None:
+            return
+
+        LOG.debug('stopping ip batch process')
+        try:
+            if kill:
+                self.proc.kill()
+            self.proc.stdin.close()
+            self.proc.wait()
+        except (IOError, OSError):
+            pass
+
+        self.proc = None
+
+    def ip(self, *args):
+        '''Send a command to the `ip` process and wait for it to
+        complete, raising InterfaceDriverError with the error output
+        of the command if it fails.'''
+
+        with metrics.timed_command('ip-batch', args=' '.join(args)):
+            self.send(args)
+
+    def send(self, args):
+        with self.lock:
+            if self.proc is None or self.proc.poll() is not None:
+                self.start()
+
+            self.serial += 1
+            marker = '%s-%d' % (self.marker, self.serial)
+
+            try:
+                self.proc.stdin.write('%s\n%s\n' % (' '.join(args),
+                                                     marker))
+                self.proc.stdin.flush()
+                errors = self.read_errors(marker)
+            except (IOError, OSError) as exc:
+                self.stop(kill=True)
+                raise InterfaceDriverError(reason=exc)
+
+        if errors:
+            raise InterfaceDriverError(reason='\n'.join(errors),
+                                       returncode=1,
+                                       stderr='\n'.join(errors))
+
+    def read_errors(self, marker):
+        '''Read stderr up to and including the response to `marker`,
+        returning any error messages seen before it.'''
+
+        deadline = time.time() + self.timeout
+        errors = []
+        while True:
+            line = self.readline(deadline)
+            if '"%s"' % marker in line:
+                # consume the "Command failed" line that follows.
+                self.readline(deadline)
+                return errors
+
+            if not line.startswith('Command failed'):
+                errors.append(line.rstrip())
+
+    def readline(self, deadline):
+        '''Read a line from the stderr of the `ip` process, raising
+        IOError if it exits or if no line arrives before `deadline`.'''
+
+        stderr = self.proc.stderr
+        while '\n' not in self.buffered:
+            timeout = deadline - time.time()
+            if timeout <= 0 or not select.select([stderr], [], [],
+                                                 timeout)[0]:
+                raise IOError('ip batch process did not respond '
+                              'within %s seconds' % self.timeout)
+
+            data = os.read(stderr.fileno(), 4096)
+            if not data:
+                raise IOError('ip batch process exited unexpectedly')
+            self.buffered += data
+
+        line, self.buffered = self.buffered.split('\n', 1)
+        return line
+
+    def close(self):
+        self.stop()
@@ -0,0 +1,187 @@
+import functools
+import logging
+
+import defaults
+import firewall
+import iptables
+from exc import *
+
+LOG = logging.getLogger(__name__)
+
+
+class IPSet (object):
+    '''A thin wrapper around the ipset command for a single set.'''
+
+    def __init__(self, name, type='hash:ip,port', netns=None):
+        self.name = name
+        self.type = type
+
+        prefix = ()
+        if netns is not None:
+            prefix = ('ip', 'netns', 'exec', netns)
+
+        self.ipset = functools.partial(iptables.cmd, *(prefix + ('ipset',)))
+
+    def __str__(self):
+        return '<IPSet %s>' % self.name
+
+    def create(self):
+        '''Create the set if it does not already exist.'''
+        self.ipset('create', self.name, self.type, '-exist')
+
+    def flush(self):
+        self.ipset('flush', self.name)
+
+    def destroy(self):
+        self.ipset('destroy', self.name)
+
+    def entries(self):
+        '''Return the entries in the set, in the form in which they are
+        given to add and del.'''
+
+        entries = []
+        for line in self.ipset('save', self.name).splitlines():
+            args = line.split()
+            if args[:2] == ['add', self.name]:
+                entries.append(args[2])
+
+        return entries
+
+    def render(self, changes):
+        return ''.join('%s %s %s\n' % (action, self.name, entry)
+                       for action, entry in changes)
+
+    def restore(self, changes):
+        '''Apply a list of (action, entry) changes, where action is
+        `add` or `del`, in a single `ipset restore`.  Adding an entry
+        that exists or deleting one that does not is not an error.'''
+
+        if not changes:
+            return
+
+        LOG.debug('committing %d changes to set %s',
+                  len(changes), self.name)
+        self.ipset('-exist', 'restore', input=self.render(changes))
+
+
+class IPSetFirewall (firewall.SetFirewall):
+    '''A firewall driver that keeps the address, protocol and port of
+    every service in a `hash:ip,port` ipset.  A single rule in the
+    `mangle` table marks packets whose destination is in the set, so
+    the kernel does one hash lookup per packet no matter how many
+    services there are, and adding or removing a service is a set
+    update rather than a change to the chain.'''
+
+    def __init__(self,
+                 fwchain=defaults.fwchain,
+                 fwmark=defaults.fwmark,
+                 fwset=defaults.fwset,
+                 table=None,
+                 ipset=None,
+                 reconcile=False):
+
+        super(IPSetFirewall, self).__init__()
+
+        if table is None:
+            table = iptables.mangle
+
+        if ipset is None:
+            ipset = IPSet(fwset)
+
+        self.table = table
+        self.ipset = ipset
+        self.fwchain = fwchain
+        self.fwmark = fwmark
+        self.stale_rules = []
+
+        try:
+            self.ipset.create()
+            self.create_chain()
+
+            if reconcile:
+                self.load_state()
+            else:
+                self.chain.flush()
+                self.ipset.flush()
+                self.chain.append(self.match_rule())
+        except iptables.CommandError as exc:
+            raise FirewallDriverError(reason=exc)
+
+    def cleanup(self):
+        LOG.info('flushing all rules from %s and destroying set %s',
+                 self.fwchain, self.ipset.name)
+        self.entries = {}
+        try:
+            self.chain.flush()
+            self.ipset.destroy()
+        except iptables.CommandError as exc:
+            raise FirewallDriverError(reason=exc)
+
+    def create_chain(self):
+        try:
+            self.chain = self.table.chains[self.fwchain]
+        except KeyError:
+            LOG.info('creating chain %s', self.fwchain)
+            self.chain = self.table.create_chain(self.fwchain)
+
+    def match_rule(self):
+        return iptables.Rule(str(arg) for arg in [
+            '-m', 'set',
+            '--match-set', self.ipset.name, 'dst,dst',
+            '-j', 'MARK', '--set-mark', self.fwmark
+        ])
+
+    def is_match_rule(self, rule):
+        '''Return True if a rule as listed by iptables is our match
+        rule.'''
+
+        args = dict(zip(rule, rule[1:]))
+        try:
+            mark = args.get('--set-xmark', args.get('--set-mark'))
+            return (args['--match-set'] == self.ipset.name and
+                    int(mark.split('/')[0], 0) == int(self.fwmark))
+        except (KeyError, AttributeError, ValueError):
+            return False
+
+    def load_state(self):
+        '''Read the entries already in the set into self.existing so
+        that they can be adopted, and make sure that the chain contains
+        our match rule.  Any other rules in the chain are removed by
+        prune().'''
+
+        self.existing = set(self.ipset.entries())
+
+        found = False
+        for rule in self.chain.rules():
+            if self.is_match_rule(rule) and not found:
+                found = True
+            else:
+                self.stale_rules.append(rule)
+
+        if not found:
+            self.chain.append(self.match_rule())
+
+        LOG.info('found %d existing entries in set %s',
+                 len(self.existing), self.ipset.name)
+
+    def prune(self):
+        '''Delete the entries found by load_state that were not
+        adopted, and any rules other than our match rule.'''
+
+        super(IPSetFirewall, self).prune()
+
+        stale_rules, self.stale_rules = self.stale_rules, []
+        for rule in stale_rules:
+            LOG.info('removing stale rule %s from %s', rule, self.fwchain)
+            try:
+                self.chain.delete(rule)
+            except iptables.CommandError as exc:
+                raise FirewallDriverError(reason=exc)
+
+    def entry_for(self, address, service):
+        return '%s,%s:%s' % (address,
+                             service['protocol'].lower(),
+                             service['port'])
+
+    def commit(self, changes):
+        self.ipset.restore(changes)
@@ -1,10 +1,17 @@
+import collections
 import subprocess
 import six
 import functools
 import shlex
 import logging
+import contextlib
+import re
+import threading
+
+import metrics
 
 LOG = logging.getLogger(__name__)
+re_needs_quoting = re.compile(r'[\s"\']')
 
 
 class CommandError(Exception):
@@ -23,23 +30,36 @@ class CommandError(Exception):
         return repr(self)
 
 
-def cmd(*args):
+def cmd(*args, **kwargs):
     '''This acts very much like subprocess.check_output, except that
     it raises CommandError if a command exits with a non-zero exit code,
     and the CommandError objects include the full command spec, a
-    returncode, stdout, and stderr.'''
+    returncode, stdout, and stderr.
 
-    LOG.debug('running command: %s', ' '.join(args))
-    p = subprocess.Popen(args,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
-    out, err = p.communicate()
+    If the `input` keyword argument is provided, it will be written to
+    the command's stdin.'''
+
+    input = kwargs.pop('input', None)
+    if input is not None:
+        kwargs['stdin'] = subprocess.PIPE
+
+    # commands run in a network namespace are recorded under the
+    # name of the command rather than as `ip`.
+    name = args[4] if args[1:3] == ('netns', 'exec') else args[0]
 
-    if p.returncode != 0:
-        LOG.debug('command failed [%d]: %s...',
-                  p.returncode,
-                  err.splitlines()[0])
-        raise CommandError(args, p.returncode, out, err)
+    LOG.debug('running command: %s', ' '.join(args))
+    with metrics.timed_command(name, args=' '.join(args)):
+        p = subprocess.Popen(args,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE,
+                             **kwargs)
+        out, err = p.communicate(input)
+
+        if p.returncode != 0:
+            LOG.debug('command failed [%d]: %s...',
+                      p.returncode,
+                      err.splitlines()[0])
+            raise CommandError(args, p.returncode, out, err)
 
     return out
 
@@ -55,6 +75,91 @@ class Rule(tuple):
         return ' '.join(self)
 
 
+def quote(arg):
+    '''Quote a single argument for use in iptables-restore input.'''
+
+    if arg and not re_needs_quoting.search(arg):
+        return arg
+
+    return '"%s"' % arg.replace('"', '\\"')
+
+
+class Batch(object):
+    '''A Batch collects modifications to a table and applies them in a
+    single iptables-restore transaction when committed.  Either all of
+    the changes are applied or none of them are.'''
+
+    def __init__(self, table):
+        self.table = table
+        self.commands = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def add(self, *args):
+        self.commands.append(args)
+
+    def render(self):
+        '''Return the batch in the format expected by
+        iptables-restore.'''
+
+        lines = ['*%s' % self.table.name]
+        lines.extend(' '.join(quote(str(arg)) for arg in args)
+                     for args in self.commands)
+        lines.append('COMMIT')
+        return '\n'.join(lines) + '\n'
+
+    def commit(self):
+        if not self.commands:
+            return
+
+        LOG.debug('committing %d changes to table %s',
+                  len(self.commands), self.table.name)
+        self.table.iptables_restore('--noflush', input=self.render())
+        self.table.changed(self.commands)
+
+
+def parse_save(text):
+    '''Parse the output of iptables-save for a single table into an
+    ordered dictionary that maps chain names to a dictionary with the
+    chain's `policy` (None for user-defined chains) and its list of
+    `rules`.'''
+
+    chains = collections.OrderedDict()
+    for line in text.splitlines():
+        if line.startswith(':'):
+            name, policy = line[1:].split()[:2]
+            chains[name] = {
+                'policy': None if policy == '-' else policy,
+                'rules': [],
+            }
+        elif line.startswith('-A '):
+            rule = Rule(line)
+            chains[rule[1]]['rules'].append(Rule(rule[2:]))
+
+    return chains
+
+
+def parse_counters(text):
+    '''Parse the output of `iptables-save -c` for a single table into
+    an ordered dictionary that maps chain names to lists of (packets,
+    bytes, rule) tuples, in the order in which the rules appear.'''
+
+    chains = collections.OrderedDict()
+    for line in text.splitlines():
+        if line.startswith(':'):
+            chains[line[1:].split()[0]] = []
+        elif line.startswith('['):
+            counters, line = line.split(None, 1)
+            packets, nbytes = counters[1:-1].split(':')
+            rule = Rule(line)
+            if rule[0] == '-A':
+                chains[rule[1]].append((int(packets), int(nbytes),
+                                        Rule(rule[2:])))
+
+    return chains
+
+
 class Chain(object):
     def __init__(self, name, table):
         self.name = name
@@ -63,7 +168,7 @@ class Chain(object):
 
     def __str__(self):
         return '<Chain %s:%s>' % (
-            self.table.table,
+            self.table.name,
             self.name)
 
     def __repr__(self):
@@ -103,30 +208,56 @@ class Chain(object):
     @policy.setter
     def policy(self, value):
         '''Set the default policy for this chain.'''
-        self.iptables('-P', self.name, value)
+        self.table.modify('-P', self.name, value)
 
     def append(self, rule):
-        self.iptables('-A', self.name, *rule)
+        self.table.modify('-A', self.name, *rule)
 
     def insert(self, rule, pos=1):
-        self.iptables('-I', self.name, str(pos), *rule)
+        self.table.modify('-I', self.name, str(pos), *rule)
 
     def replace(self, pos, rule):
-        self.iptables('-R', self.name, str(pos), *rule)
+        self.table.modify('-R', self.name, str(pos), *rule)
 
     def zero(self):
-        self.iptables('-Z', self.name)
+        self.table.modify('-Z', self.name)
 
     def delete(self, rule=None, pos=None):
         if rule is not None:
-            self.iptables('-D', self.name, *rule)
+            self.table.modify('-D', self.name, *rule)
         elif pos is not None:
-            self.iptables('-D', self.name, str(pos))
+            self.table.modify('-D', self.name, str(pos))
         else:
             raise ValueError('requires either rule or position')
 
     def flush(self):
-        self.iptables('-F', self.name)
+        self.table.modify('-F', self.name)
+
+
+class CachedChain(Chain):
+    '''A Chain that reads its rules and policy from the snapshot held
+    by a CachedTable.'''
+
+    def rules(self):
+        return iter(self.table.cached_chain(self.name)['rules'])
+
+    def rule_exists(self, rule):
+        '''Return True if the rule is present in the cached snapshot.
+        Because iptables-save normalizes rules, the rule must be given
+        in the same form that iptables-save produces.'''
+        return Rule(rule) in self.table.cached_chain(self.name)['rules']
+
+    @property
+    def policy(self):
+        policy = self.table.cached_chain(self.name)['policy']
+        if policy is None:
+            raise ValueError('chain does not have default policy')
+
+        return policy
+
+    @policy.setter
+    def policy(self, value):
+        self.table.modify('-P', self.name, value)
 
 
 class ChainFinder(object):
@@ -153,10 +284,16 @@ class Table(object):
         if netns is not None:
             prefix = ('ip', 'netns', 'exec', netns)
 
+        self.prefix = prefix
         self.iptables = functools.partial(
             cmd, *(prefix + ('iptables', '-w', '-t', name)))
+        self.iptables_restore = functools.partial(
+            cmd, *(prefix + ('iptables-restore', '-w')))
+        self.iptables_save = functools.partial(
+            cmd, *(prefix + ('iptables-save', '-t', name)))
 
         self.chains = ChainFinder(self)
+        self.local = threading.local()
 
     def __str__(self):
         return '<Table %s>' % (self.name,)
@@ -164,6 +301,49 @@ class Table(object):
     def __repr__(self):
         return str(self)
 
+    @property
+    def current_batch(self):
+        return getattr(self.local, 'batch', None)
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''Collect all modifications made to this table inside the
+        context and commit them in a single iptables-restore
+        invocation when the context exits.  Nothing is committed if
+        the context exits with an exception.  Nested calls join the
+        outermost batch.
+
+        Note that reads inside the context see the state of the
+        kernel, not the pending changes.'''
+
+        if self.current_batch is not None:
+            yield self.current_batch
+            return
+
+        batch = self.local.batch = Batch(self)
+        try:
+            yield batch
+        finally:
+            self.local.batch = None
+
+        batch.commit()
+
+    def modify(self, *args):
+        '''Run an iptables command that modifies this table, or record
+        it in the current batch if there is one.'''
+
+        batch = self.current_batch
+        if batch is not None:
+            batch.add(*args)
+        else:
+            self.iptables(*args)
+            self.changed([args])
+
+    def changed(self, commands):
+        '''Called after the given list of commands has been
+        successfully applied to this table.'''
+        pass
+
     def chain_exists(self, chain):
         try:
             self.iptables('-S', chain)
@@ -185,26 +365,122 @@ class Table(object):
         return Chain(chain, self)
 
     def create_chain(self, chain):
-        self.iptables('-N', chain)
-        return self.chains[chain]
+        self.modify('-N', chain)
+        return Chain(chain, self)
 
     def delete_chain(self, chain):
-        self.iptables('-X', chain)
+        self.modify('-X', chain)
 
     def flush_chain(self, chain):
-        self.iptables('-F', chain)
+        self.modify('-F', chain)
 
     def flush_all(self):
-        self.iptables('-F')
+        self.modify('-F')
 
     def zero_all(self):
-        self.iptables('-Z')
+        self.modify('-Z')
 
     def rule_exists(self, chain, rule):
-        chain = self.chain[chain]
+        chain = self.chains[chain]
         return chain.rule_exists(rule)
 
 
+class CachedTable(Table):
+    '''A Table that answers read queries (chain_exists, list_chains,
+    and the rules and policy of its chains) from a single parsed
+    iptables-save dump rather than running iptables for every query.
+
+    Changes made through this object update or invalidate the
+    snapshot; changes made by anything else will only be seen after
+    an explicit call to refresh().'''
+
+    def __init__(self, name='filter', netns=None):
+        super(CachedTable, self).__init__(name=name, netns=netns)
+
+        self.snapshot = None
+        self.lock = threading.RLock()
+
+    def refresh(self):
+        '''Discard the current snapshot and read a new one.'''
+        with self.lock:
+            self.snapshot = parse_save(self.iptables_save())
+            return self.snapshot
+
+    def invalidate(self):
+        '''Discard the current snapshot.  A new one will be read the
+        next time it is needed.'''
+        with self.lock:
+            self.snapshot = None
+
+    def cached(self):
+        '''Return the current snapshot, reading a new one if there
+        is no snapshot or if the rules for any chain are stale.'''
+        with self.lock:
+            if self.snapshot is None or any(
+                    chain['rules'] is None
+                    for chain in self.snapshot.values()):
+                return self.refresh()
+
+            return self.snapshot
+
+    def cached_chain(self, chain):
+        return self.cached()[chain]
+
+    def changed(self, commands):
+        with self.lock:
+            if self.snapshot is None:
+                return
+
+            for args in commands:
+                op, chain = args[0], (args[1] if len(args) > 1 else None)
+
+                if op == '-N':
+                    self.snapshot[chain] = {'policy': None, 'rules': []}
+                elif chain is None and op in ('-F', '-X'):
+                    # flushing or deleting every chain is rare enough
+                    # that we simply read a fresh snapshot.
+                    self.snapshot = None
+                    return
+                elif chain not in self.snapshot:
+                    self.snapshot = None
+                    return
+                elif op == '-X':
+                    del self.snapshot[chain]
+                elif op == '-F':
+                    self.snapshot[chain]['rules'] = []
+                elif op == '-P':
+                    self.snapshot[chain]['policy'] = args[2]
+                elif op in ('-A', '-I', '-D', '-R'):
+                    # iptables-save normalizes rules, so rather than
+                    # guessing at the canonical form we mark the
+                    # chain's rules as stale.
+                    self.snapshot[chain]['rules'] = None
+
+    def chain_exists(self, chain):
+        with self.lock:
+            if self.snapshot is None:
+                self.refresh()
+
+            return chain in self.snapshot
+
+    def list_chains(self):
+        with self.lock:
+            if self.snapshot is None:
+                self.refresh()
+
+            return iter(list(self.snapshot))
+
+    def get_chain(self, chain):
+        if not self.chain_exists(chain):
+            raise KeyError(chain)
+
+        return CachedChain(chain, self)
+
+    def create_chain(self, chain):
+        self.modify('-N', chain)
+        return CachedChain(chain, self)
+
+
 filter = Table('filter')
 nat = Table('nat')
 mangle = Table('mangle')
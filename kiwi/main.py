@@ -1,14 +1,22 @@
 #!/usr/bin/python
 
 import os
-import sys
 import argparse
 import logging
+import signal
 
+import client
 import manager
 import defaults
 import interface
 import firewall
+import iptables
+import ipset
+import metrics
+import netlink
+import optimizer
+import nftables
+import tracing
 
 LOG = logging.getLogger(__name__)
 
@@ -23,6 +31,31 @@ def parse_args():
     p.add_argument('--reconnect-interval',
                    default=defaults.reconnect_interval,
                    type=int)
+    p.add_argument('--refresh-workers',
+                   default=defaults.refresh_workers,
+                   type=int)
+    p.add_argument('--refresh-deadline',
+                   type=float)
+    p.add_argument('--heartbeat-mode',
+                   choices=['scheduler', 'pass'],
+                   default=defaults.heartbeat_mode)
+    p.add_argument('--no-list-watch',
+                   action='store_false',
+                   dest='list_watch')
+    p.add_argument('--ownership-mode',
+                   choices=['address', 'agent'],
+                   default=defaults.ownership_mode)
+    p.add_argument('--batch-size',
+                   default=defaults.batch_size,
+                   type=int)
+    p.add_argument('--reconcile',
+                   action='store_true')
+    p.add_argument('--state-file')
+    p.add_argument('--keep-claims',
+                   action='store_true')
+    p.add_argument('--coalesce-window',
+                   default=defaults.coalesce_window,
+                   type=float)
 
     g = p.add_argument_group('API endpoints')
     g.add_argument('--kube-endpoint', '-k',
@@ -31,19 +64,58 @@ def parse_args():
                    default=defaults.etcd_endpoint)
     g.add_argument('--etcd-prefix', '-p',
                    default=defaults.etcd_prefix)
+    g.add_argument('--http-pool-size',
+                   type=int)
+    g.add_argument('--connect-timeout',
+                   default=defaults.connect_timeout,
+                   type=float)
+    g.add_argument('--read-timeout',
+                   default=defaults.read_timeout,
+                   type=float)
+    g.add_argument('--http-retries',
+                   default=defaults.http_retries,
+                   type=int)
+    g.add_argument('--stream-read-size',
+                   default=defaults.stream_read_size,
+                   type=int)
 
     g = p.add_argument_group('Network options')
     g.add_argument('--interface', '-i',
                    default=defaults.interface)
+    g.add_argument('--iface-driver',
+                   choices=['ip', 'batch', 'netlink'],
+                   default='ip')
+    g.add_argument('--fw-driver',
+                   choices=['iptables', 'ipset', 'nftables'],
+                   default='iptables')
     g.add_argument('--fwchain',
                    default=defaults.fwchain)
     g.add_argument('--fwmark',
                    type=int,
                    default=defaults.fwmark)
+    g.add_argument('--fw-layout',
+                   choices=['flat', 'address', 'bucket'],
+                   default=defaults.fw_layout)
+    g.add_argument('--fw-multiport',
+                   action='store_true')
+    g.add_argument('--fw-reorder',
+                   action='store_true')
+    g.add_argument('--fw-reorder-interval',
+                   default=defaults.reorder_interval,
+                   type=float)
+    g.add_argument('--fw-reorder-hysteresis',
+                   default=defaults.reorder_hysteresis,
+                   type=float)
+    g.add_argument('--fwset',
+                   default=defaults.fwset)
+    g.add_argument('--nft-table',
+                   default=defaults.nft_table)
     g.add_argument('--cidr-range', '-r',
                    action='append')
     g.add_argument('--no-driver', '-n',
                    action='store_true')
+    g.add_argument('--iptables-cache',
+                   action='store_true')
 
     g = p.add_argument_group('Logging options')
     g.add_argument('--verbose', '-v',
@@ -56,10 +128,36 @@ def parse_args():
                    dest='loglevel')
     g.add_argument('--debug-requests',
                    action='store_true')
+    g.add_argument('--metrics-port',
+                   type=int)
+    g.add_argument('--metrics-address',
+                   default=defaults.metrics_address)
+    g.add_argument('--trace-buffer',
+                   default=defaults.trace_buffer,
+                   type=int)
+    g.add_argument('--trace-file')
 
     p.set_defaults(loglevel=logging.WARN)
 
-    return p.parse_args()
+    args = p.parse_args()
+    if args.fw_driver != 'iptables':
+        for flag, value in [('--fw-layout', args.fw_layout != 'flat'),
+                            ('--fw-multiport', args.fw_multiport),
+                            ('--fw-reorder', args.fw_reorder)]:
+            if value:
+                p.error('%s cannot be used with --fw-driver=%s' % (
+                    flag, args.fw_driver))
+
+    # every refresh worker, each of the (up to three) watchers and the
+    # main loop may be using a connection to etcd at the same time.
+    pool_size = args.refresh_workers + 4
+    if args.http_pool_size is None:
+        args.http_pool_size = pool_size
+    elif args.http_pool_size < pool_size:
+        p.error('--http-pool-size must be at least %d with '
+                '--refresh-workers=%d' % (pool_size, args.refresh_workers))
+
+    return args
 
 
 def main():
@@ -76,13 +174,60 @@ def main():
     LOG.info('Etcd is %s', args.etcd_endpoint)
     LOG.info('Managing interface %s', args.interface)
 
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port, address=args.metrics_address)
+
+    if args.trace_buffer > 0:
+        tracing.enable(args.trace_buffer, args.trace_file)
+        signal.signal(signal.SIGUSR1,
+                      lambda signum, frame: tracing.request_dump())
+
     if args.no_driver:
         iface_driver = None
         fw_driver = None
     else:
-        iface_driver = interface.Interface(args.interface)
-        fw_driver = firewall.Firewall(fwchain=args.fwchain,
-                                      fwmark=args.fwmark)
+        if args.iface_driver == 'netlink':
+            iface_driver = netlink.NetlinkInterface(
+                args.interface, reconcile=args.reconcile)
+        elif args.iface_driver == 'batch':
+            iface_driver = interface.BatchInterface(
+                args.interface, reconcile=args.reconcile)
+        else:
+            iface_driver = interface.Interface(
+                args.interface, reconcile=args.reconcile)
+        table = (iptables.CachedTable('mangle') if args.iptables_cache
+                 else iptables.mangle)
+        if args.fw_driver == 'nftables':
+            fw_driver = nftables.NftFirewall(
+                fwmark=args.fwmark,
+                fwset=args.fwset,
+                nft=nftables.Nft(args.nft_table),
+                reconcile=args.reconcile)
+        elif args.fw_driver == 'ipset':
+            fw_driver = ipset.IPSetFirewall(fwchain=args.fwchain,
+                                            fwmark=args.fwmark,
+                                            fwset=args.fwset,
+                                            table=table,
+                                            reconcile=args.reconcile)
+        else:
+            fw_driver = firewall.Firewall(fwchain=args.fwchain,
+                                          fwmark=args.fwmark,
+                                          table=table,
+                                          reconcile=args.reconcile,
+                                          layout=args.fw_layout,
+                                          multiport=args.fw_multiport,
+                                          reorder=args.fw_reorder)
+            if args.fw_reorder:
+                fw_driver.optimizer = optimizer.Optimizer(
+                    fw_driver,
+                    interval=args.fw_reorder_interval,
+                    hysteresis=args.fw_reorder_hysteresis)
+                fw_driver.optimizer.start()
+
+    http_client = client.Client(pool_size=args.http_pool_size,
+                                connect_timeout=args.connect_timeout,
+                                read_timeout=args.read_timeout,
+                                retries=args.http_retries)
 
     mgr = manager.Manager(etcd_endpoint=args.etcd_endpoint,
                           kube_endpoint=args.kube_endpoint,
@@ -91,9 +236,22 @@ def main():
                           fw_driver=fw_driver,
                           cidr_ranges=args.cidr_range,
                           refresh_interval=args.refresh_interval,
+                          batch_size=args.batch_size,
+                          coalesce_window=args.coalesce_window,
+                          reconcile=args.reconcile,
+                          state_file=args.state_file,
+                          keep_claims=args.keep_claims,
+                          client=http_client,
+                          refresh_workers=args.refresh_workers,
+                          refresh_deadline=args.refresh_deadline,
+                          heartbeat_mode=args.heartbeat_mode,
+                          ownership_mode=args.ownership_mode,
+                          list_watch=args.list_watch,
+                          stream_read_size=args.stream_read_size,
                           id=args.agent_id)
 
     LOG.info('My id is: %s', mgr.id)
+    signal.signal(signal.SIGTERM, lambda signum, frame: mgr.stop())
     mgr.run()
 
 if __name__ == '__main__':
@@ -1,14 +1,27 @@
+import contextlib
+import errno
+import json
+import os
 import requests
+import tempfile
 import uuid
 import time
 import logging
+import multiprocessing
+import multiprocessing.pool
 import netaddr
 import threading
 import Queue
 
 from exc import *
+import client as kiwiclient
 import defaults
 import addresswatcher
+import coalesce
+import metrics
+import tracing
+import netindex
+import scheduler
 import servicewatcher
 
 
@@ -24,15 +37,76 @@ class Manager (object):
                  iface_driver=None,
                  fw_driver=None,
                  cidr_ranges=None,
-                 refresh_interval=defaults.refresh_interval):
+                 refresh_interval=defaults.refresh_interval,
+                 batch_size=defaults.batch_size,
+                 client=None,
+                 refresh_workers=defaults.refresh_workers,
+                 refresh_deadline=None,
+                 heartbeat_mode=defaults.heartbeat_mode,
+                 ownership_mode=defaults.ownership_mode,
+                 list_watch=True,
+                 stream_read_size=defaults.stream_read_size,
+                 coalesce_window=defaults.coalesce_window,
+                 reconcile=False,
+                 state_file=None,
+                 keep_claims=False):
 
         super(Manager, self).__init__()
 
         if id is None:
             id = str(uuid.uuid1())
 
+        if client is None:
+            client = kiwiclient.Client()
+
         self.id = id
         self.refresh_interval = refresh_interval
+        self.batch_size = batch_size
+        self.coalesce_window = coalesce_window
+        self.reconcile = reconcile
+        self.state_file = state_file
+        self.keep_claims = keep_claims
+        self.resource_version = None
+        self.client = client
+        self.refresh_workers = refresh_workers
+        self.refresh_deadline = refresh_deadline or refresh_interval
+        self.refresh_pool = None
+        self.heartbeats = {}
+
+        # held by heartbeat threads while they refresh an address on
+        # the interface, and by release_address while it gives up the
+        # claim, so that a released address is never added back.
+        self.claim_lock = threading.Lock()
+
+        # the time at which our agent liveness key was last renewed.
+        self.agent_renewed = 0
+        self.refresh_stats = {}
+
+        # In 'address' ownership mode every claimed address key has its
+        # own TTL and is renewed individually.  In 'agent' mode address
+        # keys have no TTL; instead we renew a single agent liveness
+        # key, and other agents take over our addresses when it
+        # expires.
+        self.ownership_mode = ownership_mode
+        self.list_watch = list_watch
+        self.stream_read_size = stream_read_size
+
+        # In 'scheduler' mode heartbeats are sent from a dedicated
+        # thread, independent of the event queue.  In 'pass' mode they
+        # are sent by refresh() from the main loop.
+        self.scheduler = None
+        if heartbeat_mode == 'scheduler' and ownership_mode == 'agent':
+            self.scheduler = scheduler.Scheduler(
+                refresh_interval,
+                self.heartbeat_agent,
+                on_failure=self.agent_heartbeat_failed,
+                workers=1)
+        elif heartbeat_mode == 'scheduler':
+            self.scheduler = scheduler.Scheduler(
+                refresh_interval,
+                self.heartbeat,
+                on_failure=self.heartbeat_failed,
+                workers=refresh_workers)
 
         self.etcd_endpoint = etcd_endpoint
         self.etcd_prefix = etcd_prefix
@@ -40,14 +114,28 @@ class Manager (object):
         self.iface_driver = iface_driver
         self.fw_driver = fw_driver
         self.cidr_ranges = cidr_ranges
+        self.cidr_index = None
 
-        if self.cidr_ranges:
+        if self.cidr_ranges is not None:
             self.cidr_ranges = [netaddr.IPNetwork(n)
                                 for n in cidr_ranges]
+            self.cidr_index = netindex.NetworkIndex(self.cidr_ranges)
 
         self.addresses = {}
+        self.services = {}
+
+        # addresses that etcd says we owned before we started, which
+        # we renew rather than claim again.
+        self.reclaim = set()
+
+        self.service_watcher = servicewatcher.ServiceWatcher(
+            kube_endpoint=self.kube_endpoint,
+            client=self.client,
+            list_watch=self.list_watch,
+            read_size=self.stream_read_size)
 
         self.q = Queue.Queue()
+        self.stopping = False
 
     def run(self):
         try:
@@ -55,111 +143,582 @@ class Manager (object):
         finally:
             self.cleanup()
 
+    def stop(self):
+        '''Ask the main loop to exit, after which run() cleans up.  This
+        only sets a flag, so it is safe to call from a signal
+        handler.'''
+
+        self.stopping = True
+
     def watch_addresses(self):
         '''Read address events and stuff them into the queue.'''
         watcher = addresswatcher.AddressWatcher(
             etcd_endpoint=self.etcd_endpoint,
-            etcd_prefix=self.etcd_prefix)
+            etcd_prefix=self.etcd_prefix,
+            client=self.client)
 
         for event in watcher:
             self.q.put(event)
 
-    def watch_services(self):
-        '''Read service events and stuff them into the queue.'''
-        watcher = servicewatcher.ServiceWatcher(
-            kube_endpoint=self.kube_endpoint)
+    def watch_agents(self):
+        '''Read agent events and stuff them into the queue.'''
+        watcher = addresswatcher.AgentWatcher(
+            etcd_endpoint=self.etcd_endpoint,
+            etcd_prefix=self.etcd_prefix,
+            client=self.client)
 
         for event in watcher:
+            self.q.put(event)
+
+    def watch_services(self):
+        '''Read service events and stuff them into the queue.'''
+        for event in self.service_watcher:
             LOG.debug('event:', event)
             self.q.put(event)
 
     def mainloop(self):
         last_refresh = 0
 
+        if self.ownership_mode == 'agent':
+            self.register_agent()
+
+        self.register_metrics()
+
+        restored = self.state_file is not None and self.load_state()
+        if self.reconcile:
+            self.reconcile_state(relist=not restored)
+
         # start worker threads to feed the event queue
-        [thread.start() for thread in [
-            threading.Thread(target=self.watch_services),
-            threading.Thread(target=self.watch_addresses),
-        ]]
+        watchers = [self.watch_services, self.watch_addresses]
+        if self.ownership_mode == 'agent':
+            watchers.append(self.watch_agents)
 
-        while True:
-            try:
-                msg = self.q.get(True, self.refresh_interval)
-                LOG.debug('dequeued message %s for %s',
-                          msg['message'],
-                          msg['target'])
+        for watcher in watchers:
+            thread = threading.Thread(target=watcher)
+            thread.daemon = True
+            thread.start()
 
-                self.handle_message(msg)
-            except AttributeError:
-                LOG.debug('unhandled message %s for %s',
-                          msg['message'],
-                          msg['target'])
+        if self.scheduler is not None:
+            self.scheduler.start()
+            if self.ownership_mode == 'agent':
+                self.scheduler.add(self.id, delay=self.refresh_interval)
+
+        while not self.stopping:
+            try:
+                # wake up at least once a second to notice stop() and
+                # requests for a trace dump.
+                msgs = self.get_messages(min(self.refresh_interval, 1))
+                if self.coalesce_window:
+                    folded = coalesce.coalesce(msgs)
+                    LOG.debug('coalesced %d messages into %d',
+                              len(msgs), len(folded))
+                    self.handle_messages(folded)
+                else:
+                    self.handle_messages(msgs)
+
+                for msg in msgs:
+                    if 'service' in msg:
+                        self.resource_version = msg['service'].get(
+                            'resourceVersion', self.resource_version)
+
+                if self.state_file:
+                    self.save_state()
             except Queue.Empty:
                 LOG.debug('Punt!')
                 pass
 
+            if self.stopping:
+                break
+
+            tracing.dump_if_requested()
+
             now = time.time()
-            if now > last_refresh + self.refresh_interval:
-                self.refresh()
+            if (self.scheduler is None and
+                    now > last_refresh + self.refresh_interval):
+                with tracing.span('refresh') as span:
+                    self.refresh()
+                    span.set(**self.refresh_stats)
                 last_refresh = now
 
+        LOG.warn('stopping')
+
+    def register_metrics(self):
+        metrics.queue_depth.set_function(self.q.qsize)
+        metrics.addresses.set_function(lambda: len(self.addresses),
+                                       state='known')
+        metrics.addresses.set_function(
+            lambda: len(self.claimed_addresses()),
+            state='claimed')
+
+    def reconcile_state(self, relist=True):
+        '''Build our desired state from a list of all services and the
+        claims we hold in etcd, then remove only the firewall rules,
+        addresses and claims left behind by a previous instance that
+        are no longer wanted.  Everything else is adopted as it is.
+
+        If relist is False our state has already been restored from
+        the state file, and we only remove what is left over.  If we
+        cannot read the services or our claims we do not know what is
+        wanted, so nothing is removed; whatever the services turn out
+        to need is still adopted as it arrives.'''
+
+        if relist:
+            LOG.info('reconciling existing state')
+            if not self.read_state():
+                LOG.warn('not removing existing rules, addresses or '
+                         'claims without a list of services')
+                return
+
+        self.release_stale_claims()
+
+        with self.fw_batch():
+            if self.fw_driver:
+                try:
+                    self.fw_driver.prune()
+                except FirewallDriverError as exc:
+                    LOG.error('failed to configure host firewall: %s',
+                              exc.reason)
+
+        if self.iface_driver:
+            try:
+                self.iface_driver.prune()
+            except InterfaceDriverError as exc:
+                LOG.error('failed to remove address on system: %s',
+                          exc.reason)
+
+    def read_state(self):
+        '''Handle every service from a new list of services, renewing
+        rather than claiming any addresses that we already own in
+        etcd.  Returns False if either could not be read.'''
+
+        try:
+            index, nodes = addresswatcher.snapshot(self.url_for(),
+                                                   self.client)
+            events = self.service_watcher.relist()
+        except (requests.RequestException, ValueError) as exc:
+            LOG.error('failed to read initial state: %s', exc)
+            return False
+
+        self.reclaim = set(
+            node['key'].split('/')[-1]
+            for node in nodes.values()
+            if node.get('value') == self.id)
+
+        # relist() returns an event for every service, because the
+        # watcher has not seen any yet.
+        self.handle_messages([self.service_watcher.handle_added(
+            event['object']) for event in events])
+        self.resource_version = self.service_watcher.resource_version
+        return True
+
+    def release_stale_claims(self):
+        '''Delete the claims we held before we started that no service
+        wants any more.'''
+
+        for address in self.reclaim:
+            LOG.info('releasing stale claim on %s', address)
+            self.delete_claim(address)
+
+        self.reclaim = set()
+
+    def load_state(self):
+        '''Restore the services and claims saved by save_state(),
+        renewing our claims in etcd and resuming the service watch
+        from where the previous instance left off.  Returns True if
+        the state was restored.'''
+
+        try:
+            with open(self.state_file) as fd:
+                state = json.load(fd)
+        except IOError as exc:
+            if exc.errno != errno.ENOENT:
+                LOG.error('failed to read state from %s: %s',
+                          self.state_file, exc)
+            return False
+        except ValueError as exc:
+            LOG.error('ignoring invalid state in %s: %s',
+                      self.state_file, exc)
+            return False
+
+        if state.get('version') != 1 or state.get('id') != self.id:
+            LOG.warn('ignoring state in %s for agent %s',
+                     self.state_file, state.get('id'))
+            return False
+
+        services = state['services']
+        LOG.info('restoring %d services and %d claims from %s',
+                 len(services), len(state['claimed']), self.state_file)
+
+        self.reclaim.update(state['claimed'])
+        self.service_watcher.services = dict(services)
+        self.service_watcher.resource_version = state['resourceVersion']
+        self.resource_version = state['resourceVersion']
+
+        with self.fw_batch():
+            for id, service in services.items():
+                self.update_service(id, service)
+
+        self.release_stale_claims()
+        return True
+
+    def save_state(self):
+        '''Atomically replace the state file with our current services
+        and claims.'''
+
+        state = {
+            'version': 1,
+            'id': self.id,
+            'resourceVersion': self.resource_version,
+            'services': self.services,
+            'claimed': self.claimed_addresses(),
+        }
+
+        dirname = os.path.dirname(os.path.abspath(self.state_file))
+        fd, path = tempfile.mkstemp(dir=dirname, prefix='.kiwi-state')
+        try:
+            with os.fdopen(fd, 'w') as out:
+                json.dump(state, out, separators=(',', ':'))
+                out.flush()
+                os.fsync(out.fileno())
+
+            os.rename(path, self.state_file)
+
+            # make the rename itself durable.
+            dirfd = os.open(dirname, os.O_RDONLY)
+            try:
+                os.fsync(dirfd)
+            finally:
+                os.close(dirfd)
+        except (IOError, OSError) as exc:
+            LOG.error('failed to write state to %s: %s',
+                      self.state_file, exc)
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def get_messages(self, timeout):
+        '''Wait up to `timeout` seconds for a message, then collect any
+        other messages that are already waiting in the queue (up to
+        self.batch_size in total) so that they can be handled as a
+        single batch.  If self.coalesce_window is set, keep collecting
+        messages for that many seconds after the first one arrives.'''
+
+        msgs = [self.q.get(True, timeout)]
+        deadline = time.time() + self.coalesce_window
+        while len(msgs) < self.batch_size:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    msgs.append(self.q.get(True, remaining))
+                else:
+                    msgs.append(self.q.get_nowait())
+            except Queue.Empty:
+                break
+
+        return msgs
+
+    @contextlib.contextmanager
+    def fw_batch(self):
+        '''Group the firewall changes made inside this context into a
+        single commit, if the firewall driver supports it.'''
+
+        if self.fw_driver and hasattr(self.fw_driver, 'batch'):
+            try:
+                with self.fw_driver.batch():
+                    yield
+            except FirewallDriverError as exc:
+                LOG.error('failed to configure host firewall: %s',
+                          exc.reason)
+        else:
+            yield
+
+    def handle_messages(self, msgs):
+        with self.fw_batch():
+            for msg in msgs:
+                LOG.debug('dequeued message %s for %s',
+                          msg['message'],
+                          msg['target'])
+
+                try:
+                    self.handle_message(msg)
+                except AttributeError:
+                    LOG.debug('unhandled message %s for %s',
+                              msg['message'],
+                              msg['target'])
+
     def handle_message(self, msg):
         attr = 'handle_%s' % msg['message'].replace('-', '_')
         LOG.debug('looking for %s', attr)
         handler = getattr(self, attr)
 
-        handler(msg)
+        with tracing.span('handle', message=msg['message'],
+                          target=msg['target']), \
+                metrics.handler_seconds.time(message=msg['message']):
+            handler(msg)
 
     def refresh(self):
+        '''Send heartbeats for all claimed addresses using a pool of
+        worker threads, waiting at most self.refresh_deadline seconds
+        for them to complete.  Heartbeats that miss the deadline are
+        left running and collected on the next pass; only addresses
+        whose heartbeat actually failed are released.'''
+
+        if self.ownership_mode == 'agent':
+            try:
+                self.heartbeat_agent()
+            except Exception as exc:
+                LOG.error('failed to refresh agent %s: %s', self.id, exc)
+            return
+
         LOG.info('start refresh pass (%d addresses)',
                  len(self.addresses))
 
+        if self.refresh_pool is None:
+            self.refresh_pool = multiprocessing.pool.ThreadPool(
+                self.refresh_workers)
+
+        start = time.time()
+        deadline = start + self.refresh_deadline
+
         claimed = 0
         for address in self.addresses.keys():
-            if self.address_is_claimed(address):
-                claimed += 1
-                self.refresh_address(address)
+            if not self.address_is_claimed(address):
+                continue
+
+            claimed += 1
+            if address in self.heartbeats:
+                # a heartbeat from an earlier pass is still running.
+                continue
+
+            self.heartbeats[address] = self.refresh_pool.apply_async(
+                self.heartbeat, (address,))
+
+        failed = []
+        missed = 0
+        for address, result in self.heartbeats.items():
+            try:
+                result.get(max(0, deadline - time.time()))
+            except multiprocessing.TimeoutError:
+                missed += 1
+                continue
+            except Exception as exc:
+                LOG.error('failed to refresh address %s: %s',
+                          address, exc)
+                failed.append(address)
+
+            del self.heartbeats[address]
+
+        for address in failed:
+            self.release_address(address)
 
-        LOG.info('finished refresh pass (%d addresses, %d claimed)',
+        self.refresh_stats = {
+            'duration': time.time() - start,
+            'claimed': claimed,
+            'failed': len(failed),
+            'missed': missed,
+        }
+
+        metrics.refresh_seconds.observe(self.refresh_stats['duration'])
+
+        LOG.info('finished refresh pass (%d addresses, %d claimed, '
+                 '%d failed, %d missed deadline) in %.3f seconds',
                  len(self.addresses),
-                 claimed)
+                 claimed,
+                 len(failed),
+                 missed,
+                 self.refresh_stats['duration'])
+        if missed:
+            LOG.warn('%d heartbeats missed the refresh deadline', missed)
+
+    def etcd(self, operation, method, url, **kwargs):
+        '''Make an etcd request, recording its round trip time and
+        whether it failed under the given operation name.'''
+
+        with tracing.span('etcd', operation=operation,
+                          method=method, url=url) as span, \
+                metrics.etcd_seconds.time(operation=operation):
+            try:
+                r = self.client.request(method, url, **kwargs)
+            except requests.RequestException:
+                metrics.etcd_failures.inc(operation=operation)
+                raise
+
+            span.set(status=r.status_code)
 
-    def url_for(self, address):
+        if not r.ok:
+            metrics.etcd_failures.inc(operation=operation)
+
+        return r
+
+    def url_for(self, address=''):
         return '%s/v2/keys%s/publicips/%s' % (
             self.etcd_endpoint,
             self.etcd_prefix,
             address)
 
+    def agent_url(self, agent):
+        return '%s/v2/keys%s/agents/%s' % (
+            self.etcd_endpoint,
+            self.etcd_prefix,
+            agent)
+
+    def claim_params(self, **params):
+        '''Return the parameters for a PUT that claims an address.  In
+        agent ownership mode address keys do not have a TTL.'''
+
+        if self.ownership_mode == 'address':
+            params['ttl'] = self.refresh_interval * 2
+
+        return params
+
+    def claimed_addresses(self):
+        return [address for address, info in self.addresses.items()
+                if info['claimed']]
+
     def refresh_address(self, address):
         assert address in self.addresses
         assert self.addresses[address]['claimed']
 
-        LOG.info('refresh %s', address)
         try:
-            r = requests.put(self.url_for(address),
-                             params={'prevValue': self.id,
-                                     'ttl': self.refresh_interval * 2},
-                             data={'value': self.id})
+            self.heartbeat(address)
+        except Exception as exc:
+            LOG.error('failed to refresh address %s: %s',
+                      address, exc)
+            self.release_address(address)
+
+    def heartbeat(self, address):
+        '''Renew our claim on an address in etcd and refresh its
+        lifetime on the interface.  Raises an exception on failure.
+        This may be called from a worker thread, so it must not modify
+        any Manager state.'''
+
+        LOG.info('refresh %s', address)
+        with metrics.heartbeat_seconds.time(kind='address'):
+            r = self.etcd('refresh', 'PUT', self.url_for(address),
+                          params={'prevValue': self.id,
+                                  'ttl': self.refresh_interval * 2},
+                          data={'value': self.id})
             r.raise_for_status()
 
+            # the address may have been released while we were waiting
+            # for etcd.
             if self.iface_driver:
+                self.refresh_lifetime(address)
+
+    def refresh_lifetime(self, address):
+        '''Refresh the lifetime of an address on the interface if it is
+        still claimed.  The check and the refresh are made under
+        self.claim_lock, so that once release_address has given up the
+        claim no heartbeat can add the address back.'''
+
+        with self.claim_lock:
+            if self.address_is_claimed(address):
                 self.iface_driver.refresh_address(
                     address,
                     lft=self.refresh_interval*2)
+
+    def register_agent(self):
+        '''Renew our agent liveness key.  Returns True on success.'''
+
+        try:
+            self.heartbeat_agent()
         except Exception as exc:
-            LOG.error('failed to refresh address %s: %s',
-                      address, exc)
-            self.release_address(address)
+            LOG.error('failed to register agent %s: %s', self.id, exc)
+            return False
+
+        return True
+
+    def heartbeat_agent(self, agent=None):
+        '''Renew our agent liveness key, which in agent ownership mode
+        renews our claim on every address we own, and refresh the
+        lifetime of those addresses on the interface.  Like heartbeat(),
+        this may be called from a worker thread; the only state it
+        changes is self.agent_renewed, which nothing else writes.'''
+
+        LOG.info('refresh agent %s', self.id)
+        with metrics.heartbeat_seconds.time(kind='agent'):
+            started = time.time()
+            r = self.etcd('agent', 'PUT', self.agent_url(self.id),
+                          params={'ttl': self.refresh_interval * 2},
+                          data={'value': self.id})
+            r.raise_for_status()
+            self.agent_renewed = started
+
+            if not self.iface_driver:
+                return
+
+            for address in self.claimed_addresses():
+                try:
+                    self.refresh_lifetime(address)
+                except InterfaceDriverError as exc:
+                    LOG.error('failed to refresh address %s on system: %s',
+                              address, exc.reason)
+
+    def heartbeat_failed(self, address, exc):
+        '''Called by the scheduler from a worker thread when a
+        heartbeat fails.  The address is released by the main loop.'''
+
+        self.q.put({'message': 'refresh-failed',
+                    'target': address,
+                    'address': address,
+                    'reason': str(exc)})
+
+    def handle_refresh_failed(self, msg):
+        address = msg['address']
+        LOG.error('failed to refresh address %s: %s',
+                  address, msg['reason'])
+        self.release_address(address)
+
+    def agent_heartbeat_failed(self, agent, exc):
+        '''Called by the scheduler from a worker thread when renewing
+        our agent liveness key fails.'''
+
+        self.q.put({'message': 'agent-refresh-failed',
+                    'target': agent,
+                    'agent': agent,
+                    'reason': str(exc)})
+
+    def handle_agent_refresh_failed(self, msg):
+        '''The scheduler tries again after every interval, so a single
+        failure needs no action.  Once the TTL of our liveness key has
+        run out other agents may have taken over our addresses, so we
+        stop managing them and claim them again once we have renewed
+        our key.'''
+
+        LOG.error('failed to refresh agent %s: %s',
+                  msg['agent'], msg['reason'])
+
+        if time.time() < self.agent_renewed + self.refresh_interval * 2:
+            return
+
+        claimed = self.claimed_addresses()
+        if claimed:
+            LOG.error('agent key %s has expired, releasing %d addresses',
+                      self.id, len(claimed))
+        for address in claimed:
+            self.release_address(address, update_etcd=False)
+            self.reclaim.add(address)
+
+        if self.register_agent():
+            for address in list(self.reclaim):
+                if self.address_is_active(address):
+                    self.claim_address(address)
 
     def claim_address(self, address):
         assert address in self.addresses
 
+        if address in self.reclaim:
+            # we owned this address before we were restarted.
+            self.reclaim.discard(address)
+            if self.takeover_address(address, self.id):
+                return
+
         try:
-            r = requests.put(self.url_for(address),
-                             params={'prevExist': 'false',
-                                     'ttl': self.refresh_interval*2},
-                             data={'value': self.id})
-        except requests.ConnectionError as exc:
+            r = self.etcd('claim', 'PUT', self.url_for(address),
+                          params=self.claim_params(prevExist='false'),
+                          data={'value': self.id})
+        except requests.RequestException as exc:
             LOG.error('connection to %s failed: %s',
                       self.url_for(address),
                       exc)
@@ -171,31 +730,110 @@ class Manager (object):
                 LOG.debug('failed to claim %s: %s',
                           address,
                           r.reason)
+
+                if self.ownership_mode == 'agent':
+                    self.adopt_orphan(address)
+
                 return
 
-            LOG.warn('claimed %s', address)
-            self.addresses[address]['claimed'] = True
+            self.address_claimed(address)
 
-            if self.iface_driver:
-                try:
-                    self.iface_driver.add_address(address,
-                                                  lft=self.refresh_interval*2)
-                except InterfaceDriverError as exc:
-                    LOG.error('failed to configure address on system: %d',
-                              exc.returncode)
+    def adopt_orphan(self, address):
+        '''In agent ownership mode an address key outlives its owner
+        if no other agent was interested in the address when the owner
+        died.  If the owner of the address no longer has a liveness key,
+        take the address over.'''
+
+        try:
+            r = self.etcd('adopt', 'GET', self.url_for(address))
+            r.raise_for_status()
+            owner = r.json()['node'].get('value')
+            if not owner:
+                LOG.debug('address %s has no owner', address)
+                return
+
+            r = self.etcd('adopt', 'GET', self.agent_url(owner))
+            if r.ok:
+                return
+        except (requests.RequestException, ValueError) as exc:
+            LOG.debug('unable to check owner of %s: %s', address, exc)
+            return
+
+        LOG.info('owner %s of address %s is gone', owner, address)
+        self.takeover_address(address, owner)
+
+    def takeover_address(self, address, owner):
+        '''Atomically replace another agent's claim on an address with
+        our own.  Returns True if the address is now ours.'''
+
+        try:
+            r = self.etcd('takeover', 'PUT', self.url_for(address),
+                          params=self.claim_params(prevValue=owner),
+                          data={'value': self.id})
+        except requests.RequestException as exc:
+            LOG.error('connection to %s failed: %s',
+                      self.url_for(address),
+                      exc)
+            return False
+
+        if not r.ok:
+            LOG.debug('failed to take over %s from %s: %s',
+                      address, owner, r.reason)
+            return False
+
+        self.address_claimed(address)
+        return True
+
+    def address_claimed(self, address):
+        LOG.warn('claimed %s', address)
+        self.addresses[address]['claimed'] = True
+
+        if self.scheduler is not None and self.ownership_mode == 'address':
+            self.scheduler.add(address)
+
+        if self.iface_driver:
+            try:
+                if not self.iface_driver.adopt_address(address):
+                    self.iface_driver.add_address(
+                        address,
+                        lft=self.refresh_interval*2)
+            except InterfaceDriverError as exc:
+                LOG.error('failed to configure address on system: %d',
+                          exc.returncode)
+
+    def release_address(self, address, update_etcd=True):
+        '''Release our claim on an address.  If update_etcd is False
+        we only stop managing the address locally, because another
+        agent already owns it.'''
 
-    def release_address(self, address):
         if not self.address_is_claimed(address):
             LOG.debug('not releasing unclaimed address %s',
                       address)
             return
 
-        self.addresses[address]['claimed'] = False
+        with self.claim_lock:
+            self.addresses[address]['claimed'] = False
+
+        if self.scheduler is not None:
+            self.scheduler.remove(address)
+
+        if not update_etcd:
+            LOG.warn('lost %s', address)
+        else:
+            self.delete_claim(address)
+
+        if self.iface_driver:
+            try:
+                self.iface_driver.remove_address(address)
+            except InterfaceDriverError as exc:
+                LOG.error('failed to remove address on system: %d',
+                          exc.returncode)
 
+    def delete_claim(self, address):
         try:
-            r = requests.delete(self.url_for(address),
-                                params={'prevValue': self.id})
-        except requests.ConnectionError as exc:
+            r = self.etcd('release', 'DELETE', self.url_for(address),
+                          params={'prevValue': self.id})
+        except requests.RequestException as exc:
             LOG.error('connection to %s failed: %s',
                       self.url_for(address),
                       exc)
@@ -207,13 +845,6 @@ class Manager (object):
             else:
                 LOG.warn('released %s', address)
 
-        if self.iface_driver:
-            try:
-                self.iface_driver.remove_address(address)
-            except InterfaceDriverError as exc:
-                LOG.error('failed to remove address on system: %d',
-                          exc.returncode)
-
     def remove_address(self, address):
         assert address in self.addresses
 
@@ -225,26 +856,100 @@ class Manager (object):
         for address in self.addresses.keys():
             self.release_address(address)
 
-    def handle_add_service(self, msg):
-        service = msg['service']
+    def project_service(self, service):
+        '''Return the parts of a service that kiwi acts on, or None if
+        the service has no public addresses (or no port) and so is of
+        no interest to us.'''
+
+        if not service.get('publicIPs'):
+            return None
+
+        if service.get('port') is None:
+            LOG.warn('ignoring service %s, which has no port',
+                     service['id'])
+            return None
 
-        for address in service.get('publicIPs', []):
+        return {'id': service['id'],
+                'protocol': service.get('protocol', 'TCP'),
+                'port': service['port'],
+                'publicIPs': list(service['publicIPs']),
+                'resourceVersion': service.get('resourceVersion')}
+
+    def service_rules(self, service):
+        '''Return the set of (address, protocol, port) tuples that a
+        service needs firewall rules for.'''
+
+        if service is None:
+            return set()
+
+        rules = set()
+        for address in service['publicIPs']:
             if not self.address_is_valid(address):
                 LOG.warn('ignoring invalid address %s',
                          address)
                 continue
 
+            rules.add((address, service['protocol'], service['port']))
+
+        return rules
+
+    def handle_add_service(self, msg):
+        service = msg['service']
+
+        if service['id'] in self.services:
+            LOG.debug('service %s already exists, updating',
+                      service['id'])
+
+        self.update_service(service['id'], self.project_service(service))
+
+    def handle_update_service(self, msg):
+        service = msg['service']
+        self.update_service(service['id'], self.project_service(service))
+
+    def handle_delete_service(self, msg):
+        self.update_service(msg['service']['id'], None)
+
+    def update_service(self, id, new):
+        '''Replace our projection of service `id` with `new` (or
+        forget it, if new is None), adding and removing only the
+        firewall rules and address references that differ between
+        the two.'''
+
+        old = self.services.pop(id, None)
+        if new is not None:
+            self.services[id] = new
+
+        old_rules = self.service_rules(old)
+        new_rules = self.service_rules(new)
+
+        for address, protocol, port in old_rules - new_rules:
+            LOG.info('removing service %s on %s',
+                     id,
+                     address)
+
+            if self.fw_driver:
+                try:
+                    self.fw_driver.remove_service(address, old)
+                except FirewallDriverError as exc:
+                    LOG.error('failed to configure host firewall: %s',
+                              exc.reason)
+
+        for address, protocol, port in new_rules - old_rules:
             LOG.info('adding service %s on %s',
-                     service['id'],
+                     id,
                      address)
 
             if self.fw_driver:
                 try:
-                    self.fw_driver.add_service(address, service)
+                    self.fw_driver.add_service(address, new)
                 except FirewallDriverError as exc:
-                    LOG.error('failed to configure host firewall: %d',
-                              exc.returncode)
+                    LOG.error('failed to configure host firewall: %s',
+                              exc.reason)
+
+        old_addresses = set(rule[0] for rule in old_rules)
+        new_addresses = set(rule[0] for rule in new_rules)
 
+        for address in new_addresses - old_addresses:
             try:
                 self.addresses[address]['count'] += 1
             except KeyError:
@@ -256,26 +961,7 @@ class Manager (object):
             if not self.address_is_claimed(address):
                 self.claim_address(address)
 
-    def handle_delete_service(self, msg):
-        service = msg['service']
-
-        for address in service.get('publicIPs', []):
-            if not self.address_is_valid(address):
-                LOG.warn('ignoring invalid address %s',
-                         address)
-                continue
-
-            LOG.info('removing service %s on %s',
-                     service['id'],
-                     address)
-
-            if self.fw_driver:
-                try:
-                    self.fw_driver.remove_service(address, service)
-                except FirewallDriverError as exc:
-                    LOG.error('failed to configure host firewall: %d',
-                              exc.returncode)
-
+        for address in old_addresses - new_addresses:
             if address in self.addresses:
                 self.addresses[address]['count'] -= 1
                 if not self.address_is_active(address):
@@ -288,6 +974,41 @@ class Manager (object):
 
     handle_expire_address = handle_delete_address
 
+    def handle_set_address(self, msg):
+        address = msg['address']
+        owner = msg['node'].get('value')
+        if owner != self.id and self.address_is_claimed(address):
+            LOG.warn('address %s has been claimed by %s', address, owner)
+            self.release_address(address, update_etcd=False)
+
+    handle_create_address = handle_set_address
+
+    def handle_expire_agent(self, msg):
+        agent = msg['agent']
+
+        if agent == self.id:
+            LOG.error('our agent key has expired')
+            self.register_agent()
+            return
+
+        LOG.warn('agent %s is gone', agent)
+
+        try:
+            r = self.etcd('list', 'GET', self.url_for(),
+                          params={'recursive': True})
+            r.raise_for_status()
+            nodes = r.json()['node'].get('nodes', [])
+        except (requests.RequestException, ValueError) as exc:
+            LOG.error('failed to list addresses: %s', exc)
+            return
+
+        for node in nodes:
+            address = node['key'].split('/')[-1]
+            if (node.get('value') == agent and
+                    self.address_is_active(address) and
+                    not self.address_is_claimed(address)):
+                self.takeover_address(address, agent)
+
     def address_is_active(self, address):
         return (address in self.addresses and
                 self.addresses[address]['count'] > 0)
@@ -297,18 +1018,49 @@ class Manager (object):
                 self.addresses[address]['claimed'])
 
     def address_is_valid(self, address):
-        if self.cidr_ranges is None:
+        if self.cidr_index is None:
             return True
 
-        for net in self.cidr_ranges:
-            if address in net:
-                return True
+        return address in self.cidr_index
 
-        return False
+    def address_owner(self, address):
+        '''Return the most specific of our cidr ranges that contains
+        address, or None if no range contains it.'''
+
+        if self.cidr_index is None:
+            return None
+
+        return self.cidr_index.owner(address)
 
     def cleanup(self):
+        if self.scheduler is not None:
+            self.scheduler.stop()
+
+        if self.refresh_pool is not None:
+            self.refresh_pool.close()
+            self.refresh_pool.join()
+            self.refresh_pool = None
+
+        if self.keep_claims:
+            # leave our claims, rules and addresses in place for the
+            # next instance to pick up.
+            LOG.warn('exiting without releasing %d claims',
+                     len(self.claimed_addresses()))
+            if self.state_file:
+                self.save_state()
+            if self.iface_driver:
+                self.iface_driver.close()
+            return
+
         self.release_all_addresses()
 
+        if self.ownership_mode == 'agent':
+            try:
+                self.etcd('agent', 'DELETE', self.agent_url(self.id),
+                          params={'prevValue': self.id})
+            except requests.RequestException as exc:
+                LOG.error('failed to remove agent key: %s', exc)
+
         if self.fw_driver:
             self.fw_driver.cleanup()
 
@@ -0,0 +1,269 @@
+import bisect
+import contextlib
+import logging
+import threading
+import time
+
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+
+import tracing
+
+LOG = logging.getLogger(__name__)
+
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def escape(value):
+    return (str(value).replace('\\', '\\\\')
+            .replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value))
+                             for name, value in pairs)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value))
+
+
+class Metric (object):
+    '''Base class for metrics.  Each metric holds one value per
+    combination of label values.'''
+
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        with self.lock:
+            lines.extend(self.samples())
+
+        return lines
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield '%s%s %s' % (self.name,
+                               format_labels(self.labels, key),
+                               format_value(value))
+
+
+class Counter (Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge (Metric):
+    '''A gauge is either set explicitly or, with set_function, read
+    from a callable every time it is rendered.'''
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=()):
+        super(Gauge, self).__init__(name, help, labels)
+        self.functions = {}
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def set_function(self, func, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.functions[key] = func
+
+    def samples(self):
+        values = dict(self.values)
+        for key, func in self.functions.items():
+            try:
+                values[key] = func()
+            except Exception as exc:
+                LOG.debug('failed to read %s: %s', self.name, exc)
+
+        for key, value in sorted(values.items()):
+            yield '%s%s %s' % (self.name,
+                               format_labels(self.labels, key),
+                               format_value(value))
+
+
+class Histogram (Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=default_buckets):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            try:
+                counts, total = self.values[key]
+            except KeyError:
+                counts, total = [0] * len(self.buckets), 0
+
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        '''Observe the time spent inside the context, whether or not it
+        raises an exception.'''
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def samples(self):
+        for key, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield '%s_bucket%s %d' % (
+                    self.name,
+                    format_labels(self.labels, key,
+                                  [('le', format_value(bound))]),
+                    cumulative)
+
+            labels = format_labels(self.labels, key)
+            yield '%s_sum%s %s' % (self.name, labels, format_value(total))
+            yield '%s_count%s %d' % (self.name, labels, cumulative)
+
+
+class Registry (object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        '''Return all metrics in the Prometheus text exposition
+        format.'''
+
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+queue_depth = registry.register(Gauge(
+    'kiwi_queue_depth',
+    'Messages waiting in the event queue.'))
+addresses = registry.register(Gauge(
+    'kiwi_addresses',
+    'Addresses known to this agent, and how many of them it has claimed.',
+    ['state']))
+handler_seconds = registry.register(Histogram(
+    'kiwi_handler_seconds',
+    'Time spent handling a message.',
+    ['message']))
+command_seconds = registry.register(Histogram(
+    'kiwi_command_seconds',
+    'Time spent running external commands.',
+    ['command']))
+command_failures = registry.register(Counter(
+    'kiwi_command_failures_total',
+    'External commands that failed.',
+    ['command']))
+etcd_seconds = registry.register(Histogram(
+    'kiwi_etcd_request_seconds',
+    'Round trip time of etcd requests.',
+    ['operation']))
+etcd_failures = registry.register(Counter(
+    'kiwi_etcd_failures_total',
+    'etcd requests that failed or were refused.',
+    ['operation']))
+firewall_reorders = registry.register(Counter(
+    'kiwi_firewall_reorders_total',
+    'Chains reordered by the firewall optimizer.'))
+refresh_seconds = registry.register(Histogram(
+    'kiwi_refresh_seconds',
+    'Duration of refresh passes (heartbeat_mode pool only).',
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60)))
+heartbeat_seconds = registry.register(Histogram(
+    'kiwi_heartbeat_seconds',
+    'Time taken to renew an address claim or our agent key.',
+    ['kind']))
+
+
+@contextlib.contextmanager
+def timed_command(command, **attrs):
+    '''Record the duration of an external command, and count it as a
+    failure if it raises an exception.  The command is also traced,
+    with any extra attributes attached to its span.'''
+
+    with tracing.span('command', command=command, **attrs), \
+            command_seconds.time(command=command):
+        try:
+            yield
+        except Exception:
+            command_failures.inc(command=command)
+            raise
+
+
+class Handler (BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ['/', '/metrics']:
+            self.send_error(404)
+            return
+
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Server (socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve(port, address='127.0.0.1', registry=registry):
+    '''Serve metrics over HTTP from a background thread, and return
+    the server.'''
+
+    server = Server((address, port), Handler)
+    server.registry = registry
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    LOG.info('serving metrics on %s:%d', address, server.server_port)
+    return server
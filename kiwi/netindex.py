@@ -0,0 +1,121 @@
+import bisect
+import socket
+import struct
+
+import netaddr
+
+ipv4 = struct.Struct('!I')
+
+
+def address_key(address):
+    '''Return a sortable (version, integer) key for an address, or None
+    if it is not a valid IP address.'''
+
+    try:
+        return (4, ipv4.unpack(socket.inet_pton(socket.AF_INET,
+                                                address))[0])
+    except (socket.error, TypeError):
+        pass
+
+    try:
+        address = netaddr.IPAddress(address)
+    except (netaddr.AddrFormatError, ValueError, TypeError):
+        return None
+
+    return (address.version, int(address))
+
+
+class NetworkIndex (object):
+    '''A NetworkIndex answers "is this address in one of these
+    networks, and which one" in O(log n) time.
+
+    The networks are flattened into a sorted list of disjoint
+    intervals, each labelled with the innermost network that covers
+    it, so a lookup is a single bisect.  Networks may be given as
+    CIDR strings or netaddr.IPNetwork objects, or as (network, owner)
+    tuples to associate each network with something else (such as an
+    interface name).  Networks without an explicit owner own
+    themselves.'''
+
+    def __init__(self, networks=None):
+        super(NetworkIndex, self).__init__()
+
+        self.networks = []
+        self.starts = []
+        self.ends = []
+        self.owners = []
+
+        if networks:
+            self.build(networks)
+
+    def __len__(self):
+        return len(self.networks)
+
+    def __contains__(self, address):
+        return self.owner(address) is not None
+
+    def build(self, networks):
+        entries = []
+        for network in networks:
+            if isinstance(network, tuple):
+                network, owner = network
+            else:
+                owner = None
+
+            network = netaddr.IPNetwork(network)
+            if owner is None:
+                owner = network
+
+            self.networks.append(network)
+            entries.append(((network.version, network.first),
+                            (network.version, network.last),
+                            owner))
+
+        # Sort outer networks before the networks they contain.  CIDR
+        # networks either nest or are disjoint, so a stack of the
+        # networks enclosing the current position is enough to label
+        # every interval with its innermost owner.
+        entries.sort(key=lambda entry: (entry[0], -entry[1][1]))
+
+        stack = []
+        pos = None
+        for first, last, owner in entries:
+            while stack and stack[-1][0] < first:
+                end, outer = stack.pop()
+                self.add_interval(pos, end, outer)
+                pos = (end[0], end[1] + 1)
+
+            if stack:
+                self.add_interval(pos, (first[0], first[1] - 1),
+                                  stack[-1][1])
+
+            stack.append((last, owner))
+            pos = first
+
+        while stack:
+            end, outer = stack.pop()
+            self.add_interval(pos, end, outer)
+            pos = (end[0], end[1] + 1)
+
+    def add_interval(self, start, end, owner):
+        if start > end:
+            return
+
+        self.starts.append(start)
+        self.ends.append(end)
+        self.owners.append(owner)
+
+    def owner(self, address):
+        '''Return the owner of the most specific network containing
+        address, or None if no network contains it.'''
+
+        key = address_key(str(address))
+        if key is None:
+            return None
+
+        i = bisect.bisect_right(self.starts, key) - 1
+        if i >= 0 and key <= self.ends[i]:
+            return self.owners[i]
+
+    def contains(self, address):
+        return address in self
@@ -0,0 +1,255 @@
+import fcntl
+import logging
+import os
+import socket
+import struct
+import threading
+
+import interface
+import metrics
+from exc import *
+
+LOG = logging.getLogger(__name__)
+
+NETLINK_ROUTE = 0
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+NLM_F_REQUEST = 0x001
+NLM_F_MULTI = 0x002
+NLM_F_ACK = 0x004
+NLM_F_REPLACE = 0x100
+NLM_F_DUMP = 0x300
+NLM_F_CREATE = 0x400
+
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_LABEL = 3
+IFA_CACHEINFO = 6
+
+RT_SCOPE_UNIVERSE = 0
+
+SIOCGIFINDEX = 0x8933
+
+nlmsghdr = struct.Struct('=IHHII')
+nlmsgerr = struct.Struct('=i')
+ifaddrmsg = struct.Struct('=BBBBI')
+rtattr = struct.Struct('=HH')
+ifa_cacheinfo = struct.Struct('=IIII')
+
+
+def align(length):
+    return (length + 3) & ~3
+
+
+def pack_attr(kind, data):
+    '''Pack a single rtattr with its payload, including padding.'''
+    length = rtattr.size + len(data)
+    return (rtattr.pack(length, kind) + data +
+            b'\0' * (align(length) - length))
+
+
+def unpack_attrs(data):
+    '''Return a dictionary mapping attribute types to payloads for the
+    rtattrs in data.'''
+
+    attrs = {}
+    offset = 0
+    while offset + rtattr.size <= len(data):
+        length, kind = rtattr.unpack_from(data, offset)
+        if length < rtattr.size:
+            break
+
+        attrs[kind] = data[offset + rtattr.size:offset + length]
+        offset += align(length)
+
+    return attrs
+
+
+def interface_index(ifname):
+    '''Look up the index of the named interface in the current network
+    namespace.'''
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        res = fcntl.ioctl(sock.fileno(), SIOCGIFINDEX,
+                          struct.pack('16si', ifname.encode(), 0))
+    finally:
+        sock.close()
+
+    return struct.unpack('16si', res)[1]
+
+
+class NetlinkError(Exception):
+    def __init__(self, errno):
+        self.errno = errno
+
+    def __repr__(self):
+        return '<NetlinkError [%d]: %s>' % (
+            self.errno,
+            os.strerror(self.errno))
+
+    def __str__(self):
+        return repr(self)
+
+
+class Netlink(object):
+    '''A minimal rtnetlink client that knows how to send a request and
+    collect the replies to it.'''
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_NETLINK,
+                                  socket.SOCK_RAW,
+                                  NETLINK_ROUTE)
+        self.sock.bind((0, 0))
+        self.pid = self.sock.getsockname()[0]
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    def close(self):
+        self.sock.close()
+
+    def request(self, kind, flags, payload):
+        '''Send a request and return a list of (type, payload) tuples
+        for the messages received in response.  Raises NetlinkError if
+        the kernel reports an error.'''
+
+        with self.lock, metrics.timed_command('netlink', kind=kind):
+            self.seq += 1
+            seq = self.seq
+
+            self.sock.send(nlmsghdr.pack(nlmsghdr.size + len(payload),
+                                         kind, flags, seq, self.pid) +
+                           payload)
+
+            return list(self.replies(seq))
+
+    def replies(self, seq):
+        while True:
+            data = self.sock.recv(65536)
+            offset = 0
+
+            while offset + nlmsghdr.size <= len(data):
+                (length, kind, flags,
+                 msgseq, pid) = nlmsghdr.unpack_from(data, offset)
+                payload = data[offset + nlmsghdr.size:offset + length]
+                offset += align(length)
+
+                if msgseq != seq:
+                    continue
+
+                if kind == NLMSG_DONE:
+                    return
+                elif kind == NLMSG_ERROR:
+                    error = nlmsgerr.unpack_from(payload)[0]
+                    if error:
+                        raise NetlinkError(-error)
+                    return
+
+                yield kind, payload
+
+                if not flags & NLM_F_MULTI:
+                    return
+
+
+class NetlinkInterface (interface.Interface):
+    '''This is a network interface driver for Kiwi that manages
+    addresses by talking rtnetlink to the kernel directly, rather than
+    running the `ip` command for every change.'''
+
+    def __init__(self,
+                 interface='eth0',
+                 label='kube',
+                 reconcile=False):
+        self.nl = Netlink()
+        self.index = interface_index(interface)
+
+        super(NetlinkInterface, self).__init__(interface=interface,
+                                               label=label,
+                                               reconcile=reconcile)
+
+    def close(self):
+        self.nl.close()
+
+    @property
+    def full_label(self):
+        return '%s:%s' % (self.interface, self.label)
+
+    def addrmsg(self, address, attrs=()):
+        packed = socket.inet_aton(address)
+        return (ifaddrmsg.pack(socket.AF_INET, 32, 0,
+                               RT_SCOPE_UNIVERSE, self.index) +
+                pack_attr(IFA_LOCAL, packed) +
+                pack_attr(IFA_ADDRESS, packed) +
+                b''.join(pack_attr(kind, data) for kind, data in attrs))
+
+    def labelled_addresses(self):
+        '''Return a list of addresses on self.interface that are
+        labelled with self.label.'''
+
+        try:
+            replies = self.nl.request(
+                RTM_GETADDR,
+                NLM_F_REQUEST | NLM_F_DUMP,
+                ifaddrmsg.pack(socket.AF_INET, 0, 0, 0, 0))
+        except (NetlinkError, socket.error) as exc:
+            raise InterfaceDriverError(reason=exc,
+                                       returncode=exc.errno)
+
+        label = self.full_label.encode()
+        addresses = []
+        for kind, payload in replies:
+            if kind != RTM_NEWADDR:
+                continue
+
+            family, _, _, _, index = ifaddrmsg.unpack_from(payload)
+            if family != socket.AF_INET or index != self.index:
+                continue
+
+            attrs = unpack_attrs(payload[ifaddrmsg.size:])
+            if attrs.get(IFA_LABEL, b'').rstrip(b'\0') != label:
+                continue
+
+            address = attrs.get(IFA_LOCAL, attrs.get(IFA_ADDRESS))
+            addresses.append(socket.inet_ntoa(address))
+
+        return addresses
+
+    def add_address(self, address, lft=None):
+        '''Add the given address to the managed interface.'''
+        LOG.info('add address %s to device %s',
+                 address,
+                 self.interface)
+
+        attrs = [(IFA_LABEL, self.full_label.encode() + b'\0')]
+        if lft:
+            attrs.append((IFA_CACHEINFO,
+                          ifa_cacheinfo.pack(lft, lft, 0, 0)))
+
+        try:
+            self.nl.request(
+                RTM_NEWADDR,
+                NLM_F_REQUEST | NLM_F_ACK | NLM_F_CREATE | NLM_F_REPLACE,
+                self.addrmsg(address, attrs))
+        except (NetlinkError, socket.error) as exc:
+            raise InterfaceDriverError(reason=exc,
+                                       returncode=exc.errno)
+
+    def remove_address(self, address):
+        '''Remove the given address from the managed interface.'''
+        LOG.info('remove address %s from device %s',
+                 address,
+                 self.interface)
+
+        try:
+            self.nl.request(RTM_DELADDR,
+                            NLM_F_REQUEST | NLM_F_ACK,
+                            self.addrmsg(address))
+        except (NetlinkError, socket.error) as exc:
+            raise InterfaceDriverError(reason=exc,
+                                       returncode=exc.errno)
@@ -0,0 +1,155 @@
+import functools
+import json
+import logging
+
+import defaults
+import firewall
+import iptables
+from exc import *
+
+LOG = logging.getLogger(__name__)
+
+# the priority of the mangle table in the prerouting hook.
+mangle_priority = -150
+
+
+class Nft (object):
+    '''A thin wrapper around the nft command for a single table.'''
+
+    def __init__(self, name=defaults.nft_table, family='ip', netns=None):
+        self.name = name
+        self.family = family
+
+        prefix = ()
+        if netns is not None:
+            prefix = ('ip', 'netns', 'exec', netns)
+
+        self.nft = functools.partial(iptables.cmd, *(prefix + ('nft',)))
+
+    def __str__(self):
+        return '<Nft %s %s>' % (self.family, self.name)
+
+    @property
+    def spec(self):
+        return '%s %s' % (self.family, self.name)
+
+    def apply(self, commands):
+        '''Apply a list of nft commands in a single atomic
+        transaction.'''
+
+        if not commands:
+            return
+
+        LOG.debug('committing %d changes to table %s',
+                  len(commands), self.spec)
+        self.nft('-f', '-', input=''.join('%s\n' % c for c in commands))
+
+    def list_set(self, name):
+        '''Return the elements of a set of concatenations as a list of
+        tuples of strings.'''
+
+        out = json.loads(self.nft('-j', 'list', 'set',
+                                  self.family, self.name, name))
+
+        elements = []
+        for item in out.get('nftables', []):
+            for elem in item.get('set', {}).get('elem', []):
+                # elements with extra attributes are wrapped.
+                if 'elem' in elem:
+                    elem = elem['elem']['val']
+
+                elements.append(tuple(str(part).lower()
+                                      for part in elem['concat']))
+
+        return elements
+
+    def delete(self):
+        self.apply(['delete table %s' % self.spec])
+
+
+class NftFirewall (firewall.SetFirewall):
+    '''A firewall driver that manages a table of its own in nftables.
+    The table holds a set of `ipv4_addr . inet_proto . inet_service`
+    entries, one for the address, protocol and port of every service,
+    and a prerouting chain at mangle priority with a single rule that
+    marks packets whose destination is in the set.  Every change (or
+    batch of changes) is pushed as one atomic `nft -f -` transaction,
+    rather than one iptables command per rule.'''
+
+    def __init__(self,
+                 fwmark=defaults.fwmark,
+                 fwset=defaults.fwset,
+                 nft=None,
+                 reconcile=False):
+
+        super(NftFirewall, self).__init__()
+
+        if nft is None:
+            nft = Nft()
+
+        self.nft = nft
+        self.fwmark = fwmark
+        self.fwset = fwset
+
+        try:
+            if reconcile:
+                self.load_state()
+            else:
+                self.create_table()
+        except iptables.CommandError as exc:
+            raise FirewallDriverError(reason=exc)
+
+    def definition(self):
+        '''Return the commands that create our set and chain, and make
+        the chain contain only our match rule.  These are safe to apply
+        whether or not the table already exists.'''
+
+        table = self.nft.spec
+        return [
+            'add table %s' % table,
+            'add set %s %s { type ipv4_addr . inet_proto . inet_service; }'
+            % (table, self.fwset),
+            'add chain %s prerouting { type filter hook prerouting '
+            'priority %d; }' % (table, mangle_priority),
+            'flush chain %s prerouting' % table,
+            'add rule %s prerouting ip daddr . meta l4proto . th dport '
+            '@%s meta mark set %s' % (table, self.fwset, self.fwmark),
+        ]
+
+    def create_table(self):
+        '''Replace anything left in our table with an empty set and our
+        match rule, in one transaction.'''
+
+        LOG.info('creating nftables table %s', self.nft.spec)
+        self.nft.apply(['add table %s' % self.nft.spec,
+                        'delete table %s' % self.nft.spec] +
+                       self.definition())
+
+    def load_state(self):
+        '''Make sure our table, set and rule exist without disturbing
+        the set, and read the entries already in it into self.existing
+        so that they can be adopted.'''
+
+        self.nft.apply(self.definition())
+        self.existing = set(self.nft.list_set(self.fwset))
+        LOG.info('found %d existing entries in set %s',
+                 len(self.existing), self.fwset)
+
+    def cleanup(self):
+        LOG.info('deleting nftables table %s', self.nft.spec)
+        self.entries = {}
+        try:
+            self.nft.delete()
+        except iptables.CommandError as exc:
+            raise FirewallDriverError(reason=exc)
+
+    def entry_for(self, address, service):
+        return (address,
+                service['protocol'].lower(),
+                str(service['port']))
+
+    def commit(self, changes):
+        verbs = {'add': 'add', 'del': 'delete'}
+        self.nft.apply(['%s element %s %s { %s }' % (
+            verbs[action], self.nft.spec, self.fwset, ' . '.join(entry))
+            for action, entry in changes])
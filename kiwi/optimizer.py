@@ -0,0 +1,193 @@
+import logging
+import threading
+
+import defaults
+import iptables
+import metrics
+import tracing
+
+LOG = logging.getLogger(__name__)
+
+
+class Optimizer (object):
+    '''An Optimizer periodically moves the busiest rules in the
+    firewall's chains to the front, so that most packets are matched
+    after checking only a few rules.  This only helps when the firewall
+    was created with reorder=True, which makes a match end the
+    traversal of the chain.
+
+    Every `interval` seconds it reads the packet counters for the
+    whole table with a single `iptables-save -c`, and keeps a
+    decaying average of the packets matched by each rule in
+    self.fwchain and its sub-chains since the last pass.  The cost of
+    an order is the average number of rules checked per packet.  A
+    chain is rewritten, together with any others that need it and
+    with their counters preserved, in a single atomic iptables-restore
+    only if the best order would reduce its cost by more than
+    `hysteresis` (a fraction of the current cost), so that rules do
+    not churn back and forth on small changes in traffic.'''
+
+    def __init__(self,
+                 firewall,
+                 interval=defaults.reorder_interval,
+                 hysteresis=defaults.reorder_hysteresis,
+                 decay=0.5,
+                 min_packets=100):
+        super(Optimizer, self).__init__()
+
+        self.firewall = firewall
+        self.table = firewall.table
+        self.interval = interval
+        self.hysteresis = hysteresis
+        self.decay = decay
+        self.min_packets = min_packets
+
+        # maps (chain, rule) to the packet count seen on the last
+        # pass, and to the average packets matched per pass.
+        self.counts = {}
+        self.rates = {}
+
+        self.cond = threading.Condition()
+        self.thread = None
+        self.stopped = False
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        '''Stop the optimizer, waiting for any pass in progress to
+        finish.'''
+
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        LOG.info('starting firewall optimizer')
+        while True:
+            with self.cond:
+                if not self.stopped:
+                    self.cond.wait(self.interval)
+                if self.stopped:
+                    break
+
+            try:
+                with tracing.span('reorder') as span:
+                    span.set(chains=self.optimize())
+            except Exception as exc:
+                LOG.error('failed to reorder firewall rules: %s', exc)
+
+        LOG.info('stopped firewall optimizer')
+
+    def is_ours(self, chain):
+        return (chain == self.firewall.fwchain or
+                self.firewall.is_subchain(chain))
+
+    def can_reorder(self, rule):
+        '''Return True if a rule ends the traversal of its chain when it
+        matches, and so can be moved without changing which rule a
+        packet matches.'''
+
+        args = dict(zip(rule, rule[1:]))
+        target = args.get('-g')
+        return (target == self.firewall.markchain or
+                (target is not None and self.firewall.is_subchain(target)))
+
+    def update_rates(self, chain, rules):
+        '''Update the average rate of each rule from its counters, and
+        return the rates in the current order.'''
+
+        rates = []
+        for packets, nbytes, rule in rules:
+            key = (chain, rule)
+            last = self.counts.get(key, 0)
+
+            # a rule that was deleted and added again starts over.
+            delta = packets - last if packets >= last else packets
+            self.counts[key] = packets
+
+            rate = self.rates.get(key)
+            rate = delta if rate is None else (
+                self.decay * rate + (1 - self.decay) * delta)
+            self.rates[key] = rate
+            rates.append(rate)
+
+        return rates
+
+    def plan(self, chain, rules):
+        '''Return the rules of a chain in their best order, or None if
+        the chain should be left alone.'''
+
+        rates = self.update_rates(chain, rules)
+        if sum(rates) < self.min_packets:
+            return None
+
+        if not all(self.can_reorder(rule) for _, _, rule in rules):
+            LOG.debug('not reordering %s, which has rules that '
+                      'do not end the traversal', chain)
+            return None
+
+        # sorted is stable, so rules with the same rate keep their
+        # order.
+        order = sorted(range(len(rules)), key=lambda i: -rates[i])
+        current = sum(rate * (i + 1) for i, rate in enumerate(rates))
+        best = sum(rates[j] * (i + 1) for i, j in enumerate(order))
+        if current - best <= self.hysteresis * current:
+            return None
+
+        LOG.info('reordering %s reduces rules checked per packet '
+                 'from %.2f to %.2f',
+                 chain, current / sum(rates), best / sum(rates))
+        return [rules[i] for i in order]
+
+    def render(self, plans):
+        lines = ['*%s' % self.table.name]
+        for chain, rules in plans:
+            lines.append('-F %s' % chain)
+            lines.extend('[%d:%d] -A %s %s' % (
+                packets, nbytes, chain,
+                ' '.join(iptables.quote(arg) for arg in rule))
+                for packets, nbytes, rule in rules)
+        lines.append('COMMIT')
+        return '\n'.join(lines) + '\n'
+
+    def optimize(self):
+        '''Read the counters and reorder the chains that need it.
+        Returns the number of chains that were reordered.'''
+
+        # hold the firewall's lock so that no rules are added or
+        # removed between reading the chains and writing them back.
+        with self.firewall.lock:
+            chains = iptables.parse_counters(self.table.iptables_save('-c'))
+
+            plans = []
+            for chain, rules in chains.items():
+                if not self.is_ours(chain):
+                    continue
+
+                order = self.plan(chain, rules)
+                if order is not None:
+                    plans.append((chain, order))
+
+            # forget rules that no longer exist.
+            present = set((chain, rule) for chain, rules in chains.items()
+                          for _, _, rule in rules)
+            for key in list(self.counts):
+                if key not in present:
+                    del self.counts[key]
+                    self.rates.pop(key, None)
+
+            if not plans:
+                return 0
+
+            self.table.iptables_restore('--noflush', '--counters',
+                                        input=self.render(plans))
+            self.table.changed([('-A', chain) for chain, _ in plans])
+
+        metrics.firewall_reorders.inc(len(plans))
+        return len(plans)
@@ -0,0 +1,144 @@
+import heapq
+import logging
+import multiprocessing.pool
+import random
+import threading
+import time
+
+import defaults
+import tracing
+
+LOG = logging.getLogger(__name__)
+
+
+class Scheduler (object):
+    '''A Scheduler calls `callback(key)` once every `interval` seconds
+    for each key that has been added to it.  It runs in its own thread
+    and hands the calls off to a pool of worker threads, so that it is
+    not delayed by slow callbacks or by anything else kiwi is doing.
+
+    Deadlines are kept in a heap.  New keys are given a random offset
+    within the first interval so that renewals are spread out rather
+    than sent in a single burst.  If a call raises an exception,
+    `on_failure(key, exc)` is called from the worker thread.'''
+
+    def __init__(self,
+                 interval,
+                 callback,
+                 on_failure=None,
+                 workers=defaults.refresh_workers):
+        super(Scheduler, self).__init__()
+
+        self.interval = interval
+        self.callback = callback
+        self.on_failure = on_failure
+        self.workers = workers
+
+        self.heap = []
+        self.deadlines = {}
+        self.running = set()
+        self.cond = threading.Condition()
+        self.pool = None
+        self.thread = None
+        self.stopped = False
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def start(self):
+        self.pool = multiprocessing.pool.ThreadPool(self.workers)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        '''Stop making calls, and wait for any that are running to
+        finish.'''
+
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+
+        if self.thread is not None:
+            self.thread.join()
+
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def add(self, key, delay=None):
+        '''Schedule calls for key.  The first call is made after
+        `delay` seconds, or after a random fraction of the interval if
+        delay is not specified.'''
+
+        if delay is None:
+            delay = random.uniform(0, self.interval)
+
+        with self.cond:
+            self.schedule(key, time.time() + delay)
+            self.cond.notify()
+
+    def remove(self, key):
+        '''Stop making calls for key.  A call that is already running
+        is not interrupted.'''
+
+        with self.cond:
+            self.deadlines.pop(key, None)
+
+    def schedule(self, key, when):
+        self.deadlines[key] = when
+        heapq.heappush(self.heap, (when, key))
+
+    def run(self):
+        LOG.info('starting heartbeat scheduler')
+        with self.cond:
+            while not self.stopped:
+                if not self.heap:
+                    self.cond.wait(self.interval)
+                    continue
+
+                when, key = self.heap[0]
+                if self.deadlines.get(key) != when:
+                    # this key was removed or rescheduled.
+                    heapq.heappop(self.heap)
+                    continue
+
+                now = time.time()
+                if when > now:
+                    self.cond.wait(when - now)
+                    continue
+
+                heapq.heappop(self.heap)
+
+                # schedule relative to the previous deadline to avoid
+                # drift, unless we have fallen more than an interval
+                # behind.
+                deadline = when + self.interval
+                if deadline <= now:
+                    deadline = now + self.interval
+                self.schedule(key, deadline)
+
+                if key in self.running:
+                    LOG.warn('previous call for %s is still running', key)
+                    continue
+
+                self.running.add(key)
+                self.pool.apply_async(self.call, (key,))
+
+        LOG.info('stopped heartbeat scheduler')
+
+    def call(self, key):
+        try:
+            with tracing.span('scheduled-call', key=key):
+                self.callback(key)
+        except Exception as exc:
+            LOG.error('scheduled call for %s failed: %s', key, exc)
+            if self.on_failure is not None:
+                self.on_failure(key, exc)
+        finally:
+            with self.cond:
+                self.running.discard(key)
@@ -1,68 +1,95 @@
-import json
 import logging
-import requests
 import time
-from itertools import izip
 
+import client as kiwiclient
 import defaults
-from utils import iter_lines
+from utils import StreamDecoder
 
 
 LOG = logging.getLogger(__name__)
 
 
-def iter_request_events(fd):
-    '''Iterate over the events from a Kubernetes event stream.'''
+def iter_request_events(raw, read_size=defaults.stream_read_size):
+    '''Iterate over the events from a Kubernetes event stream, given
+    the urllib3 response (`response.raw`) of a streamed request.'''
 
-    lines = iter_lines(fd)
-    for expected_len, data, marker in izip(lines, lines, lines):
-        expected_len = int(expected_len, base=16)
-        actual_len = len(data)
-        if expected_len != actual_len + 1:
-            raise ValueError('data length mismatch (expected %d, have %d)',
-                             expected_len,
-                             actual_len)
+    for events in StreamDecoder(raw, read_size):
+        for event in events:
+            yield event
 
-        yield json.loads(data)
 
-
-def iter_events(url, interval=1):
+def iter_events(url, interval=1, client=None,
+                read_size=defaults.stream_read_size):
     '''Generates an infinite string of Kubernetes events'''
 
+    if client is None:
+        client = kiwiclient.Client()
+
     while True:
         try:
-            r = requests.get(url, stream=True)
+            r = client.get(url, stream=True,
+                           timeout=(client.connect_timeout, None))
             r.raise_for_status()
-            for event in iter_request_events(r.raw):
+            for event in iter_request_events(r.raw, read_size=read_size):
                 yield event
         except Exception as exc:
             LOG.error('connection failed: %s' % exc)
             time.sleep(interval)
 
 
+class ResourceVersionTooOld (Exception):
+    pass
+
+
 class ServiceWatcher (object):
     '''A ServiceWatcher is an iterator that watches the Kubernetes API for
-    changes to services, and yields these events as Python dictionaries.'''
+    changes to services, and yields these events as Python dictionaries.
+
+    In list-watch mode (the default) the watcher starts by listing all
+    services, then watches for changes starting from the resourceVersion
+    of the list.  It keeps track of the last resourceVersion it has
+    seen, so that after a disconnect it can resume the watch without
+    missing or replaying events.  If the resourceVersion is too old to
+    resume from, it lists the services again and generates events for
+    the differences from what it has already seen.'''
 
     def __init__(self,
                  reconnect_interval=defaults.reconnect_interval,
-                 kube_endpoint=defaults.kube_endpoint):
+                 kube_endpoint=defaults.kube_endpoint,
+                 client=None,
+                 list_watch=True,
+                 read_size=defaults.stream_read_size):
         super(ServiceWatcher, self).__init__()
 
+        if client is None:
+            client = kiwiclient.Client()
+
         self.kube_api = '%s/api/v1beta1' % kube_endpoint
         self.reconnect_interval = reconnect_interval
+        self.client = client
+        self.list_watch = list_watch
+        self.read_size = read_size
 
-    def __iter__(self):
-        url = '%s/watch/services' % self.kube_api
+        self.services = {}
+        self.resource_version = None
 
-        for event in iter_events(url, interval=self.reconnect_interval):
+    def __iter__(self):
+        if self.list_watch:
+            events = self.iter_list_watch()
+        else:
+            events = iter_events('%s/watch/services' % self.kube_api,
+                                 interval=self.reconnect_interval,
+                                 client=self.client,
+                                 read_size=self.read_size)
+
+        for event in events:
             service = event['object']
             LOG.debug('received %s for %s',
                       event['type'],
                       service['id'])
 
             handler = getattr(self,
-                              'handle_%s' % event['type'].lower())
+                              'handle_%s' % event['type'].lower(), None)
 
             # we log missing handlers at debug level because we probably
             # intentionally have not written a handler for the event.
@@ -72,6 +99,95 @@ class ServiceWatcher (object):
 
             yield(handler(service))
 
+    def iter_list_watch(self):
+        '''Generates an infinite stream of Kubernetes events, resuming
+        the watch from the last seen resourceVersion after errors.'''
+
+        url = '%s/watch/services' % self.kube_api
+
+        while True:
+            try:
+                if self.resource_version is None:
+                    for event in self.relist():
+                        yield event
+
+                LOG.debug('watching services from resourceVersion %s',
+                          self.resource_version)
+                r = self.client.get(
+                    url,
+                    params={'resourceVersion': self.resource_version},
+                    stream=True,
+                    timeout=(self.client.connect_timeout, None))
+                if r.status_code == 410:
+                    raise ResourceVersionTooOld(self.resource_version)
+                r.raise_for_status()
+
+                for event in iter_request_events(r.raw,
+                                                 read_size=self.read_size):
+                    if event['type'] == 'ERROR':
+                        status = event['object']
+                        if status.get('code') == 410:
+                            raise ResourceVersionTooOld(
+                                self.resource_version)
+                        raise ValueError(status.get('message', status))
+
+                    self.track(event)
+                    yield event
+            except ResourceVersionTooOld as exc:
+                LOG.warn('resourceVersion %s is too old, relisting', exc)
+                self.resource_version = None
+            except Exception as exc:
+                LOG.error('connection failed: %s' % exc)
+                time.sleep(self.reconnect_interval)
+
+    def track(self, event):
+        '''Record the service and resourceVersion from an event.'''
+
+        service = event['object']
+        if event['type'] == 'DELETED':
+            self.services.pop(service['id'], None)
+        else:
+            self.services[service['id']] = service
+
+        if service.get('resourceVersion') is not None:
+            self.resource_version = service['resourceVersion']
+
+    def list_services(self):
+        '''Return a (services, resourceVersion) tuple with the current
+        list of services.'''
+
+        r = self.client.get('%s/services' % self.kube_api)
+        r.raise_for_status()
+        data = r.json()
+        return data.get('items') or [], data.get('resourceVersion')
+
+    def relist(self):
+        '''List all services, and return a list of synthetic events
+        describing how they differ from the services we already know
+        about.'''
+
+        items, resource_version = self.list_services()
+        LOG.info('listed %d services at resourceVersion %s',
+                 len(items), resource_version)
+
+        services = dict((service['id'], service) for service in items)
+        events = []
+        for id, service in services.items():
+            old = self.services.get(id)
+            if old is None:
+                events.append({'type': 'ADDED', 'object': service})
+            elif (old.get('resourceVersion') !=
+                  service.get('resourceVersion')):
+                events.append({'type': 'MODIFIED', 'object': service})
+
+        for id, service in self.services.items():
+            if id not in services:
+                events.append({'type': 'DELETED', 'object': service})
+
+        self.services = services
+        self.resource_version = resource_version
+        return events
+
     def handle_added(self, service):
         return({'message': 'add-service',
                 'target': service['id'],
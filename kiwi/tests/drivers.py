@@ -0,0 +1,70 @@
+'''Interface and firewall drivers that record the changes kiwi asks
+for instead of making them, for tests and benchmarks that run without
+privileges.'''
+
+import collections
+import contextlib
+import threading
+
+
+class RecordingInterface(object):
+    def __init__(self):
+        self.addresses = set()
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+
+    def add_address(self, address, lft=None):
+        with self.lock:
+            self.calls['add'] += 1
+            self.addresses.add(address)
+
+    def refresh_address(self, address, lft=None):
+        with self.lock:
+            self.calls['refresh'] += 1
+
+    def remove_address(self, address):
+        with self.lock:
+            self.calls['remove'] += 1
+            self.addresses.discard(address)
+
+    def adopt_address(self, address):
+        return False
+
+    def prune(self):
+        pass
+
+    def close(self):
+        pass
+
+    def cleanup(self):
+        with self.lock:
+            self.addresses.clear()
+
+
+class RecordingFirewall(object):
+    def __init__(self):
+        self.rules = set()
+        self.calls = collections.Counter()
+
+    def rule_for(self, address, service):
+        return (address, service['protocol'], service['port'],
+                service['id'])
+
+    def add_service(self, address, service):
+        self.calls['add'] += 1
+        self.rules.add(self.rule_for(address, service))
+
+    def remove_service(self, address, service):
+        self.calls['remove'] += 1
+        self.rules.discard(self.rule_for(address, service))
+
+    @contextlib.contextmanager
+    def batch(self):
+        self.calls['batch'] += 1
+        yield
+
+    def prune(self):
+        pass
+
+    def cleanup(self):
+        self.rules.clear()
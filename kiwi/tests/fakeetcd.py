@@ -0,0 +1,362 @@
+'''An in-process stand-in for the etcd v2 keys API.
+
+This implements just enough of etcd's semantics for testing kiwi: keys
+with TTLs that expire, prevExist/prevValue conditions on PUT and
+DELETE, recursive GETs of directories, and wait/waitIndex watches with
+a bounded event history.'''
+
+import collections
+import heapq
+import json
+import socket
+import sys
+import threading
+import time
+
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+from six.moves.urllib.parse import urlsplit, parse_qs
+
+ERR_KEY_NOT_FOUND = 100
+ERR_TEST_FAILED = 101
+ERR_NODE_EXIST = 105
+ERR_EVENT_INDEX_CLEARED = 401
+
+
+class EtcdError(Exception):
+    def __init__(self, status, code, message, cause):
+        self.status = status
+        self.code = code
+        self.message = message
+        self.cause = cause
+
+
+class FakeEtcd(object):
+    def __init__(self, history=1000, expire_interval=0.05):
+        self.nodes = {}
+        self.expirations = []
+        self.index = 0
+        self.events = collections.deque(maxlen=history)
+        self.watchers = []
+        self.cond = threading.Condition()
+        self.expire_interval = expire_interval
+        self.requests = collections.Counter()
+        self.responses = collections.Counter()
+        self.stopped = False
+        self.server = None
+
+    def start(self):
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.etcd = self
+        self.endpoint = 'http://127.0.0.1:%d' % self.server.server_port
+
+        for target in [self.serve, self.expire_loop]:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+        return self
+
+    def serve(self):
+        self.server.serve_forever(poll_interval=0.05)
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+        self.server.shutdown()
+        self.server.server_close()
+
+    def expire_loop(self):
+        while not self.stopped:
+            time.sleep(self.expire_interval)
+            with self.cond:
+                self.expire_keys()
+
+    # The methods below must be called with self.cond held.
+
+    def expire_keys(self, now=None):
+        now = time.time() if now is None else now
+        while self.expirations and self.expirations[0][0] <= now:
+            expiration, key = heapq.heappop(self.expirations)
+
+            # the key may have been deleted or given a new TTL since.
+            node = self.nodes.get(key)
+            if node is not None and node['expiration'] == expiration:
+                self.remove(key, 'expire')
+
+    def owners(self, prefix):
+        '''Return a dict mapping each key under prefix to its value and
+        expiration time (None if it has no TTL).'''
+        prefix = prefix.rstrip('/') + '/'
+        with self.cond:
+            return dict((key, (node['value'], node['expiration']))
+                        for key, node in self.nodes.items()
+                        if key.startswith(prefix))
+
+    def expire(self, key):
+        '''Expire a key immediately, as if its TTL had run out.'''
+        with self.cond:
+            self.remove(key, 'expire')
+
+    def record(self, action, node, prev=None):
+        self.index += 1
+        node['modifiedIndex'] = self.index
+        event = {'action': action, 'node': self.render(node)}
+        if prev is not None:
+            event['prevNode'] = self.render(prev)
+        self.events.append((self.index, event))
+
+        # like etcd, hand the event to waiting watches as it happens,
+        # so they see it even if it leaves the history before they
+        # wake up.
+        for watcher in self.watchers:
+            if watcher['event'] is None and self.matches(watcher, event):
+                watcher['event'] = event
+
+        self.cond.notify_all()
+        return event
+
+    def remove(self, key, action):
+        prev = self.nodes.pop(key)
+        node = {'key': key, 'createdIndex': prev['createdIndex'],
+                'value': None, 'expiration': None}
+        return self.record(action, node, prev)
+
+    def render(self, node):
+        out = {'key': node['key'],
+               'modifiedIndex': node.get('modifiedIndex'),
+               'createdIndex': node['createdIndex']}
+        if node['value'] is not None:
+            out['value'] = node['value']
+        if node['expiration'] is not None:
+            out['ttl'] = max(1, int(node['expiration'] - time.time()))
+        return out
+
+    def error(self, status, code, message, cause):
+        raise EtcdError(status, code, message, cause)
+
+    def put(self, key, value, ttl=None, prevExist=None, prevValue=None):
+        prev = self.nodes.get(key)
+
+        if prevExist == 'false' and prev is not None:
+            self.error(412, ERR_NODE_EXIST, 'Key already exists', key)
+        if (prevExist == 'true' or prevValue is not None) and prev is None:
+            self.error(404, ERR_KEY_NOT_FOUND, 'Key not found', key)
+        if prevValue is not None and prev['value'] != prevValue:
+            self.error(412, ERR_TEST_FAILED, 'Compare failed',
+                       '[%s != %s]' % (prevValue, prev['value']))
+
+        if prevExist == 'false':
+            action = 'create'
+        elif prevValue is not None:
+            action = 'compareAndSwap'
+        else:
+            action = 'set'
+
+        node = {'key': key, 'value': value,
+                'createdIndex': (prev['createdIndex'] if prev
+                                 else self.index + 1),
+                'expiration': (time.time() + int(ttl)) if ttl else None}
+        self.nodes[key] = node
+        if node['expiration'] is not None:
+            heapq.heappush(self.expirations, (node['expiration'], key))
+
+        return (201 if action == 'create' else 200,
+                self.record(action, node, prev))
+
+    def delete(self, key, prevValue=None):
+        prev = self.nodes.get(key)
+        if prev is None:
+            self.error(404, ERR_KEY_NOT_FOUND, 'Key not found', key)
+        if prevValue is not None and prev['value'] != prevValue:
+            self.error(412, ERR_TEST_FAILED, 'Compare failed',
+                       '[%s != %s]' % (prevValue, prev['value']))
+
+        action = 'compareAndDelete' if prevValue is not None else 'delete'
+        return 200, self.remove(key, action)
+
+    def get(self, key, recursive=False):
+        if key in self.nodes:
+            return 200, {'action': 'get',
+                         'node': self.render(self.nodes[key])}
+
+        prefix = key.rstrip('/') + '/'
+        children = sorted(k for k in self.nodes if k.startswith(prefix))
+        if not children:
+            self.error(404, ERR_KEY_NOT_FOUND, 'Key not found', key)
+
+        return 200, {'action': 'get',
+                     'node': self.render_dir(key.rstrip('/'), children,
+                                             recursive)}
+
+    def render_dir(self, key, children, recursive):
+        prefix = key + '/'
+        nodes = []
+        subdirs = collections.OrderedDict()
+        for child in children:
+            name = child[len(prefix):]
+            if '/' in name:
+                subdirs.setdefault(prefix + name.split('/')[0],
+                                   []).append(child)
+            else:
+                nodes.append(self.render(self.nodes[child]))
+
+        for subdir, grandchildren in subdirs.items():
+            node = {'key': subdir, 'dir': True}
+            if recursive:
+                node = self.render_dir(subdir, grandchildren, recursive)
+            nodes.append(node)
+
+        return {'key': key, 'dir': True, 'nodes': nodes}
+
+    def matches(self, watcher, event):
+        evkey = event['node']['key']
+        return (evkey == watcher['key'] or
+                (watcher['recursive'] and
+                 evkey.startswith(watcher['key'].rstrip('/') + '/')))
+
+    def watch(self, key, recursive=False, waitIndex=None, timeout=None):
+        '''Return the first event at or after waitIndex that affects
+        key, waiting for one if there is none in the history yet.
+        Returns None if the wait times out.
+
+        As with etcd, a waitIndex older than the history is an error
+        only when the watch starts.  Once it is waiting, a watch gets
+        the next matching event no matter how many others follow.'''
+
+        if waitIndex is None:
+            waitIndex = self.index + 1
+
+        if self.events and waitIndex < self.events[0][0]:
+            self.error(400, ERR_EVENT_INDEX_CLEARED,
+                       'The event in requested index is outdated '
+                       'and cleared',
+                       'the requested history has been cleared '
+                       '[%d/%d]' % (self.events[0][0], waitIndex))
+
+        watcher = {'key': key, 'recursive': recursive, 'event': None}
+        for index, event in self.events:
+            if index >= waitIndex and self.matches(watcher, event):
+                return 200, event
+
+        deadline = None if timeout is None else time.time() + timeout
+        self.watchers.append(watcher)
+        try:
+            while not self.stopped and watcher['event'] is None:
+                remaining = (None if deadline is None
+                             else deadline - time.time())
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.cond.wait(remaining if remaining is not None else 1)
+        finally:
+            self.watchers.remove(watcher)
+
+        if watcher['event'] is None:
+            return None
+
+        return 200, watcher['event']
+
+
+class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # clients (such as agents killed by a benchmark) may drop their
+        # connections at any time.
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(
+                self, request, client_address)
+
+
+def truthy(value):
+    return value is not None and value.lower() == 'true'
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def parse(self):
+        parts = urlsplit(self.path)
+        if not parts.path.startswith('/v2/keys'):
+            self.send_json(404, {'message': 'not found'})
+            return None, None
+
+        params = dict((k, v[-1]) for k, v in
+                      parse_qs(parts.query).items())
+        length = int(self.headers.get('content-length') or 0)
+        if length:
+            body = self.rfile.read(length)
+            params.update((k, v[-1]) for k, v in
+                          parse_qs(body.decode('utf-8')).items())
+
+        return parts.path[len('/v2/keys'):] or '/', params
+
+    def dispatch(self, method):
+        key, params = self.parse()
+        if key is None:
+            return
+
+        etcd = self.server.etcd
+        etcd.requests[method] += 1
+        try:
+            with etcd.cond:
+                etcd.expire_keys()
+                if method == 'PUT':
+                    res = etcd.put(key, params.get('value'),
+                                   ttl=params.get('ttl'),
+                                   prevExist=params.get('prevExist'),
+                                   prevValue=params.get('prevValue'))
+                elif method == 'DELETE':
+                    res = etcd.delete(key,
+                                      prevValue=params.get('prevValue'))
+                elif truthy(params.get('wait')):
+                    waitIndex = params.get('waitIndex')
+                    res = etcd.watch(key,
+                                     recursive=truthy(
+                                         params.get('recursive')),
+                                     waitIndex=(int(waitIndex)
+                                                if waitIndex else None))
+                    if res is None:
+                        return
+                else:
+                    res = etcd.get(key,
+                                   recursive=truthy(
+                                       params.get('recursive')))
+                index = etcd.index
+        except EtcdError as exc:
+            etcd.responses[method, exc.status] += 1
+            self.send_json(exc.status, {'errorCode': exc.code,
+                                        'message': exc.message,
+                                        'cause': exc.cause,
+                                        'index': etcd.index},
+                           index=etcd.index)
+        else:
+            etcd.responses[method, res[0]] += 1
+            self.send_json(res[0], res[1], index=index)
+
+    def send_json(self, status, data, index=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if index is not None:
+            self.send_header('X-Etcd-Index', str(index))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
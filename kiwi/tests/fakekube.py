@@ -0,0 +1,173 @@
+'''An in-process stand-in for the Kubernetes v1beta1 services API.
+
+This serves a list of services and a watch that streams chunked JSON
+events from a given resourceVersion, which is what kiwi's
+ServiceWatcher consumes.  Watches that ask for a resourceVersion older
+than the retained history get a 410, as with a real API server.'''
+
+import collections
+import json
+import socket
+import sys
+import threading
+
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+from six.moves.urllib.parse import urlsplit, parse_qs
+
+
+class FakeKube(object):
+    def __init__(self, history=100000):
+        self.services = {}
+        self.version = 0
+        self.events = collections.deque(maxlen=history)
+        self.cond = threading.Condition()
+        self.watchers = 0
+        self.stopped = False
+        self.server = None
+
+    def start(self):
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.kube = self
+        self.endpoint = 'http://127.0.0.1:%d' % self.server.server_port
+
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+
+        return self
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+        self.server.shutdown()
+        self.server.server_close()
+
+    def record(self, kind, service):
+        with self.cond:
+            self.version += 1
+            service = dict(service, resourceVersion=self.version)
+            if kind == 'DELETED':
+                self.services.pop(service['id'], None)
+            else:
+                self.services[service['id']] = service
+
+            self.events.append((self.version,
+                                {'type': kind, 'object': service}))
+            self.cond.notify_all()
+
+    def add(self, service):
+        self.record('ADDED', service)
+
+    def modify(self, service):
+        self.record('MODIFIED', service)
+
+    def delete(self, service):
+        self.record('DELETED', service)
+
+    def list(self):
+        with self.cond:
+            return {'kind': 'ServiceList',
+                    'resourceVersion': self.version,
+                    'items': list(self.services.values())}
+
+    def pending(self, since):
+        '''Return the events after resourceVersion `since`, waiting for
+        at least one.  Returns an empty list if we are stopping, or if
+        the history no longer reaches back that far.  Must be called
+        with self.cond held.'''
+
+        while not self.stopped:
+            if self.events and since < self.events[0][0] - 1:
+                return []
+
+            events = [event for version, event in self.events
+                      if version > since]
+            if events:
+                return events
+
+            self.cond.wait(1)
+
+        return []
+
+
+class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # clients (such as agents killed by a benchmark) may drop their
+        # connections at any time.
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(
+                self, request, client_address)
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        params = dict((k, v[-1]) for k, v in parse_qs(parts.query).items())
+        kube = self.server.kube
+
+        if parts.path == '/api/v1beta1/services':
+            self.send_json(200, kube.list())
+        elif parts.path == '/api/v1beta1/watch/services':
+            since = params.get('resourceVersion')
+            self.watch(int(since) if since else kube.version)
+        else:
+            self.send_json(404, {'message': 'not found'})
+
+    def watch(self, since):
+        kube = self.server.kube
+
+        with kube.cond:
+            if kube.events and since < kube.events[0][0] - 1:
+                self.send_json(410, {'code': 410,
+                                     'message': 'too old resource version'})
+                return
+            kube.watchers += 1
+
+        # like the API server, send the headers before any events.
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        try:
+            while True:
+                with kube.cond:
+                    events = kube.pending(since)
+                if not events:
+                    break
+
+                chunks = []
+                for event in events:
+                    data = json.dumps(event) + '\n'
+                    chunks.append('%x\r\n%s\r\n' % (len(data), data))
+                    since = event['object']['resourceVersion']
+
+                self.wfile.write(''.join(chunks).encode('utf-8'))
+        except socket.error:
+            pass
+        finally:
+            with kube.cond:
+                kube.watchers -= 1
+
+        self.close_connection = 1
@@ -0,0 +1,108 @@
+#!/usr/bin/python
+
+import threading
+import time
+import unittest
+import Queue
+
+from kiwi import addresswatcher
+from kiwi import client
+from kiwi.tests import fakeetcd
+
+
+class TestAddressWatcher(unittest.TestCase):
+    def test_renewal(self):
+        watcher = addresswatcher.AddressWatcher()
+        node = {'key': '/kiwi/publicips/10.0.0.1', 'value': 'a'}
+        assert watcher.is_renewal({'action': 'compareAndSwap',
+                                   'node': node,
+                                   'prevNode': dict(node)})
+        assert not watcher.is_renewal({'action': 'compareAndSwap',
+                                       'node': node,
+                                       'prevNode': dict(node, value='b')})
+        assert not watcher.is_renewal({'action': 'set', 'node': node})
+
+
+class TestIterEvents(unittest.TestCase):
+    def setUp(self):
+        self.etcd = fakeetcd.FakeEtcd(history=5).start()
+        self.client = client.Client()
+        self.url = '%s/v2/keys/kiwi/publicips' % self.etcd.endpoint
+
+    def tearDown(self):
+        self.client.close()
+        self.etcd.stop()
+
+    def put(self, address, value):
+        with self.etcd.cond:
+            self.etcd.put('/kiwi/publicips/%s' % address, value)
+
+    def delete(self, address):
+        with self.etcd.cond:
+            self.etcd.delete('/kiwi/publicips/%s' % address)
+
+    def test_watch_outlives_history(self):
+        # a watch that is already waiting gets the next event, even if
+        # more events than the history holds follow it.
+        result = []
+
+        def watch():
+            with self.etcd.cond:
+                result.append(self.etcd.watch('/kiwi/publicips',
+                                              recursive=True, timeout=5))
+
+        thread = threading.Thread(target=watch)
+        thread.start()
+        while not self.etcd.watchers:
+            time.sleep(0.01)
+
+        with self.etcd.cond:
+            for i in range(10):
+                self.etcd.put('/kiwi/publicips/10.0.1.%d' % i, 'b')
+
+        thread.join()
+        status, event = result[0]
+        assert event['node']['key'] == '/kiwi/publicips/10.0.1.0'
+
+    def test_resync_after_index_cleared(self):
+        self.put('10.0.0.1', 'a')
+        self.put('10.0.0.2', 'a')
+
+        q = Queue.Queue()
+        thread = threading.Thread(target=lambda: [
+            q.put(event) for event in addresswatcher.iter_events(
+                self.url, interval=1, client=self.client)])
+        thread.daemon = True
+        thread.start()
+
+        # give the watcher time to take its initial snapshot.
+        time.sleep(0.2)
+        self.put('10.0.0.3', 'a')
+        event = q.get(timeout=5)
+        assert event['action'] == 'set'
+        assert event['node']['key'] == '/kiwi/publicips/10.0.0.3'
+
+        # generate more changes than the etcd history will hold, so
+        # that the watch after the next event finds its index cleared.
+        cleared = self.etcd.responses['GET', 400]
+        with self.etcd.cond:
+            self.etcd.delete('/kiwi/publicips/10.0.0.1')
+            self.etcd.put('/kiwi/publicips/10.0.0.2', 'b')
+            for i in range(10):
+                self.etcd.put('/kiwi/publicips/10.0.1.%d' % i, 'b')
+            self.etcd.delete('/kiwi/publicips/10.0.1.0')
+
+        changes = sorted((event['action'], event['node']['key'])
+                         for event in [q.get(timeout=5)
+                                       for i in range(11)])
+        assert changes == sorted(
+            [('delete', '/kiwi/publicips/10.0.0.1'),
+             ('set', '/kiwi/publicips/10.0.0.2')] +
+            [('create', '/kiwi/publicips/10.0.1.%d' % i)
+             for i in range(1, 10)])
+        assert self.etcd.responses['GET', 400] > cleared
+
+        # and we continue watching from the snapshot.
+        self.put('10.0.2.1', 'c')
+        event = q.get(timeout=5)
+        assert event['node']['key'] == '/kiwi/publicips/10.0.2.1'
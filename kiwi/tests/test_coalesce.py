@@ -0,0 +1,63 @@
+#!/usr/bin/python
+
+import unittest
+
+from kiwi.coalesce import coalesce
+
+
+def service(message, port=80, addresses=('10.0.0.1',), id='web'):
+    return {'message': '%s-service' % message,
+            'target': id,
+            'service': {'id': id,
+                        'port': port,
+                        'protocol': 'TCP',
+                        'publicIPs': list(addresses)}}
+
+
+def address(message, address, owner):
+    return {'message': '%s-address' % message,
+            'target': address,
+            'address': address,
+            'node': {'value': owner}}
+
+
+def messages(msgs):
+    return [(msg['message'], msg['target']) for msg in msgs]
+
+
+class TestCoalesce(unittest.TestCase):
+    def test_add_then_delete(self):
+        assert coalesce([service('add'), service('delete')]) == []
+
+    def test_add_then_update(self):
+        out = coalesce([service('add'), service('update', port=81)])
+        assert messages(out) == [('add-service', 'web')]
+        assert out[0]['service']['port'] == 81
+
+    def test_recreate_unchanged(self):
+        assert coalesce([service('delete'), service('add')]) == []
+
+    def test_recreate_changed(self):
+        out = coalesce([service('delete'), service('add', port=81)])
+        assert messages(out) == [('update-service', 'web')]
+        assert out[0]['service']['port'] == 81
+
+    def test_updates(self):
+        out = coalesce([service('update', port=port)
+                        for port in range(81, 90)])
+        assert messages(out) == [('update-service', 'web')]
+        assert out[0]['service']['port'] == 89
+
+    def test_targets_are_independent(self):
+        out = coalesce([service('add', id='a'),
+                        service('add', id='b'),
+                        service('delete', id='a'),
+                        address('set', '10.0.0.1', 'other'),
+                        address('delete', '10.0.0.1', None),
+                        service('update', id='b', port=81)])
+        assert messages(out) == [('delete-address', '10.0.0.1'),
+                                 ('add-service', 'b')]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,393 @@
+#!/usr/bin/python
+
+import unittest
+import mock
+
+from kiwi import firewall
+from kiwi import iptables
+
+existing_rules = [
+    '-d 10.0.0.1/32 -p tcp -m tcp --dport 80 -m comment --comment web '
+    '-j MARK --set-xmark 0x1/0xffffffff',
+    '-d 10.0.0.2/32 -p tcp -m tcp --dport 80 -m comment --comment old '
+    '-j MARK --set-xmark 0x1/0xffffffff',
+    '-d 10.0.0.3/32 -p udp -m udp --dport 53 -m comment --comment dns '
+    '-j MARK --set-xmark 0x2/0xffffffff',
+]
+
+
+def service(id, port=80, protocol='TCP'):
+    return {'id': id, 'port': port, 'protocol': protocol}
+
+
+class TestReconcile(unittest.TestCase):
+    def setUp(self):
+        self.chain = mock.Mock()
+        self.chain.rules.return_value = [iptables.Rule(rule)
+                                         for rule in existing_rules]
+        self.table = mock.MagicMock()
+        self.table.chains = {'KUBE-PUBLIC': self.chain}
+
+    def test_flush_without_reconcile(self):
+        fw = firewall.Firewall(table=self.table)
+        assert self.chain.flush.called
+        assert fw.existing == {}
+
+    def test_adopt_and_prune(self):
+        fw = firewall.Firewall(table=self.table, reconcile=True)
+        assert not self.chain.flush.called
+
+        fw.add_service('10.0.0.1', service('web'))
+        fw.add_service('10.0.0.4', service('new'))
+        assert self.chain.append.call_args_list == [
+            mock.call(fw.rule_for('10.0.0.4', service('new')))]
+        assert fw.rule_for('10.0.0.1', service('web')) in fw.rules
+
+        # the rule for 'old' is no longer wanted, and the rule for
+        # 'dns' has a different mark.
+        fw.prune()
+        deleted = sorted(str(args[0])
+                         for args, kwargs in self.chain.delete.call_args_list)
+        assert deleted == sorted(existing_rules[1:])
+
+    def test_remove_adopted(self):
+        fw = firewall.Firewall(table=self.table, reconcile=True)
+        fw.add_service('10.0.0.1', service('web'))
+        fw.remove_service('10.0.0.1', service('web'))
+        self.chain.delete.assert_called_with(
+            fw.rule_for('10.0.0.1', service('web')))
+
+
+class FakeTable(iptables.Table):
+    '''A mangle table whose iptables command lists the given chains
+    and that records every modification, whether or not it is made in
+    a batch.'''
+
+    def __init__(self, chains):
+        super(FakeTable, self).__init__('mangle')
+        self.saved = chains
+        self.commands = []
+        self.iptables = self.fake_iptables
+        self.iptables_restore = self.fake_iptables_restore
+
+    def fake_iptables_restore(self, *args, **kwargs):
+        self.commands.extend(kwargs['input'].splitlines()[1:-1])
+
+    def fake_iptables(self, *args):
+        if args[0] != '-S':
+            self.commands.append(' '.join(args))
+            return ''
+
+        names = args[1:] or sorted(self.saved)
+        return ''.join(
+            '-N %s\n' % name +
+            ''.join('-A %s %s\n' % (name, rule)
+                    for rule in self.saved.get(name, []))
+            for name in names)
+
+    def changes(self):
+        commands, self.commands = self.commands, []
+        return commands
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.table = FakeTable({'KUBE-PUBLIC': []})
+        self.fw = firewall.Firewall(table=self.table)
+
+    def fail(self, *args, **kwargs):
+        raise iptables.CommandError(args, 1, '', 'failed')
+
+    def test_failed_delete(self):
+        web = self.fw.rule_for('10.0.0.1', service('web'))
+        www = self.fw.rule_for('10.0.0.1', service('www', 81))
+        self.fw.add_service('10.0.0.1', service('web'))
+
+        def iptables(*args):
+            if args[0] == '-D':
+                self.fail(*args)
+            return self.table.fake_iptables(*args)
+
+        self.table.iptables_restore = self.fail
+        self.table.iptables = iptables
+        with self.assertRaises(firewall.FirewallDriverError):
+            with self.fw.batch():
+                self.fw.remove_service('10.0.0.1', service('web'))
+                self.fw.add_service('10.0.0.1', service('www', 81))
+
+        assert self.fw.rules == set([web, www])
+
+    def test_abort(self):
+        with self.assertRaises(ValueError):
+            with self.fw.batch():
+                self.fw.add_service('10.0.0.1', service('web'))
+                raise ValueError()
+
+        assert self.fw.rules == set()
+        assert self.fw.pending is None
+
+
+class TestLayout(unittest.TestCase):
+    def test_subchain_names(self):
+        fw = firewall.Firewall(table=FakeTable({}), layout='address')
+        assert fw.subchain_for('10.1.2.3') == ('KUBE-PUBLIC-0A010203',
+                                               '10.1.2.3/32')
+
+        fw = firewall.Firewall(table=FakeTable({}), layout='bucket')
+        assert fw.subchain_for('10.1.2.3') == ('KUBE-PUBLIC-0A0102',
+                                               '10.1.2.0/24')
+
+    def test_create_and_collect(self):
+        table = FakeTable({'KUBE-PUBLIC': []})
+        fw = firewall.Firewall(table=table, layout='address')
+        table.changes()
+
+        fw.add_service('10.0.0.1', service('web'))
+        fw.add_service('10.0.0.1', service('dns', 53, 'UDP'))
+        commands = table.changes()
+        assert commands[:2] == [
+            '-N KUBE-PUBLIC-0A000001',
+            '-A KUBE-PUBLIC -d 10.0.0.1/32 -j KUBE-PUBLIC-0A000001']
+        assert [c.split()[1] for c in commands[2:]] == [
+            'KUBE-PUBLIC-0A000001', 'KUBE-PUBLIC-0A000001']
+
+        fw.remove_service('10.0.0.1', service('web'))
+        assert len(table.changes()) == 1
+
+        fw.remove_service('10.0.0.1', service('dns', 53, 'UDP'))
+        assert table.changes()[1:] == [
+            '-D KUBE-PUBLIC -d 10.0.0.1/32 -j KUBE-PUBLIC-0A000001',
+            '-F KUBE-PUBLIC-0A000001',
+            '-X KUBE-PUBLIC-0A000001']
+        assert fw.members == {}
+
+    def fail_on(self, table, command):
+        def iptables_restore(*args, **kwargs):
+            if command in kwargs['input'].splitlines():
+                raise iptables.CommandError(args, 1, '', 'failed')
+            table.fake_iptables_restore(*args, **kwargs)
+
+        table.iptables_restore = iptables_restore
+
+    def test_failed_create(self):
+        table = FakeTable({'KUBE-PUBLIC': []})
+        fw = firewall.Firewall(table=table, layout='address')
+        table.changes()
+
+        self.fail_on(table, '-N KUBE-PUBLIC-0A000001')
+        with self.assertRaises(firewall.FirewallDriverError):
+            fw.add_service('10.0.0.1', service('web'))
+        assert fw.members == {}
+        assert fw.rules == set()
+        assert 'KUBE-PUBLIC-0A000001' not in fw.chains
+
+        table.iptables_restore = table.fake_iptables_restore
+        fw.add_service('10.0.0.1', service('web'))
+        assert table.changes()[:2] == [
+            '-N KUBE-PUBLIC-0A000001',
+            '-A KUBE-PUBLIC -d 10.0.0.1/32 -j KUBE-PUBLIC-0A000001']
+
+    def test_failed_jump(self):
+        table = FakeTable({'KUBE-PUBLIC': []})
+        fw = firewall.Firewall(table=table, layout='address')
+        table.changes()
+
+        jump = '-A KUBE-PUBLIC -d 10.0.0.1/32 -j KUBE-PUBLIC-0A000001'
+        self.fail_on(table, jump)
+        with self.assertRaises(firewall.FirewallDriverError):
+            fw.add_service('10.0.0.1', service('web'))
+        assert fw.members == {}
+        assert fw.rules == set()
+        assert table.changes() == ['-N KUBE-PUBLIC-0A000001']
+
+        # the chain was created, so it is not created again.
+        table.iptables_restore = table.fake_iptables_restore
+        fw.add_service('10.0.0.1', service('web'))
+        commands = table.changes()
+        assert commands[0] == jump
+        assert len(commands) == 2
+        assert fw.members['KUBE-PUBLIC-0A000001'] == fw.rules
+
+    def test_failed_rule(self):
+        table = FakeTable({'KUBE-PUBLIC': []})
+        fw = firewall.Firewall(table=table, layout='address')
+        web = fw.rule_for('10.0.0.1', service('web'))
+        table.changes()
+
+        self.fail_on(table, '-A KUBE-PUBLIC-0A000001 %s' % str(web))
+        with self.assertRaises(firewall.FirewallDriverError):
+            fw.add_service('10.0.0.1', service('web'))
+        assert fw.members == {'KUBE-PUBLIC-0A000001': set()}
+        assert fw.rules == set()
+
+        table.iptables_restore = table.fake_iptables_restore
+        table.changes()
+        fw.add_service('10.0.0.1', service('web'))
+        assert table.changes() == ['-A KUBE-PUBLIC-0A000001 %s' % str(web)]
+        assert fw.members == {'KUBE-PUBLIC-0A000001': set([web])}
+
+    def test_reconcile(self):
+        web = ('-d 10.0.0.1/32 -p tcp -m tcp --dport 80 -m comment '
+               '--comment web -j MARK --set-xmark 0x1/0xffffffff')
+        table = FakeTable({
+            'KUBE-PUBLIC': [
+                '-d 10.0.0.1/32 -j KUBE-PUBLIC-0A000001',
+                '-d 10.0.0.2/32 -j KUBE-PUBLIC-0A000002'],
+            'KUBE-PUBLIC-0A000001': [web, web.replace('web', 'old')],
+            'KUBE-PUBLIC-0A000002': [web.replace('.1/', '.2/')]})
+
+        fw = firewall.Firewall(table=table, layout='address',
+                               reconcile=True)
+        fw.add_service('10.0.0.1', service('web'))
+        assert table.changes() == []
+
+        fw.prune()
+        assert sorted(table.changes()) == sorted([
+            '-D KUBE-PUBLIC-0A000001 %s' % web.replace('web', 'old'),
+            '-D KUBE-PUBLIC-0A000002 %s' % web.replace('.1/', '.2/'),
+            '-D KUBE-PUBLIC -d 10.0.0.2/32 -j KUBE-PUBLIC-0A000002',
+            '-F KUBE-PUBLIC-0A000002',
+            '-X KUBE-PUBLIC-0A000002'])
+
+
+class TestMultiport(unittest.TestCase):
+    def setUp(self):
+        self.table = FakeTable({'KUBE-PUBLIC': []})
+
+    def rule(self, ports, address='10.0.0.1'):
+        return ('-A KUBE-PUBLIC -d %s -p tcp -m multiport --dports %s '
+                '-j MARK --set-mark 1' % (address, ports))
+
+    def test_group_ports(self):
+        fw = firewall.Firewall(table=self.table, multiport=True)
+        self.table.changes()
+
+        fw.add_service('10.0.0.1', service('web', 80))
+        fw.add_service('10.0.0.1', service('https', 443))
+        assert self.table.changes() == [
+            self.rule('80'),
+            self.rule('80,443'),
+            self.rule('80').replace('-A', '-D', 1)]
+
+        # a second service on the same port shares the entry.
+        fw.add_service('10.0.0.1', service('www', 80))
+        fw.remove_service('10.0.0.1', service('web', 80))
+        assert self.table.changes() == []
+
+        fw.remove_service('10.0.0.1', service('www', 80))
+        fw.remove_service('10.0.0.1', service('https', 443))
+        assert self.table.changes() == [
+            self.rule('443'),
+            self.rule('80,443').replace('-A', '-D', 1),
+            self.rule('443').replace('-A', '-D', 1)]
+        assert fw.groups == {}
+        assert fw.rules == set()
+
+    def test_chunks(self):
+        fw = firewall.Firewall(table=self.table, multiport=True)
+        with fw.batch():
+            for port in range(1, 21):
+                fw.add_service('10.0.0.1', service('s%d' % port, port))
+
+        assert sorted(len(chunk['ports'])
+                      for chunk in fw.groups['10.0.0.1', 'tcp']) == [5, 15]
+        assert len(fw.rules) == 2
+
+        # only the rule holding the port is rewritten.
+        self.table.changes()
+        fw.remove_service('10.0.0.1', service('s20', 20))
+        assert self.table.changes() == [
+            self.rule('16,17,18,19'),
+            self.rule('16,17,18,19,20').replace('-A', '-D', 1)]
+
+    def test_batched_burst(self):
+        fw = firewall.Firewall(table=self.table, multiport=True,
+                               layout='address')
+        self.table.changes()
+
+        # each chunk is rendered once, however many of its ports
+        # change.
+        with fw.batch():
+            for port in range(1, 18):
+                fw.add_service('10.0.0.1', service('s%d' % port, port))
+        commands = self.table.changes()
+        assert len(commands) == 4
+        assert commands[:2] == [
+            '-N KUBE-PUBLIC-0A000001',
+            '-A KUBE-PUBLIC -d 10.0.0.1/32 -j KUBE-PUBLIC-0A000001']
+        assert len(fw.members['KUBE-PUBLIC-0A000001']) == 2
+
+        with fw.batch():
+            for port in range(1, 18):
+                fw.remove_service('10.0.0.1', service('s%d' % port, port))
+        assert len(self.table.changes()) == 5
+        assert fw.groups == {}
+        assert fw.rules == set()
+        assert fw.members == {}
+
+        # a port added and removed again changes nothing.
+        fw.add_service('10.0.0.1', service('web', 80))
+        self.table.changes()
+        with fw.batch():
+            fw.add_service('10.0.0.1', service('https', 443))
+            fw.remove_service('10.0.0.1', service('https', 443))
+        assert self.table.changes() == []
+
+    def test_batch_abort(self):
+        fw = firewall.Firewall(table=self.table, multiport=True)
+        fw.add_service('10.0.0.1', service('web', 80))
+        self.table.changes()
+
+        with self.assertRaises(ValueError):
+            with fw.batch():
+                fw.add_service('10.0.0.1', service('https', 443))
+                fw.remove_service('10.0.0.1', service('web', 80))
+                raise ValueError()
+
+        assert self.table.changes() == []
+        [chunk] = fw.groups['10.0.0.1', 'tcp']
+        assert chunk['ports'] == {'80': set(['web'])}
+
+    def test_failed_replace(self):
+        fw = firewall.Firewall(table=self.table, multiport=True)
+        fw.add_service('10.0.0.1', service('web', 80))
+        rule = fw.multiport_rule_for('10.0.0.1', 'tcp', ['80'])
+
+        def fail(*args, **kwargs):
+            raise iptables.CommandError(args, 1, '', 'failed')
+
+        self.table.iptables_restore = fail
+        with self.assertRaises(firewall.FirewallDriverError):
+            fw.add_service('10.0.0.1', service('https', 443))
+        with self.assertRaises(firewall.FirewallDriverError):
+            with fw.batch():
+                fw.add_service('10.0.0.1', service('https', 443))
+        with self.assertRaises(firewall.FirewallDriverError):
+            with fw.batch():
+                fw.remove_service('10.0.0.1', service('web', 80))
+
+        # the old rule is still in place, so we keep its ports.
+        [chunk] = fw.groups['10.0.0.1', 'tcp']
+        assert chunk['ports'] == {'80': set(['web'])}
+        assert chunk['rule'] == rule
+        assert fw.rules == set([rule])
+
+    def test_reconcile(self):
+        table = FakeTable({'KUBE-PUBLIC': [
+            '-d 10.0.0.1/32 -p tcp -m multiport --dports 80,443,8080 '
+            '-j MARK --set-xmark 0x1/0xffffffff']})
+        fw = firewall.Firewall(table=table, multiport=True,
+                               reconcile=True)
+        fw.add_service('10.0.0.1', service('web', 80))
+        fw.add_service('10.0.0.1', service('https', 443))
+        assert table.changes() == []
+
+        fw.prune()
+        assert table.changes() == [
+            self.rule('80,443'),
+            '-D KUBE-PUBLIC -d 10.0.0.1/32 -p tcp -m multiport '
+            '--dports 80,443,8080 -j MARK --set-xmark 0x1/0xffffffff']
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+
+import os
+import subprocess
+import threading
+import unittest
+
+from kiwi import interface
+from kiwi.exc import InterfaceDriverError
+from kiwi.tests.test_netlink import setns
+
+netns = 'kiwi-test-batch-%d' % os.getpid()
+
+
+def ip(*args):
+    return subprocess.check_output(('ip', '-n', netns) + args)
+
+
+class TestBatchInterface(unittest.TestCase):
+    def setUp(self):
+        if os.getuid() != 0:
+            raise unittest.SkipTest('requires root')
+
+        try:
+            subprocess.check_call(['ip', 'netns', 'add', netns])
+        except (OSError, subprocess.CalledProcessError):
+            raise unittest.SkipTest('unable to create network namespace')
+
+        ip('link', 'set', 'lo', 'up')
+
+        # the ip process inherits the namespace it was started in.
+        with open('/proc/self/ns/net') as orig, \
+                open('/var/run/netns/%s' % netns) as target:
+            setns(target.fileno())
+            try:
+                self.iface = interface.BatchInterface('lo')
+                self.iface.start()
+            finally:
+                setns(orig.fileno())
+
+    def tearDown(self):
+        self.iface.stop()
+        subprocess.call(['ip', 'netns', 'del', netns])
+
+    def test_add_remove(self):
+        self.iface.add_address('10.99.1.1', lft=20)
+        self.iface.add_address('10.99.1.2')
+        out = ip('-o', '-4', 'addr', 'show', 'label', 'lo:kube')
+        assert '10.99.1.1/32' in out
+        assert '10.99.1.2/32' in out
+
+        self.iface.remove_address('10.99.1.1')
+        out = ip('-o', '-4', 'addr', 'show', 'label', 'lo:kube')
+        assert '10.99.1.1/32' not in out
+        assert '10.99.1.2/32' in out
+
+    def test_error_maps_to_address(self):
+        self.iface.add_address('10.99.1.1')
+        with self.assertRaises(InterfaceDriverError) as ctx:
+            self.iface.remove_address('10.99.2.1')
+
+        assert ctx.exception.stderr
+
+        # the process keeps going after an error.
+        self.iface.remove_address('10.99.1.1')
+        assert self.iface.proc.poll() is None
+
+
+class TestBatchTimeout(unittest.TestCase):
+    def test_restart_after_timeout(self):
+        # skip __init__, which would look for existing addresses.
+        iface = interface.BatchInterface.__new__(interface.BatchInterface)
+        iface.serial = 0
+        iface.timeout = 0.1
+        iface.buffered = ''
+        iface.lock = threading.Lock()
+
+        # a process that never answers.
+        iface.proc = hung = subprocess.Popen(['sleep', '60'],
+                                             stdin=subprocess.PIPE,
+                                             stderr=subprocess.PIPE)
+
+        with self.assertRaises(InterfaceDriverError):
+            iface.ip('addr', 'show')
+
+        assert hung.poll() is not None
+        assert iface.proc is None
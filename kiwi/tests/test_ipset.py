@@ -0,0 +1,112 @@
+#!/usr/bin/python
+
+import unittest
+import mock
+
+from kiwi import ipset
+from kiwi import iptables
+
+saved_set = '''create kiwi-public hash:ip,port family inet hashsize 1024
+add kiwi-public 10.0.0.1,tcp:80
+add kiwi-public 10.0.0.2,tcp:80
+'''
+
+
+def service(id, port=80, protocol='TCP'):
+    return {'id': id, 'port': port, 'protocol': protocol}
+
+
+class TestIPSet(unittest.TestCase):
+    def test_entries(self):
+        s = ipset.IPSet('kiwi-public')
+        s.ipset = mock.Mock(return_value=saved_set)
+        assert s.entries() == ['10.0.0.1,tcp:80', '10.0.0.2,tcp:80']
+
+    def test_restore(self):
+        s = ipset.IPSet('kiwi-public')
+        s.ipset = mock.Mock()
+        s.restore([('add', '10.0.0.1,tcp:80'), ('del', '10.0.0.2,udp:53')])
+        s.ipset.assert_called_once_with(
+            '-exist', 'restore',
+            input='add kiwi-public 10.0.0.1,tcp:80\n'
+                  'del kiwi-public 10.0.0.2,udp:53\n')
+
+
+class TestIPSetFirewall(unittest.TestCase):
+    def setUp(self):
+        self.chain = mock.Mock()
+        self.chain.rules.return_value = [iptables.Rule(
+            '-m set --match-set kiwi-public dst,dst '
+            '-j MARK --set-xmark 0x1/0xffffffff')]
+        self.table = mock.MagicMock()
+        self.table.chains = {'KUBE-PUBLIC': self.chain}
+        self.set = mock.Mock()
+        self.set.name = 'kiwi-public'
+        self.set.entries.return_value = ['10.0.0.1,tcp:80',
+                                         '10.0.0.2,tcp:80']
+
+    def changes(self):
+        changes = [change for args, kwargs
+                   in self.set.restore.call_args_list
+                   for change in args[0]]
+        self.set.restore.reset_mock()
+        return changes
+
+    def test_single_rule(self):
+        fw = ipset.IPSetFirewall(table=self.table, ipset=self.set)
+        assert self.chain.flush.called
+        assert self.set.flush.called
+        self.chain.append.assert_called_once_with(fw.match_rule())
+
+    def test_refcount(self):
+        fw = ipset.IPSetFirewall(table=self.table, ipset=self.set)
+        fw.add_service('10.0.0.1', service('web'))
+        fw.add_service('10.0.0.1', service('www'))
+        assert self.changes() == [('add', '10.0.0.1,tcp:80')]
+
+        fw.remove_service('10.0.0.1', service('web'))
+        assert self.changes() == []
+        fw.remove_service('10.0.0.1', service('www'))
+        assert self.changes() == [('del', '10.0.0.1,tcp:80')]
+
+    def test_batch(self):
+        fw = ipset.IPSetFirewall(table=self.table, ipset=self.set)
+        with fw.batch():
+            for i in range(3):
+                fw.add_service('10.0.0.%d' % i, service('web'))
+
+        self.set.restore.assert_called_once_with(
+            [('add', '10.0.0.%d,tcp:80' % i) for i in range(3)])
+
+    def test_batch_failure(self):
+        fw = ipset.IPSetFirewall(table=self.table, ipset=self.set)
+
+        def restore(changes):
+            if len(changes) > 1 or changes[0][1].startswith('10.0.0.2'):
+                raise iptables.CommandError(['ipset'], 1, '', 'failed')
+
+        self.set.restore.side_effect = restore
+        with self.assertRaises(ipset.FirewallDriverError):
+            with fw.batch():
+                for i in range(3):
+                    fw.add_service('10.0.0.%d' % i, service('web'))
+
+        assert sorted(fw.entries) == ['10.0.0.0,tcp:80', '10.0.0.1,tcp:80']
+
+    def test_adopt_and_prune(self):
+        fw = ipset.IPSetFirewall(table=self.table, ipset=self.set,
+                                 reconcile=True)
+        assert not self.chain.flush.called
+        assert not self.chain.append.called
+
+        fw.add_service('10.0.0.1', service('web'))
+        fw.add_service('10.0.0.3', service('new'))
+        assert self.changes() == [('add', '10.0.0.3,tcp:80')]
+
+        fw.prune()
+        assert self.changes() == [('del', '10.0.0.2,tcp:80')]
+        assert not self.chain.delete.called
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -136,3 +136,119 @@ class TestChains(unittest.TestCase):
                                        'filter', '-C', 'INPUT') + rule,
                                       stdout=subprocess.PIPE,
                                       stderr=subprocess.PIPE)
+
+
+class TestBatch(unittest.TestCase):
+    @mock.patch('subprocess.Popen')
+    def test_batch_commit(self, mock_popen):
+        mock_popen_return = mock.Mock()
+        attrs = {
+            'communicate.return_value': ('', ''),
+            'returncode': 0,
+        }
+        mock_popen_return.configure_mock(**attrs)
+        mock_popen.configure_mock(return_value=mock_popen_return)
+
+        chain = iptables.Chain('testchain', iptables.mangle)
+        rule = iptables.Rule(
+            '-d 192.168.1.1 -p tcp --dport 80 '
+            '-m comment --comment "my service" -j MARK --set-mark 1')
+        with iptables.mangle.batch():
+            chain.append(rule)
+            chain.delete(rule)
+            chain.flush()
+            assert not mock_popen.called
+
+        mock_popen.assert_called_once_with(
+            ('iptables-restore', '-w', '--noflush'),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        mock_popen_return.communicate.assert_called_once_with('\n'.join([
+            '*mangle',
+            '-A testchain -d 192.168.1.1 -p tcp --dport 80 '
+            '-m comment --comment "my service" -j MARK --set-mark 1',
+            '-D testchain -d 192.168.1.1 -p tcp --dport 80 '
+            '-m comment --comment "my service" -j MARK --set-mark 1',
+            '-F testchain',
+            'COMMIT',
+        ]) + '\n')
+
+    @mock.patch('subprocess.Popen')
+    def test_batch_abort(self, mock_popen):
+        chain = iptables.Chain('testchain', iptables.mangle)
+        try:
+            with iptables.mangle.batch():
+                chain.append(iptables.Rule('-j ACCEPT'))
+                raise ValueError()
+        except ValueError:
+            pass
+
+        assert not mock_popen.called
+        assert iptables.mangle.current_batch is None
+
+
+iptables_save_output = '\n'.join([
+    '# Generated by iptables-save',
+    '*mangle',
+    ':PREROUTING ACCEPT [0:0]',
+    ':KUBE-PUBLIC - [0:0]',
+    '-A PREROUTING -j KUBE-PUBLIC',
+    '-A KUBE-PUBLIC -d 192.168.1.41/32 -p tcp -m tcp --dport 8080 '
+    '-m comment --comment web -j MARK --set-xmark 0x1/0xffffffff',
+    'COMMIT',
+])
+
+
+class TestCachedTable(unittest.TestCase):
+    def setUp(self):
+        self.table = iptables.CachedTable('mangle')
+
+    @mock.patch('subprocess.Popen')
+    def test_reads_from_snapshot(self, mock_popen):
+        mock_popen_return = mock.Mock()
+        attrs = {
+            'communicate.return_value': (iptables_save_output, ''),
+            'returncode': 0,
+        }
+        mock_popen_return.configure_mock(**attrs)
+        mock_popen.configure_mock(return_value=mock_popen_return)
+
+        assert self.table.chain_exists('KUBE-PUBLIC')
+        assert not self.table.chain_exists('does_not_exist')
+        assert tuple(self.table.list_chains()) == ('PREROUTING',
+                                                   'KUBE-PUBLIC')
+        chain = self.table.chains['PREROUTING']
+        assert chain.policy == 'ACCEPT'
+        assert list(chain.rules()) == [iptables.Rule('-j KUBE-PUBLIC')]
+        assert chain.rule_exists(iptables.Rule('-j KUBE-PUBLIC'))
+        assert not chain.rule_exists(iptables.Rule('-j ACCEPT'))
+
+        mock_popen.assert_called_once_with(('iptables-save', '-t',
+                                            'mangle'),
+                                           stdout=subprocess.PIPE,
+                                           stderr=subprocess.PIPE)
+
+    @mock.patch('subprocess.Popen')
+    def test_invalidate_on_write(self, mock_popen):
+        mock_popen_return = mock.Mock()
+        attrs = {
+            'communicate.return_value': (iptables_save_output, ''),
+            'returncode': 0,
+        }
+        mock_popen_return.configure_mock(**attrs)
+        mock_popen.configure_mock(return_value=mock_popen_return)
+
+        chain = self.table.chains['KUBE-PUBLIC']
+        chain.flush()
+        assert list(chain.rules()) == []
+        self.table.create_chain('testchain')
+        assert self.table.chain_exists('testchain')
+        # save, flush, create
+        assert mock_popen.call_count == 3
+
+        chain.append(iptables.Rule('-j ACCEPT'))
+        assert self.table.chain_exists('testchain')
+        assert mock_popen.call_count == 4
+        list(chain.rules())
+        assert mock_popen.call_count == 5
@@ -0,0 +1,310 @@
+#!/usr/bin/python
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import mock
+import requests
+
+from kiwi import manager
+from kiwi import metrics
+from kiwi.tests import fakeetcd
+
+
+def service(message, port=80, addresses=('10.0.0.1',), id='web'):
+    return {'message': '%s-service' % message,
+            'target': id,
+            'service': {'id': id,
+                        'port': port,
+                        'protocol': 'TCP',
+                        'publicIPs': list(addresses)}}
+
+
+class TestUpdateService(unittest.TestCase):
+    def setUp(self):
+        self.etcd = fakeetcd.FakeEtcd().start()
+        self.fw = mock.Mock()
+        self.mgr = manager.Manager(id='agent-a',
+                                   etcd_endpoint=self.etcd.endpoint,
+                                   fw_driver=self.fw,
+                                   heartbeat_mode='pass')
+
+    def tearDown(self):
+        self.mgr.client.close()
+        self.etcd.stop()
+
+    def fw_calls(self):
+        calls = [(name, args[0], args[1]['port'])
+                 for name, args, kwargs in self.fw.method_calls]
+        self.fw.reset_mock()
+        return sorted(calls)
+
+    def test_port_change(self):
+        self.mgr.handle_message(service('add'))
+        self.fw_calls()
+
+        self.mgr.handle_message(service('update', port=81))
+        assert self.fw_calls() == [('add_service', '10.0.0.1', 81),
+                                   ('remove_service', '10.0.0.1', 80)]
+        assert self.mgr.addresses['10.0.0.1']['count'] == 1
+        assert self.mgr.address_is_claimed('10.0.0.1')
+
+    def test_address_change(self):
+        self.mgr.handle_message(service('add',
+                                        addresses=['10.0.0.1',
+                                                   '10.0.0.2']))
+        self.fw_calls()
+
+        self.mgr.handle_message(service('update',
+                                        addresses=['10.0.0.2',
+                                                   '10.0.0.3']))
+        assert self.fw_calls() == [('add_service', '10.0.0.3', 80),
+                                   ('remove_service', '10.0.0.1', 80)]
+        assert '10.0.0.1' not in self.mgr.addresses
+        assert self.mgr.address_is_claimed('10.0.0.3')
+        assert '/kiwi/publicips/10.0.0.1' not in self.etcd.nodes
+
+    def test_unchanged_update(self):
+        self.mgr.handle_message(service('add'))
+        self.fw_calls()
+        puts = self.etcd.requests['PUT']
+
+        self.mgr.handle_message(service('update'))
+        self.mgr.handle_message(service('add'))
+        assert self.fw_calls() == []
+        assert self.etcd.requests['PUT'] == puts
+
+    def test_service_without_public_ips(self):
+        # services that kiwi does not manage need not have a port.
+        self.mgr.handle_message({'message': 'add-service',
+                                 'target': 'internal',
+                                 'service': {'id': 'internal'}})
+        assert self.mgr.services == {}
+
+        # losing all of its addresses is the same as being deleted.
+        self.mgr.handle_message(service('add'))
+        self.mgr.handle_message(service('update', addresses=[]))
+        assert self.mgr.services == {}
+        assert '10.0.0.1' not in self.mgr.addresses
+
+    def test_shared_address(self):
+        self.mgr.handle_message(service('add', id='a'))
+        self.mgr.handle_message(service('add', id='b'))
+        self.mgr.handle_message(service('update', id='a',
+                                        addresses=['10.0.0.2']))
+        assert self.mgr.addresses['10.0.0.1']['count'] == 1
+
+        self.mgr.handle_message(service('delete', id='b'))
+        assert '10.0.0.1' not in self.mgr.addresses
+        assert self.mgr.address_is_claimed('10.0.0.2')
+
+    def test_takeover_connection_failed(self):
+        with mock.patch.object(self.mgr.client, 'request',
+                               side_effect=requests.ConnectionError()):
+            assert self.mgr.takeover_address('10.0.0.1', 'agent-b') is False
+
+
+class TestReconcile(unittest.TestCase):
+    def setUp(self):
+        self.etcd = fakeetcd.FakeEtcd().start()
+        self.fw = mock.MagicMock()
+        self.iface = mock.Mock()
+        self.iface.adopt_address.return_value = True
+        self.mgr = manager.Manager(id='agent-a',
+                                   etcd_endpoint=self.etcd.endpoint,
+                                   fw_driver=self.fw,
+                                   iface_driver=self.iface,
+                                   heartbeat_mode='pass',
+                                   reconcile=True)
+
+    def tearDown(self):
+        self.mgr.client.close()
+        self.etcd.stop()
+
+    def test_reconcile(self):
+        with self.etcd.cond:
+            for address, owner in [('10.0.0.1', 'agent-a'),
+                                   ('10.0.0.2', 'agent-a'),
+                                   ('10.0.0.3', 'agent-b')]:
+                self.etcd.put('/kiwi/publicips/%s' % address, owner)
+
+        services = [service('add', id='a', addresses=['10.0.0.1'])
+                    ['service'],
+                    service('add', id='b', addresses=['10.0.0.3',
+                                                      '10.0.0.4'])
+                    ['service']]
+        with mock.patch.object(self.mgr.service_watcher,
+                               'list_services',
+                               return_value=(services, 10)):
+            self.mgr.reconcile_state()
+
+        assert self.mgr.service_watcher.resource_version == 10
+        assert sorted(self.mgr.claimed_addresses()) == ['10.0.0.1',
+                                                        '10.0.0.4']
+        assert not self.mgr.address_is_claimed('10.0.0.3')
+
+        # our claim on 10.0.0.1 was renewed, the one on 10.0.0.2 was
+        # released, and the adopted addresses were not added again.
+        assert self.etcd.nodes['/kiwi/publicips/10.0.0.1'][
+            'modifiedIndex'] > 3
+        assert '/kiwi/publicips/10.0.0.2' not in self.etcd.nodes
+        assert not self.iface.add_address.called
+        assert self.fw.prune.called
+        assert self.iface.prune.called
+
+    def test_relist_failed(self):
+        with self.etcd.cond:
+            self.etcd.put('/kiwi/publicips/10.0.0.1', 'agent-a')
+
+        with mock.patch.object(self.mgr.service_watcher,
+                               'list_services',
+                               side_effect=requests.ConnectionError()):
+            self.mgr.reconcile_state()
+
+        # without a list of services nothing may be removed.
+        assert '/kiwi/publicips/10.0.0.1' in self.etcd.nodes
+        assert not self.fw.prune.called
+        assert not self.iface.prune.called
+
+
+class TestHeartbeat(unittest.TestCase):
+    def setUp(self):
+        self.etcd = fakeetcd.FakeEtcd().start()
+        self.iface = mock.Mock()
+        self.iface.adopt_address.return_value = False
+        self.mgr = manager.Manager(id='agent-a',
+                                   etcd_endpoint=self.etcd.endpoint,
+                                   fw_driver=mock.Mock(),
+                                   iface_driver=self.iface,
+                                   heartbeat_mode='pass')
+        self.mgr.handle_message(service('add'))
+
+    def tearDown(self):
+        self.mgr.client.close()
+        self.etcd.stop()
+
+    def test_release_during_refresh(self):
+        releases = []
+
+        def refresh_address(address, lft):
+            # the main loop releases the address while the interface
+            # is being refreshed, and must wait for the refresh.
+            thread = threading.Thread(target=self.mgr.release_address,
+                                      args=(address,))
+            thread.start()
+            thread.join(0.1)
+            assert thread.is_alive()
+            assert not self.iface.remove_address.called
+            releases.append(thread)
+
+        self.iface.refresh_address.side_effect = refresh_address
+        self.mgr.heartbeat('10.0.0.1')
+        releases[0].join(5)
+        self.iface.remove_address.assert_called_once_with('10.0.0.1')
+
+        # once released, the address is not refreshed again.
+        self.iface.refresh_address.reset_mock()
+        with self.assertRaises(requests.HTTPError):
+            self.mgr.heartbeat('10.0.0.1')
+        self.mgr.refresh_lifetime('10.0.0.1')
+        assert not self.iface.refresh_address.called
+
+    def test_heartbeat_seconds(self):
+        # heartbeats made by the scheduler are timed, not just refresh
+        # passes.
+        def count():
+            counts, total = metrics.heartbeat_seconds.values.get(
+                ('address',), ([], 0))
+            return sum(counts)
+
+        before = count()
+        self.mgr.heartbeat('10.0.0.1')
+        assert count() == before + 1
+
+
+class TestStateFile(unittest.TestCase):
+    def setUp(self):
+        self.etcd = fakeetcd.FakeEtcd().start()
+        self.dir = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.dir, 'state.json')
+        self.managers = []
+
+    def tearDown(self):
+        for mgr in self.managers:
+            mgr.client.close()
+        self.etcd.stop()
+        shutil.rmtree(self.dir)
+
+    def manager(self, id='agent-a'):
+        mgr = manager.Manager(id=id,
+                              etcd_endpoint=self.etcd.endpoint,
+                              heartbeat_mode='pass',
+                              state_file=self.state_file,
+                              keep_claims=True)
+        self.managers.append(mgr)
+        return mgr
+
+    def test_warm_restart(self):
+        old = self.manager()
+        msg = service('add', addresses=['10.0.0.1', '10.0.0.2'])
+        msg['service']['resourceVersion'] = 42
+        old.handle_message(msg)
+        old.resource_version = 42
+        old.cleanup()
+
+        assert os.listdir(self.dir) == ['state.json']
+        assert '/kiwi/publicips/10.0.0.1' in self.etcd.nodes
+
+        creates = self.etcd.requests['PUT']
+        new = self.manager()
+        assert new.load_state()
+        assert sorted(new.claimed_addresses()) == ['10.0.0.1', '10.0.0.2']
+        assert new.service_watcher.resource_version == 42
+        assert new.services['web']['port'] == 80
+
+        # both claims were renewed with prevValue rather than claimed
+        # again.
+        assert self.etcd.requests['PUT'] == creates + 2
+        assert self.etcd.nodes['/kiwi/publicips/10.0.0.1'][
+            'value'] == 'agent-a'
+
+    def test_ignore_other_agent(self):
+        old = self.manager()
+        old.handle_message(service('add'))
+        old.save_state()
+
+        new = self.manager(id='agent-b')
+        assert not new.load_state()
+        assert new.services == {}
+
+    def test_keep_claims_closes_driver(self):
+        mgr = self.manager()
+        mgr.iface_driver = mock.Mock()
+        mgr.cleanup()
+        assert mgr.iface_driver.close.called
+        assert not mgr.iface_driver.cleanup.called
+
+    def test_invalid_state(self):
+        with open(self.state_file, 'w') as fd:
+            fd.write('{"version": 1, ')
+
+        assert not self.manager().load_state()
+
+    def test_stop(self):
+        mgr = self.manager()
+        mgr.watch_services = lambda: None
+        thread = threading.Thread(target=mgr.run)
+        thread.start()
+
+        # as from a signal handler: the main loop notices on its own
+        # and exits through cleanup, which saves our state.
+        mgr.stop()
+        thread.join(5)
+        assert not thread.is_alive()
+        assert os.listdir(self.dir) == ['state.json']
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+
+import unittest
+
+import requests
+
+from kiwi import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_counter(self):
+        counter = self.registry.register(metrics.Counter(
+            'test_total', 'A counter.', ['kind']))
+        counter.inc(kind='a')
+        counter.inc(2, kind='a')
+        counter.inc(kind='b"c')
+
+        assert self.registry.render().splitlines() == [
+            '# HELP test_total A counter.',
+            '# TYPE test_total counter',
+            'test_total{kind="a"} 3.0',
+            'test_total{kind="b\\"c"} 1.0',
+        ]
+
+    def test_histogram(self):
+        hist = self.registry.register(metrics.Histogram(
+            'test_seconds', 'A histogram.', buckets=(0.1, 1)))
+        for value in [0.05, 0.1, 0.5, 5]:
+            hist.observe(value)
+
+        assert self.registry.render().splitlines()[2:] == [
+            'test_seconds_bucket{le="0.1"} 2',
+            'test_seconds_bucket{le="1.0"} 3',
+            'test_seconds_bucket{le="+Inf"} 4',
+            'test_seconds_sum 5.65',
+            'test_seconds_count 4',
+        ]
+
+    def test_gauge_function(self):
+        gauge = self.registry.register(metrics.Gauge(
+            'test_depth', 'A gauge.'))
+        values = [1]
+        gauge.set_function(lambda: len(values))
+        values.append(2)
+
+        assert self.registry.render().splitlines()[2:] == [
+            'test_depth 2.0']
+
+    def test_timed_command(self):
+        with self.assertRaises(ValueError):
+            with metrics.timed_command('test-fail'):
+                raise ValueError()
+
+        assert metrics.command_failures.values[('test-fail',)] == 1
+        assert metrics.command_seconds.values[('test-fail',)][0][-1] == 0
+
+    def test_serve(self):
+        self.registry.register(metrics.Gauge('test_up', 'Up.')).set(1)
+        server = metrics.serve(0, registry=self.registry)
+        try:
+            r = requests.get('http://127.0.0.1:%d/metrics' %
+                             server.server_port)
+            assert r.ok
+            assert 'test_up 1.0' in r.text
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+#!/usr/bin/python
+
+import unittest
+
+import netaddr
+
+from kiwi.netindex import NetworkIndex
+
+
+class TestNetworkIndex(unittest.TestCase):
+    def test_contains(self):
+        index = NetworkIndex(['10.0.0.0/24', '192.168.0.0/16'])
+
+        assert '10.0.0.1' in index
+        assert '10.0.0.255' in index
+        assert '192.168.10.1' in index
+        assert '10.0.1.0' not in index
+        assert '9.255.255.255' not in index
+        assert '172.16.0.1' not in index
+
+    def test_innermost_owner(self):
+        index = NetworkIndex([('10.0.0.0/8', 'outer'),
+                              ('10.1.0.0/16', 'middle'),
+                              ('10.1.2.0/24', 'inner'),
+                              ('10.2.0.0/16', 'other')])
+
+        assert index.owner('10.0.0.1') == 'outer'
+        assert index.owner('10.1.0.1') == 'middle'
+        assert index.owner('10.1.2.3') == 'inner'
+        assert index.owner('10.1.3.0') == 'middle'
+        assert index.owner('10.2.255.255') == 'other'
+        assert index.owner('10.3.0.0') == 'outer'
+        assert index.owner('11.0.0.0') is None
+
+    def test_default_owner_is_network(self):
+        index = NetworkIndex(['10.0.0.0/24'])
+        assert index.owner('10.0.0.5') == netaddr.IPNetwork('10.0.0.0/24')
+
+    def test_invalid_and_mixed_versions(self):
+        index = NetworkIndex(['10.0.0.0/24', 'fd00::/64'])
+
+        assert 'fd00::1' in index
+        assert 'fd01::1' not in index
+        assert '::10.0.0.1' not in index
+        assert 'not an address' not in index
+
+    def test_matches_linear_scan(self):
+        networks = [netaddr.IPNetwork('10.%d.%d.0/%d' % (i % 7, i, 20 + i % 9))
+                    for i in range(0, 256, 3)]
+        index = NetworkIndex(networks)
+
+        for i in range(0, 65536, 97):
+            address = '10.%d.%d.%d' % (i % 7, i // 256, i % 256)
+            expected = any(address in net for net in networks)
+            assert (address in index) == expected, address
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/python
+
+import ctypes
+import os
+import socket
+import subprocess
+import unittest
+
+from kiwi import netlink
+from kiwi.exc import InterfaceDriverError
+
+CLONE_NEWNET = 0x40000000
+netns = 'kiwi-test-%d' % os.getpid()
+
+
+def setns(fd):
+    libc = ctypes.CDLL('libc.so.6', use_errno=True)
+    if libc.setns(fd, CLONE_NEWNET) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+def ip(*args):
+    return subprocess.check_output(('ip', '-n', netns) + args)
+
+
+class TestNetlinkInterface(unittest.TestCase):
+    '''These tests run the netlink driver against the loopback
+    interface inside a private network namespace, so they need to run
+    as root but do not touch the host network configuration.'''
+
+    def setUp(self):
+        if os.getuid() != 0:
+            raise unittest.SkipTest('requires root')
+
+        try:
+            subprocess.check_call(['ip', 'netns', 'add', netns])
+        except (OSError, subprocess.CalledProcessError):
+            raise unittest.SkipTest('unable to create network namespace')
+
+        ip('link', 'set', 'lo', 'up')
+        ip('addr', 'add', '10.99.0.1/32', 'dev', 'lo', 'label', 'lo:kube')
+        ip('addr', 'add', '10.99.0.2/32', 'dev', 'lo', 'label', 'lo:other')
+
+        # The netlink socket belongs to the namespace in which it was
+        # created, so we only need to be in the test namespace while
+        # creating the driver.
+        with open('/proc/self/ns/net') as orig, \
+                open('/var/run/netns/%s' % netns) as target:
+            setns(target.fileno())
+            try:
+                self.iface = netlink.NetlinkInterface('lo')
+            finally:
+                setns(orig.fileno())
+
+    def tearDown(self):
+        subprocess.call(['ip', 'netns', 'del', netns])
+
+    def addresses(self):
+        return ip('-o', '-4', 'addr', 'show', 'dev', 'lo')
+
+    def test_startup_removes_labelled_addresses(self):
+        out = self.addresses()
+        assert '10.99.0.1/32' not in out
+        assert '10.99.0.2/32' in out
+
+    def test_add_refresh_remove(self):
+        self.iface.add_address('10.99.1.1', lft=20)
+        out = ip('-o', '-4', 'addr', 'show', 'label', 'lo:kube')
+        assert '10.99.1.1/32' in out
+        assert 'valid_lft 20sec' in out
+        assert self.iface.labelled_addresses() == ['10.99.1.1']
+
+        self.iface.refresh_address('10.99.1.1', lft=40)
+        out = ip('-o', '-4', 'addr', 'show', 'label', 'lo:kube')
+        assert 'valid_lft 40sec' in out
+
+        self.iface.remove_address('10.99.1.1')
+        assert '10.99.1.1/32' not in self.addresses()
+        assert self.iface.labelled_addresses() == []
+
+    def test_remove_missing_address(self):
+        with self.assertRaises(InterfaceDriverError) as ctx:
+            self.iface.remove_address('10.99.2.1')
+
+        assert ctx.exception.returncode
+
+    def test_cleanup(self):
+        self.iface.add_address('10.99.1.1')
+        self.iface.cleanup()
+        assert '10.99.1.1/32' not in self.addresses()
+
+        # the netlink socket is closed.
+        with self.assertRaises(socket.error):
+            self.iface.nl.sock.recv(1)
@@ -0,0 +1,123 @@
+#!/usr/bin/python
+
+import json
+import unittest
+import mock
+
+from kiwi import firewall
+from kiwi import iptables
+from kiwi import nftables
+
+listed_set = json.dumps({'nftables': [
+    {'metainfo': {'json_schema_version': 1}},
+    {'set': {'family': 'ip', 'table': 'kiwi', 'name': 'kiwi-public',
+             'type': ['ipv4_addr', 'inet_proto', 'inet_service'],
+             'elem': [{'concat': ['10.0.0.1', 'tcp', 80]},
+                      {'concat': ['10.0.0.2', 'tcp', 80]}]}}]})
+
+
+def service(id, port=80, protocol='TCP'):
+    return {'id': id, 'port': port, 'protocol': protocol}
+
+
+class TestNftFirewall(unittest.TestCase):
+    def setUp(self):
+        self.nft = nftables.Nft()
+        self.nft.nft = mock.Mock(return_value=listed_set)
+
+    def transactions(self):
+        transactions = [kwargs['input'].splitlines()
+                        for args, kwargs in self.nft.nft.call_args_list
+                        if args == ('-f', '-')]
+        self.nft.nft.reset_mock()
+        return transactions
+
+    def test_create(self):
+        nftables.NftFirewall(nft=self.nft)
+        [commands] = self.transactions()
+        assert commands[:2] == ['add table ip kiwi', 'delete table ip kiwi']
+        assert commands[-1] == (
+            'add rule ip kiwi prerouting ip daddr . meta l4proto . '
+            'th dport @kiwi-public meta mark set 1')
+
+    def test_batch(self):
+        fw = nftables.NftFirewall(nft=self.nft)
+        self.transactions()
+
+        with fw.batch():
+            fw.add_service('10.0.0.1', service('web'))
+            fw.add_service('10.0.0.1', service('www'))
+            fw.add_service('10.0.0.2', service('dns', 53, 'UDP'))
+            fw.remove_service('10.0.0.1', service('web'))
+
+        assert self.transactions() == [[
+            'add element ip kiwi kiwi-public { 10.0.0.1 . tcp . 80 }',
+            'add element ip kiwi kiwi-public { 10.0.0.2 . udp . 53 }']]
+
+        fw.remove_service('10.0.0.1', service('www'))
+        assert self.transactions() == [[
+            'delete element ip kiwi kiwi-public { 10.0.0.1 . tcp . 80 }']]
+
+    def test_batch_failure(self):
+        fw = nftables.NftFirewall(nft=self.nft)
+
+        def nft(*args, **kwargs):
+            input = kwargs['input']
+            if input.count('\n') > 1 or '10.0.0.2' in input:
+                raise iptables.CommandError(args, 1, '', 'failed')
+
+        self.nft.nft.side_effect = nft
+        with self.assertRaises(nftables.FirewallDriverError):
+            with fw.batch():
+                for i in range(3):
+                    fw.add_service('10.0.0.%d' % i, service('web'))
+
+        assert sorted(fw.entries) == [('10.0.0.0', 'tcp', '80'),
+                                      ('10.0.0.1', 'tcp', '80')]
+
+    def test_failed_delete(self):
+        fw = nftables.NftFirewall(nft=self.nft)
+        fw.add_service('10.0.0.1', service('web'))
+
+        self.nft.nft.side_effect = iptables.CommandError(
+            ('nft',), 1, '', 'failed')
+        with self.assertRaises(nftables.FirewallDriverError):
+            with fw.batch():
+                fw.remove_service('10.0.0.1', service('web'))
+
+        # the entry is still in the set, so we still track it.
+        assert fw.entries == {('10.0.0.1', 'tcp', '80'): set(['web'])}
+
+    def test_abort(self):
+        fw = nftables.NftFirewall(nft=self.nft)
+        fw.add_service('10.0.0.1', service('web'))
+        self.transactions()
+
+        with self.assertRaises(ValueError):
+            with fw.batch():
+                fw.add_service('10.0.0.2', service('web'))
+                fw.remove_service('10.0.0.1', service('web'))
+                raise ValueError()
+
+        assert self.transactions() == []
+        assert fw.entries == {('10.0.0.1', 'tcp', '80'): set(['web'])}
+
+    def test_abstract(self):
+        with self.assertRaises(TypeError):
+            firewall.SetFirewall()
+
+    def test_adopt_and_prune(self):
+        fw = nftables.NftFirewall(nft=self.nft, reconcile=True)
+        [commands] = self.transactions()
+        assert 'delete table ip kiwi' not in commands
+
+        fw.add_service('10.0.0.1', service('web'))
+        fw.add_service('10.0.0.3', service('new'))
+        fw.prune()
+        assert self.transactions() == [
+            ['add element ip kiwi kiwi-public { 10.0.0.3 . tcp . 80 }'],
+            ['delete element ip kiwi kiwi-public { 10.0.0.2 . tcp . 80 }']]
+
+
+if __name__ == '__main__':
+    unittest.main()
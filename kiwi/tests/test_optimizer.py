@@ -0,0 +1,91 @@
+#!/usr/bin/python
+
+import unittest
+
+from kiwi import firewall
+from kiwi import iptables
+from kiwi import optimizer
+from kiwi.tests.test_firewall import FakeTable, service
+
+rules = [
+    '-d 10.0.0.%d/32 -p tcp -m tcp --dport 80 -m comment --comment s%d '
+    '-g KUBE-PUBLIC-MARK' % (i, i) for i in range(1, 4)]
+
+
+def save(counts, extra=()):
+    return '\n'.join(
+        ['*mangle',
+         ':PREROUTING ACCEPT [0:0]',
+         ':KUBE-PUBLIC - [0:0]',
+         ':KUBE-PUBLIC-MARK - [0:0]',
+         '[500:30000] -A PREROUTING -j KUBE-PUBLIC'] +
+        ['[%d:%d] -A KUBE-PUBLIC %s' % (count, count * 60, rule)
+         for count, rule in zip(counts, rules)] +
+        list(extra) +
+        ['[500:30000] -A KUBE-PUBLIC-MARK -j MARK --set-xmark 0x1/0xffffffff',
+         'COMMIT']) + '\n'
+
+
+class TestOptimizer(unittest.TestCase):
+    def setUp(self):
+        self.table = FakeTable({'KUBE-PUBLIC': []})
+        self.fw = firewall.Firewall(table=self.table, reorder=True)
+        self.opt = optimizer.Optimizer(self.fw)
+        self.table.changes()
+
+    def optimize(self, text):
+        self.table.iptables_save = lambda *args: text
+        return self.opt.optimize()
+
+    def test_parse_counters(self):
+        chains = iptables.parse_counters(save([1, 2, 3]))
+        assert list(chains) == ['PREROUTING', 'KUBE-PUBLIC',
+                                'KUBE-PUBLIC-MARK']
+        assert chains['KUBE-PUBLIC'][1] == (2, 120, iptables.Rule(rules[1]))
+
+    def test_goto_mark_chain(self):
+        rule = self.fw.rule_for('10.0.0.1', service('web'))
+        assert rule[-2:] == ('-g', 'KUBE-PUBLIC-MARK')
+
+    def test_reorder(self):
+        assert self.optimize(save([10, 20, 470])) == 1
+        assert self.table.changes() == [
+            '-F KUBE-PUBLIC',
+            '[470:28200] -A KUBE-PUBLIC %s' % rules[2],
+            '[20:1200] -A KUBE-PUBLIC %s' % rules[1],
+            '[10:600] -A KUBE-PUBLIC %s' % rules[0]]
+
+    def test_hysteresis(self):
+        # the best order would save less than 20% of the rules checked.
+        assert self.optimize(save([200, 210, 220])) == 0
+
+        # too little traffic to act on.
+        self.opt = optimizer.Optimizer(self.fw)
+        assert self.optimize(save([0, 0, 50])) == 0
+
+    def test_uses_rates(self):
+        assert self.optimize(save([400, 50, 50])) == 0
+
+        # the third rule is now the busiest, but its total count is
+        # still the smallest.
+        assert self.optimize(save([410, 60, 450])) == 1
+        assert self.table.changes()[1].startswith('[450:')
+
+    def test_foreign_rule(self):
+        extra = ['[0:0] -A KUBE-PUBLIC -s 192.168.0.0/16 -j RETURN']
+        assert self.optimize(save([10, 20, 470], extra)) == 0
+
+    def test_cleanup(self):
+        self.fw.optimizer = self.opt
+        self.opt.interval = 60
+        self.opt.start()
+        self.fw.cleanup()
+
+        assert not self.opt.thread.is_alive()
+        assert self.table.changes() == ['-F KUBE-PUBLIC',
+                                         '-F KUBE-PUBLIC-MARK',
+                                         '-X KUBE-PUBLIC-MARK']
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/python
+
+import unittest
+
+from kiwi import manager
+from kiwi.tests import fakeetcd
+
+
+def add_service(address):
+    return {'message': 'add-service',
+            'target': 'web-%s' % address,
+            'service': {'id': 'web-%s' % address,
+                        'port': 80,
+                        'protocol': 'TCP',
+                        'publicIPs': [address]}}
+
+
+class TestAgentOwnership(unittest.TestCase):
+    def setUp(self):
+        self.etcd = fakeetcd.FakeEtcd().start()
+        self.managers = [manager.Manager(id=id,
+                                         etcd_endpoint=self.etcd.endpoint,
+                                         ownership_mode='agent',
+                                         heartbeat_mode='pass')
+                         for id in ['agent-a', 'agent-b']]
+
+    def tearDown(self):
+        for mgr in self.managers:
+            mgr.client.close()
+        self.etcd.stop()
+
+    def owner(self, address):
+        return self.etcd.nodes['/kiwi/publicips/%s' % address]['value']
+
+    def test_single_heartbeat(self):
+        a, b = self.managers
+        a.register_agent()
+        for i in range(10):
+            a.handle_add_service(add_service('10.0.0.%d' % i))
+
+        assert len(a.claimed_addresses()) == 10
+        assert self.etcd.nodes['/kiwi/publicips/10.0.0.1'][
+            'expiration'] is None
+
+        puts = self.etcd.requests['PUT']
+        a.refresh()
+        assert self.etcd.requests['PUT'] == puts + 1
+
+    def test_takeover(self):
+        a, b = self.managers
+        a.register_agent()
+        b.register_agent()
+
+        a.handle_add_service(add_service('10.0.0.1'))
+        b.handle_add_service(add_service('10.0.0.1'))
+        assert a.address_is_claimed('10.0.0.1')
+        assert not b.address_is_claimed('10.0.0.1')
+
+        self.etcd.expire('/kiwi/agents/agent-a')
+        b.handle_expire_agent({'message': 'expire-agent',
+                               'agent': 'agent-a'})
+        assert b.address_is_claimed('10.0.0.1')
+        assert self.owner('10.0.0.1') == 'agent-b'
+
+        # agent-a sees the change of ownership and lets go.
+        a.handle_set_address({'message': 'set-address',
+                              'address': '10.0.0.1',
+                              'node': {'value': 'agent-b'}})
+        assert not a.address_is_claimed('10.0.0.1')
+        assert self.owner('10.0.0.1') == 'agent-b'
+
+    def test_adopt_orphan(self):
+        a, b = self.managers
+        a.register_agent()
+        a.handle_add_service(add_service('10.0.0.1'))
+        self.etcd.expire('/kiwi/agents/agent-a')
+
+        b.register_agent()
+        b.handle_add_service(add_service('10.0.0.1'))
+        assert b.address_is_claimed('10.0.0.1')
+        assert self.owner('10.0.0.1') == 'agent-b'
+
+    def test_expired_agent_key(self):
+        a, b = self.managers
+        a.register_agent()
+        b.register_agent()
+        a.handle_add_service(add_service('10.0.0.1'))
+        a.handle_add_service(add_service('10.0.0.2'))
+
+        # agent-a's key expires while it cannot reach etcd, and
+        # agent-b takes over one of its addresses.
+        self.etcd.expire('/kiwi/agents/agent-a')
+        b.handle_add_service(add_service('10.0.0.1'))
+        b.handle_expire_agent({'message': 'expire-agent',
+                               'agent': 'agent-a'})
+        assert self.owner('10.0.0.1') == 'agent-b'
+
+        failed = {'message': 'agent-refresh-failed',
+                  'agent': 'agent-a',
+                  'reason': 'timed out'}
+        a.handle_agent_refresh_failed(failed)
+        assert a.address_is_claimed('10.0.0.1')
+
+        a.agent_renewed = 0
+        a.handle_agent_refresh_failed(failed)
+        assert not a.address_is_claimed('10.0.0.1')
+        assert a.address_is_claimed('10.0.0.2')
+        assert self.owner('10.0.0.2') == 'agent-a'
+        assert '/kiwi/agents/agent-a' in self.etcd.nodes
@@ -0,0 +1,43 @@
+#!/usr/bin/python
+
+import threading
+import unittest
+import mock
+
+from kiwi import manager
+from kiwi import scheduler
+
+
+class TestScheduler(unittest.TestCase):
+    def test_calls(self):
+        called = threading.Event()
+        sched = scheduler.Scheduler(0.05, lambda key: called.set())
+        sched.start()
+        try:
+            sched.add('a', delay=0)
+            assert called.wait(5)
+        finally:
+            sched.stop()
+
+        assert not sched.thread.is_alive()
+        assert sched.pool is None
+
+
+class TestSchedulerHeartbeats(unittest.TestCase):
+    def setUp(self):
+        self.client = mock.Mock()
+        self.client.put.return_value = mock.Mock(ok=True)
+        self.mgr = manager.Manager(id='agent-a',
+                                   client=self.client,
+                                   heartbeat_mode='scheduler')
+
+    def test_schedule_claimed_address(self):
+        # an empty scheduler is falsy, which must not stop us from
+        # scheduling the first address.
+        self.mgr.addresses['10.0.0.1'] = {'claimed': False}
+        self.mgr.claim_address('10.0.0.1')
+        assert self.mgr.address_is_claimed('10.0.0.1')
+        assert '10.0.0.1' in self.mgr.scheduler
+
+        self.mgr.release_address('10.0.0.1')
+        assert '10.0.0.1' not in self.mgr.scheduler
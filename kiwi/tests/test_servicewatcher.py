@@ -0,0 +1,135 @@
+#!/usr/bin/python
+
+import json
+import threading
+import unittest
+import mock
+import Queue
+
+from kiwi import client
+from kiwi import servicewatcher
+from kiwi.tests import fakekube
+
+
+def service(id, version, port=80):
+    return {'id': id, 'resourceVersion': version, 'port': port,
+            'protocol': 'TCP', 'publicIPs': ['10.0.0.1']}
+
+
+def response(status_code=200, json_data=None, events=None):
+    r = mock.Mock(status_code=status_code)
+    r.json.return_value = json_data
+
+    if events is not None:
+        r.raw.chunked = False
+        r.raw.stream.return_value = [json.dumps(event) + '\n'
+                                     for event in events]
+
+    return r
+
+
+class TestListWatch(unittest.TestCase):
+    def setUp(self):
+        self.client = mock.Mock(connect_timeout=1)
+        self.watcher = servicewatcher.ServiceWatcher(client=self.client,
+                                                     reconnect_interval=0)
+
+    def test_relist_diff(self):
+        self.watcher.services = {'a': service('a', 1),
+                                 'b': service('b', 2),
+                                 'c': service('c', 3)}
+        self.client.get.return_value = response(json_data={
+            'resourceVersion': 10,
+            'items': [service('a', 1), service('b', 5), service('d', 6)]})
+
+        events = sorted((event['type'], event['object']['id'])
+                        for event in self.watcher.relist())
+        assert events == [('ADDED', 'd'),
+                          ('DELETED', 'c'),
+                          ('MODIFIED', 'b')]
+        assert self.watcher.resource_version == 10
+        assert sorted(self.watcher.services) == ['a', 'b', 'd']
+
+    def test_resume_from_resource_version(self):
+        self.client.get.side_effect = [
+            response(json_data={'resourceVersion': 10,
+                                'items': [service('a', 3)]}),
+            response(events=[{'type': 'ADDED',
+                              'object': service('b', 11)}]),
+            response(events=[{'type': 'DELETED',
+                              'object': service('a', 12)}]),
+            response(status_code=410),
+            response(json_data={'resourceVersion': 20,
+                                'items': [service('b', 11),
+                                          service('c', 15)]}),
+        ]
+
+        events = self.watcher.iter_list_watch()
+        seen = [(event['type'], event['object']['id'])
+                for _, event in zip(range(4), events)]
+        assert seen == [('ADDED', 'a'), ('ADDED', 'b'),
+                        ('DELETED', 'a'), ('ADDED', 'c')]
+
+        params = [call[1].get('params') for call in
+                  self.client.get.call_args_list]
+        assert params == [None,
+                          {'resourceVersion': 10},
+                          {'resourceVersion': 11},
+                          {'resourceVersion': 12},
+                          None]
+
+
+class TestFakeKube(unittest.TestCase):
+    def setUp(self):
+        self.kube = fakekube.FakeKube().start()
+        self.client = client.Client()
+
+    def tearDown(self):
+        self.client.close()
+        self.kube.stop()
+
+    def test_list_watch(self):
+        self.kube.add(service('a', None))
+
+        watcher = servicewatcher.ServiceWatcher(
+            kube_endpoint=self.kube.endpoint,
+            client=self.client,
+            reconnect_interval=0)
+        q = Queue.Queue()
+        thread = threading.Thread(target=lambda: [q.put(msg)
+                                                  for msg in watcher])
+        thread.daemon = True
+        thread.start()
+
+        assert q.get(timeout=5)['target'] == 'a'
+
+        self.kube.add(service('b', None))
+        self.kube.modify(service('a', None, port=81))
+        self.kube.delete(service('b', None))
+
+        seen = [q.get(timeout=5) for i in range(3)]
+        assert [(msg['message'], msg['target']) for msg in seen] == [
+            ('add-service', 'b'),
+            ('update-service', 'a'),
+            ('delete-service', 'b')]
+        assert seen[1]['service']['port'] == 81
+        assert watcher.resource_version == 4
+
+    def test_resume_with_pending_events(self):
+        for id in 'abcde':
+            self.kube.add(service(id, None))
+
+        # the first events arrive together with the response headers.
+        watcher = servicewatcher.ServiceWatcher(
+            kube_endpoint=self.kube.endpoint,
+            client=self.client,
+            reconnect_interval=0)
+        watcher.resource_version = 1
+        q = Queue.Queue()
+        thread = threading.Thread(target=lambda: [q.put(msg)
+                                                  for msg in watcher])
+        thread.daemon = True
+        thread.start()
+
+        assert [q.get(timeout=5)['target'] for i in range(4)] == [
+            'b', 'c', 'd', 'e']
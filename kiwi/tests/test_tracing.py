@@ -0,0 +1,100 @@
+#!/usr/bin/python
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from kiwi import iptables
+from kiwi import tracing
+
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        self.spans = []
+        tracing.add_hook(self.spans.append)
+
+    def tearDown(self):
+        tracing.remove_hook(self.spans.append)
+
+    def test_nested_spans(self):
+        with tracing.span('outer', kind='test') as outer:
+            with tracing.span('inner') as inner:
+                inner.set(status=200)
+
+        assert [span.name for span in self.spans] == ['inner', 'outer']
+        assert inner.parent == outer.id
+        assert outer.parent is None
+        assert inner.attrs == {'status': 200}
+        assert outer.duration >= inner.duration
+
+    def test_error(self):
+        with self.assertRaises(ValueError):
+            with tracing.span('failing'):
+                raise ValueError('broken')
+
+        assert self.spans[0].error == 'broken'
+
+    def test_command_span(self):
+        with self.assertRaises(iptables.CommandError):
+            iptables.cmd('sh', '-c', 'echo failed >&2; exit 1')
+
+        span = self.spans[-1]
+        assert span.name == 'command'
+        assert span.attrs['command'] == 'sh'
+        assert span.error
+
+    def test_no_hooks(self):
+        tracing.remove_hook(self.spans.append)
+        try:
+            with tracing.span('ignored') as span:
+                span.set(status=200)
+        finally:
+            tracing.add_hook(self.spans.append)
+
+        assert self.spans == []
+
+
+class TestBuffer(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        tracing.enable(2)
+
+    def tearDown(self):
+        tracing.remove_hook(tracing.buffer)
+        tracing.buffer = None
+        shutil.rmtree(self.dir)
+
+    def test_dump(self):
+        for name in ['a', 'b', 'c']:
+            with tracing.span(name, n=name):
+                pass
+
+        path = os.path.join(self.dir, 'trace.json')
+        tracing.dump(path)
+
+        with open(path) as fd:
+            spans = [json.loads(line) for line in fd]
+
+        assert [span['name'] for span in spans] == ['b', 'c']
+        assert spans[0]['attrs'] == {'n': 'b'}
+
+    def test_requested_dump(self):
+        path = os.path.join(self.dir, 'trace.json')
+        tracing.enable(2, path)
+        with tracing.span('a'):
+            pass
+
+        tracing.dump_if_requested()
+        assert not os.path.exists(path)
+
+        # as from the SIGUSR1 handler, then the main loop.
+        tracing.request_dump()
+        tracing.dump_if_requested()
+        assert os.path.exists(path)
+        assert not tracing.dump_requested
+
+
+if __name__ == '__main__':
+    unittest.main()
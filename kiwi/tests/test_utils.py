@@ -0,0 +1,105 @@
+#!/usr/bin/python
+
+import httplib
+import os
+import socket
+import unittest
+
+from requests.packages import urllib3
+
+from kiwi import utils
+from kiwi.utils import StreamDecoder
+
+
+class PipeSocket(object):
+    '''Just enough of a socket for httplib to read a response from a
+    file.'''
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def makefile(self, *args, **kwargs):
+        return self.fd
+
+
+def response(data, sock=True):
+    '''Return a streamed urllib3 response that reads `data`, a complete
+    HTTP response, as requests does: through the buffered file object
+    of a socket, or if sock is False of a plain file.'''
+
+    if sock:
+        rsock, wsock = socket.socketpair()
+        wsock.sendall(data)
+        wsock.close()
+        src = socket.socket(_sock=rsock)
+    else:
+        rfd, wfd = os.pipe()
+        os.write(wfd, data)
+        os.close(wfd)
+        src = PipeSocket(os.fdopen(rfd, 'rb'))
+
+    r = httplib.HTTPResponse(src, method='GET', buffering=True)
+    r.begin()
+    return urllib3.HTTPResponse.from_httplib(r, preload_content=False)
+
+
+def chunked(*chunks):
+    return ('HTTP/1.1 200 OK\r\n'
+            'Transfer-Encoding: chunked\r\n'
+            '\r\n' +
+            ''.join('%x\r\n%s\r\n' % (len(chunk), chunk)
+                    for chunk in chunks) +
+            '0\r\n\r\n')
+
+
+class TestSplitChunks(unittest.TestCase):
+    def test_split(self):
+        assert utils.split_chunks('3\r\nabc\r\n2\r\nde\r\n1\r') == (
+            ['abc', 'de'], '1\r', False)
+        assert utils.split_chunks('3\r\nabc\r\n2\r\nd') == (
+            ['abc'], '2\r\nd', False)
+        assert utils.split_chunks('3\r\nabc\r\n0\r\n\r\n') == (
+            ['abc'], '', True)
+
+    def test_crlf_in_chunk(self):
+        assert utils.split_chunks('4\r\na\r\nb\r\n3;x=1\r\nabc\r\n4\r\n') == (
+            ['a\r\nb', 'abc'], '4\r\n', False)
+
+
+def decode(*args):
+    return [event for events in StreamDecoder(*args) for event in events]
+
+
+class TestStreamDecoder(unittest.TestCase):
+    def test_one_payload_per_chunk(self):
+        r = response(chunked('{"a": 1}\n', '{"b": 2}\n'))
+        assert list(StreamDecoder(r)) == [[{'a': 1}, {'b': 2}]]
+        assert r.closed
+
+    def test_payloads_split_across_chunks(self):
+        data = chunked('{"a": 1}\n{"b"', ': 2}\n', '\n{"c": 3}')
+        for read_size in [1, 2, 3, 5, 1024]:
+            assert decode(response(data), read_size) == [
+                {'a': 1}, {'b': 2}, {'c': 3}]
+
+    def test_partial_value_in_chunk(self):
+        # a chunk that starts with a complete value need not end with it.
+        data = chunked('12', '3\n', '{"a": 1} \n', '4\n5\n')
+        assert decode(response(data)) == [123, {'a': 1}, 4, 5]
+
+    def test_crlf_in_chunk(self):
+        data = chunked('{"a": 1}\r\n{"b": 2}\n', '{"c": 3}\n')
+        for read_size in [1, 1024]:
+            assert decode(response(data), read_size) == [
+                {'a': 1}, {'b': 2}, {'c': 3}]
+
+    def test_invalid_payload(self):
+        data = chunked('{"a": 1}\n', '{"b"\n')
+        with self.assertRaises(ValueError):
+            decode(response(data))
+
+    def test_not_from_socket(self):
+        # anything we cannot read from a socket ourselves is read
+        # through urllib3.
+        data = chunked('{"a": 1}\n{"b"', ': 2}\n')
+        assert decode(response(data, sock=False), 4) == [{'a': 1}, {'b': 2}]
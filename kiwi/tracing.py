@@ -0,0 +1,180 @@
+import collections
+import contextlib
+import itertools
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+hooks = []
+buffer = None
+dump_path = None
+dump_requested = False
+local = threading.local()
+ids = itertools.count(1)
+
+
+class Span (object):
+    '''A Span records the timing, attributes and outcome of a single
+    operation.  Spans opened while another span is active in the same
+    thread record it as their parent.'''
+
+    def __init__(self, name, parent=None, attrs=None):
+        self.id = next(ids)
+        self.parent = parent
+        self.name = name
+        self.attrs = attrs or {}
+        self.thread = threading.current_thread().name
+        self.start = time.time()
+        self.duration = None
+        self.error = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def to_dict(self):
+        return {'id': self.id,
+                'parent': self.parent,
+                'name': self.name,
+                'thread': self.thread,
+                'start': self.start,
+                'duration': self.duration,
+                'error': self.error,
+                'attrs': self.attrs}
+
+
+class NullSpan (object):
+    '''Stands in for a Span when nothing is listening.'''
+
+    def set(self, **attrs):
+        pass
+
+
+null_span = NullSpan()
+
+
+class Buffer (object):
+    '''A ring buffer that keeps the most recently finished spans.'''
+
+    def __init__(self, size):
+        self.spans = collections.deque(maxlen=size)
+
+    def __call__(self, span):
+        self.spans.append(span)
+
+    def dump(self, fd):
+        '''Write the buffered spans to fd as JSON, one per line, in the
+        order in which they started.'''
+
+        for span in sorted(list(self.spans), key=lambda span: span.start):
+            fd.write(json.dumps(span.to_dict(), sort_keys=True) + '\n')
+
+
+def add_hook(hook):
+    '''Call hook(span) every time a span finishes.'''
+    hooks.append(hook)
+
+
+def remove_hook(hook):
+    hooks.remove(hook)
+
+
+def enable(size, path=None):
+    '''Keep the last `size` spans in a ring buffer that can be written
+    out with dump(), or to `path` by dump_if_requested().'''
+
+    global buffer, dump_path
+
+    dump_path = path
+
+    if buffer is not None:
+        remove_hook(buffer)
+
+    buffer = Buffer(size)
+    add_hook(buffer)
+
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    '''Record a span around the body of the context.  The span is
+    yielded so that attributes learned inside the context (such as an
+    HTTP status) can be added with span.set().  If there are no hooks
+    this does nothing.'''
+
+    if not hooks:
+        yield null_span
+        return
+
+    stack = getattr(local, 'stack', None)
+    if stack is None:
+        stack = local.stack = []
+
+    current = Span(name, stack[-1].id if stack else None, attrs)
+    stack.append(current)
+    try:
+        yield current
+    except Exception as exc:
+        current.error = str(exc) or exc.__class__.__name__
+        raise
+    finally:
+        stack.pop()
+        current.duration = time.time() - current.start
+        for hook in list(hooks):
+            try:
+                hook(current)
+            except Exception as exc:
+                LOG.error('tracing hook %s failed: %s', hook, exc)
+
+
+def dump(path=None):
+    '''Write the contents of the span buffer to path, replacing it
+    atomically, or to stderr if path is None.'''
+
+    if buffer is None:
+        LOG.warn('tracing is not enabled')
+        return
+
+    if path is None:
+        buffer.dump(sys.stderr)
+        return
+
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.kiwi-trace')
+    try:
+        with os.fdopen(fd, 'w') as out:
+            buffer.dump(out)
+
+        os.rename(tmp, path)
+    except (IOError, OSError) as exc:
+        LOG.error('failed to write trace to %s: %s', path, exc)
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+    else:
+        LOG.warn('wrote %d spans to %s', len(buffer.spans), path)
+
+
+def request_dump():
+    '''Ask for the span buffer to be written out by the next call to
+    dump_if_requested().  This only sets a flag, so it is safe to call
+    from a signal handler.'''
+
+    global dump_requested
+    dump_requested = True
+
+
+def dump_if_requested():
+    '''Write out the span buffer if request_dump() has been called
+    since we last did.'''
+
+    global dump_requested
+
+    if dump_requested:
+        dump_requested = False
+        dump(dump_path)
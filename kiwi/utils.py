@@ -1,27 +1,166 @@
-import os
+import json
+import socket
 
+import defaults
 
-def iter_lines(fd, chunk_size=1024):
-    '''Iterates over the content of a file-like object line-by-line.'''
 
-    pending = None
+def split_chunks(data):
+    '''Split as many complete chunks as possible off the front of
+    `data`, the body of a response with chunked transfer encoding.
+    Returns a list of the chunks, the rest of the data, and whether the
+    last (empty) chunk was reached.
+
+    The whole buffer is split on CRLF, and the sizes checked against
+    the lengths of the chunks, in a few calls that each handle every
+    chunk at once.  Only if that fails, because a chunk contains a CRLF
+    of its own, has a chunk extension or is the last one, is the
+    buffer split one chunk at a time.'''
+
+    parts = data.split(b'\r\n')
+    rest = parts.pop()
+    if len(parts) % 2:
+        rest = parts.pop() + b'\r\n' + rest
+
+    lines, chunks = parts[0::2], parts[1::2]
+    try:
+        sizes = map(int, lines, [16] * len(lines))
+    except ValueError:
+        sizes = None
+
+    if sizes == map(len, chunks) and 0 not in sizes:
+        return chunks, rest, False
+
+    return split_chunks_by_size(data)
+
+
+def split_chunks_by_size(data):
+    '''Like split_chunks, but find the end of each chunk in turn from
+    its size.'''
+
+    chunks = []
+    pos = 0
 
     while True:
-        chunk = os.read(fd.fileno(), chunk_size)
-        if not chunk:
+        nl = data.find(b'\r\n', pos)
+        if nl < 0:
+            break
+
+        size = int(data[pos:nl].split(b';', 1)[0], 16)
+        if not size:
+            return chunks, b'', True
+
+        start = nl + 2
+        end = start + size
+        if end + 2 > len(data):
             break
+        if data[end:end + 2] != b'\r\n':
+            raise ValueError('chunk of %d bytes is not followed by CRLF'
+                             % size)
+
+        chunks.append(data[start:end])
+        pos = end + 2
+
+    return chunks, data[pos:], False
+
+
+class StreamDecoder (object):
+    '''Parses the newline-terminated JSON payloads in the body of a
+    streamed HTTP response, and yields a list of the values parsed from
+    each read.
+
+    `raw` is the urllib3 response of a streamed `requests` request
+    (`response.raw`).  A chunked response, which is how the Kubernetes
+    API sends watch events, is read straight from the socket beneath
+    httplib's file object, `read_size` bytes at a time, starting with
+    whatever httplib read along with the headers.  The chunks in each
+    read are split out of a single string (see split_chunks).  Any
+    other response is read through urllib3.
+
+    Each chunk is parsed where it is with JSONDecoder.raw_decode, and
+    if it holds exactly one payload, as each watch event does, that is
+    all.  Payloads that are split across chunks, or chunks that hold
+    several payloads, are collected in a bytearray that is scanned only
+    once.'''
+
+    def __init__(self, raw, read_size=defaults.stream_read_size):
+        self.raw = raw
+        self.read_size = read_size
+
+    def __iter__(self):
+        raw_decode = json.JSONDecoder().raw_decode
+        buf = bytearray()
+        scanned = 0
+
+        for blocks in self.read_blocks():
+            values = []
+            for block in blocks:
+                if not buf:
+                    try:
+                        value, end = raw_decode(block)
+                    except ValueError:
+                        pass
+                    else:
+                        if end == len(block) - 1 and block[end] == b'\n':
+                            values.append(value)
+                            continue
+
+                buf += block
+
+                # parse any complete payloads.
+                first = 0
+                while True:
+                    nl = buf.find(b'\n', scanned)
+                    if nl < 0:
+                        scanned = len(buf)
+                        break
+
+                    payload = bytes(buf[first:nl])
+                    if payload.strip():
+                        values.append(json.loads(payload))
+                    first = scanned = nl + 1
+
+                if first:
+                    del buf[:first]
+                    scanned -= first
+
+            if values:
+                yield values
+
+        if bytes(buf).strip():
+            yield [json.loads(bytes(buf))]
+
+    def read_blocks(self):
+        '''Return an iterator over lists of blocks of the response body,
+        one list for each read.'''
+
+        fp = getattr(getattr(self.raw, '_fp', None), 'fp', None)
+        if (self.raw.chunked and
+                not self.raw.headers.get('content-encoding') and
+                isinstance(fp, socket._fileobject)):
+            return self.read_chunks(fp)
 
-        if pending is not None:
-            chunk = pending + chunk
-            pending = None
+        return ([block] for block in
+                self.raw.stream(self.read_size, decode_content=True))
 
-        lines = chunk.splitlines()
+    def read_chunks(self, fp):
+        '''Undo the chunked transfer encoding of the response, and yield
+        the complete chunks from each read.'''
 
-        if lines and lines[-1]:
-            pending = lines.pop()
+        data = fp._rbuf.getvalue()
+        recv = fp._sock.recv
 
-        for line in lines:
-            yield line
+        try:
+            while True:
+                chunks, data, done = split_chunks(data)
+                yield chunks
+                if done:
+                    return
 
-    if pending:
-        yield(pending)
+                block = recv(self.read_size)
+                if not block:
+                    return
+                data += block
+        finally:
+            # we have read behind httplib's back, so the connection
+            # cannot be used again.
+            self.raw.close()